@@ -13,72 +13,139 @@
 #      them back to the original image buffer using bilinear interpolation to remove tile
 #      artifacts
 # 4. OpenGL builtin GL_LINEAR scaling is used to map the input image to a fullscreen image.
-# 5. Final image is rendered to screen. 
+# 5. Final image is rendered to screen, by a fullscreen triangle or a framebuffer blit
+#    (presentation.py). 
+
+import os
+import sys
+
+# PyOpenGL binds to a windowing platform the first time OpenGL is imported, so headless
+# runs have to pick EGL or OSMesa before the imports below.
+def select_gl_platform(argv):
+    for i, arg in enumerate(argv):
+        if arg == '--headless' or arg.startswith('--headless='):
+            backend = arg.partition('=')[2]
+            if not backend and i + 1 < len(argv) and not argv[i + 1].startswith('-'):
+                backend = argv[i + 1]
+            os.environ.setdefault('PYOPENGL_PLATFORM', backend or 'egl')
+    # offline batches need no window either
+    if any(arg == '--batch' or arg.startswith('--batch=') for arg in argv):
+        os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+
+select_gl_platform(sys.argv[1:])
 
 import numpy as np
-import subprocess
-import glfw
+import argparse
+import ctypes
+import time
 import OpenGL.GL as gl
 from OpenGL.GL import *
-import sys
 import gi
 import math
 gi.require_version('Gst', '1.0')
 from gi.repository import Gst
 import matplotlib.pyplot as plt
-
-# source files for compute shaders
-first_pass_compute_shader = open("shaders/clahe_first_pass.glsl")
-first_pass_compute_shader_src = first_pass_compute_shader.read()
-
-second_pass_compute_shader = open("shaders/clahe_second_pass.glsl")
-second_pass_compute_shader_src = second_pass_compute_shader.read()
-
-third_pass_compute_shader = open("shaders/clahe_third_pass.glsl")
-third_pass_compute_shader_src = third_pass_compute_shader.read()
-
-
-# width and height of input frames
-w, h = 1280, 720
+from frame_batch import BatchProcessor
+from frame_ingest import AppsinkIngest, ArrayFrame, CopyStats, FrameMailbox
+from frame_sources import SOURCES, create_frame_source, synthetic_frames
+from frame_recording import FrameRecorder, FrameReplay, ReplayIngest
+from gl_context import HEADLESS_CONTEXTS, create_context
+from output_stream import OUTPUT_TARGETS, AppsrcOutput
+from latency_trace import LatencyTracer
+from multi_stream import StreamSet, stream_value
+from presentation import DEFAULT_PRESENT_MODE, PRESENT_FORMATS, PRESENT_MODES, PRESENT_OUTPUT_FORMATS, Presenter
+from frame_pacing import POLICIES, FrameScheduler
+from shader_build import (BIN_COUNTS, BIN_TEXTURE_FORMATS, CHANGE_METRICS, CHANGE_SHADER, CLAHE_SHADERS, DEFAULT_BIT_DEPTH,
+                          DEFAULT_CHANGE_METRIC, DEFAULT_CHANGE_THRESHOLD, DEFAULT_CLIP_LIMIT, DEFAULT_HISTOGRAM_COPIES,
+                          DEFAULT_HISTOGRAM_SAMPLING, DEFAULT_INTERPOLATION, DEFAULT_LUT_FORMAT, DEFAULT_OUTPUT_FORMAT,
+                          HISTOGRAM_SAMPLINGS, INTERPOLATIONS, LUT_FORMATS, LUT_TEXTURE_FORMATS, OUTPUT_FORMATS,
+                          OUTPUT_FRAME_FORMATS, OUTPUT_TEXTURE_FORMATS, ClaheGeometry, SCALED_LOCAL_SIZE,
+                          build_shader_source, change_defines, fit_histogram_copies, lut_defines, output_defines,
+                          sampling_defines, scaled_output_defines)
+from program_cache import DEFAULT_CACHE_DIR, ProgramCache
+from temporal_lut import DEFAULT_ALPHA, DEFAULT_CUT_DISTANCE, DEFAULT_CUT_FRACTION, TemporalSchedule
+from tile_changes import ChangeDetector
+
+# default width and height of input frames
+default_w, default_h = 1280, 720
 
 # width and height out output frames
 output_w, output_h = 1920, 1080
 
-#number of tiles for CLAHE. 
-# 39x39 is the maximum openGL work group size the Nano can support.
-numTilesX = math.ceil(w/39)
-numTilesY = math.ceil(h/39)
+# default CLAHE tile size.
+# 39x39 is the maximum openGL work group size the Nano can support, larger tiles
+# (or GPUs with smaller limits) make each invocation process several pixels.
+default_tile_size = 39
 
-def start_camera_stream():
-    # Start gstreamer pipeline to send frames to appsink
+# longest the render thread blocks waiting for a new frame (seconds).
+# keeps the window responsive when the camera stalls.
+FRAME_WAIT_TIMEOUT = 0.1
+
+# longest we wait on a single PBO fence before checking again (nanoseconds)
+PBO_FENCE_TIMEOUT = 100_000_000
+
+def start_camera_stream(source):
+    # Start gstreamer pipeline to send frames from the frame source to the appsink
     Gst.init(None)
-    
-    subprocess.run([f'v4l2-ctl', '-d', '/dev/video0','--set-fmt-video=width={w},height={h}'])
+
+    source.prepare()
 
     pipeline = Gst.Pipeline()
-    source = Gst.ElementFactory.make('v4l2src', 'camera')
-    source.set_property('device', '/dev/video0')
-    source.set_property('io-mode', 4)
+    elements = source.create_elements()
 
-    caps = Gst.Caps.from_string(f'video/x-raw, width={w}, height={h}, format=GRAY16_LE')
     caps_filter = Gst.ElementFactory.make('capsfilter', 'caps_filter')
-    caps_filter.set_property('caps', caps)
+    caps_filter.set_property('caps', source.caps())
 
+    # only ever hold the newest buffer, older ones are dropped instead of queued.
     sink = Gst.ElementFactory.make('appsink', 'sink')
     sink.set_property('emit-signals', True)
     sink.set_property('sync', False)
-    sink.set_property('drop', False)
+    sink.set_property('max-buffers', 1)
+    sink.set_property('drop', True)
 
-    pipeline.add(source)
-    pipeline.add(caps_filter)
-    pipeline.add(sink)
-
-    source.link(caps_filter)
-    caps_filter.link(sink)
+    elements += [caps_filter, sink]
+    for element in elements:
+        pipeline.add(element)
+    for upstream, downstream in zip(elements, elements[1:]):
+        if not upstream.link(downstream):
+            raise RuntimeError(f"could not link {upstream.get_name()} to {downstream.get_name()}")
 
     pipeline.set_state(Gst.State.PLAYING)
+    source.start(pipeline)
+
+    return pipeline, sink
+
+def start_ingest(args, w, h, mailbox, stream=0, taps=()):
+    # start feeding the mailbox with the frames of one stream, from a recording or a frame source.
+    # returns the ingest, and the gstreamer pipeline and frame source when there is one.
+    if args.replay:
+        # replay a recording straight out of its memory map into the mailbox.
+        path = stream_value(args.replay, stream)
+        replay = FrameReplay(path)
+        if (replay.width, replay.height) != (w, h):
+            raise SystemExit(f"{path} is {replay.width}x{replay.height}, the pipeline expects {w}x{h}")
+        ingest = ReplayIngest(replay, mailbox, args.replay_pacing)
+        ingest.start()
+        return ingest, None, None
 
-    return sink
+    # begin running gstreamer pipeline to send camera frame buffers to appsink.
+    # new samples are pushed into the mailbox from the streaming thread.
+    source_options = {
+        'v4l2': {'device': args.device[stream] if args.device else f'/dev/video{stream}'},
+        'testsrc': {'pattern': args.pattern, 'bit_depth': args.bit_depth},
+        'file': {'path': stream_value(args.file, stream) if args.file else None},
+        'numpy': {'frames': synthetic_frames(w, h, args.bit_depth, seed=stream)},
+    }[args.source]
+    source = create_frame_source(args.source, w, h, args.fps, **source_options)
+    pipeline, sink = start_camera_stream(source)
+    return AppsinkIngest(sink, mailbox, taps), pipeline, source
+
+def stop_ingest(ingest, pipeline, source):
+    if pipeline is not None:
+        source.stop()
+        pipeline.set_state(Gst.State.NULL)
+    else:
+        ingest.stop()
 
 def compile_shader(source, shader_type):
     shader = glCreateShader(shader_type)
@@ -88,12 +155,43 @@ def compile_shader(source, shader_type):
         raise RuntimeError(glGetShaderInfoLog(shader).decode())
     return shader
 
+def create_clahe_programs(geometry, cache, histogram_copies=DEFAULT_HISTOGRAM_COPIES, lut_format=DEFAULT_LUT_FORMAT,
+                          interpolation=DEFAULT_INTERPOLATION, temporal=False, dirty_tiles=False, output_size=None,
+                          output_format=DEFAULT_OUTPUT_FORMAT, histogram_sampling=DEFAULT_HISTOGRAM_SAMPLING,
+                          frame_array=False):
+    # build the three CLAHE passes with the frame and tile geometry injected as #defines,
+    # loading the linked programs from the program cache when they are in it.
+    max_invocations = glGetIntegerv(GL_MAX_COMPUTE_WORK_GROUP_INVOCATIONS)
+    max_shared_bytes = glGetIntegerv(GL_MAX_COMPUTE_SHARED_MEMORY_SIZE)
+    defines = geometry.defines(max_invocations)
+    defines['HISTOGRAM_COPIES'] = fit_histogram_copies(histogram_copies, geometry.num_bins, max_shared_bytes)
+    defines.update(lut_defines(lut_format, interpolation))
+    defines['TEMPORAL'] = temporal
+    defines['DIRTY_TILES'] = dirty_tiles
+    defines['FRAME_ARRAY'] = frame_array
+    defines.update(scaled_output_defines(geometry, output_size))
+    defines.update(output_defines(output_format))
+    defines.update(sampling_defines(histogram_sampling))
+    return [cache.program(build_shader_source(name, defines), defines, create_compute_program)
+            for name in CLAHE_SHADERS]
+
+def create_change_program(geometry, cache, change_metric=DEFAULT_CHANGE_METRIC):
+    # build the tile change detector that runs ahead of the passes with --dirty-tiles
+    defines = geometry.defines(glGetIntegerv(GL_MAX_COMPUTE_WORK_GROUP_INVOCATIONS))
+    defines.update(change_defines(change_metric))
+    return cache.program(build_shader_source(CHANGE_SHADER, defines), defines, create_compute_program)
+
+def uniform_locations(program, *names):
+    return {name: glGetUniformLocation(program, name) for name in names}
+
 def create_compute_program(compute_shader_src):
     #compile and link compute shader to program 
 
     compute_shader = compile_shader(compute_shader_src, GL_COMPUTE_SHADER)
     program = glCreateProgram()
     glAttachShader(program, compute_shader)
+    # keep the linked binary around so it can be saved to the program cache
+    glProgramParameteri(program, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
     glLinkProgram(program)
 
     if glGetProgramiv(program, GL_LINK_STATUS) != GL_TRUE:
@@ -102,7 +200,7 @@ def create_compute_program(compute_shader_src):
     glDeleteShader(compute_shader)
     return program
 
-#Create image buffer that will contain the input image until it is scaled to fullscreen. 
+#Create image buffer that will contain the equalized image until it is scaled to fullscreen. 
 def create_texture(w,h):
     texture_id = glGenTextures(1)
 
@@ -122,62 +220,432 @@ def create_texture(w,h):
 
     return texture_id
 
-# create the image buffer that will contain the final scaled image to render to screen.
-def create_framebuffer(output_width, output_height):
+# Create an unsigned integer image for the compute passes (raw input samples, bins).
+# Integer textures can not be filtered, they are only ever accessed with imageLoad/imageStore.
+def create_image_texture(w, h, internal_format):
+    image_texture = glGenTextures(1)
+    glBindTexture(GL_TEXTURE_2D, image_texture)
+    glTexStorage2D(GL_TEXTURE_2D, 1, internal_format, w, h)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+    glBindTexture(GL_TEXTURE_2D, 0)
+    return image_texture
+
+# Create the 3D texture the per-tile LUTs are kept in for hardware interpolation.
+# x and y are the tile, z is the bin. GL_LINEAR blends neighboring tiles, the third pass
+# always samples on a bin's texel center so bins are never blended.
+def create_lut_texture(geometry, lut_format):
+    lut_texture = glGenTextures(1)
+    glBindTexture(GL_TEXTURE_3D, lut_texture)
+    glTexStorage3D(GL_TEXTURE_3D, 1, LUT_TEXTURE_FORMATS[lut_format],
+                   geometry.num_tiles_x, geometry.num_tiles_y, geometry.num_bins)
+    glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+    glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+    glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+    glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+    glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_WRAP_R, GL_CLAMP_TO_EDGE)
+    glBindTexture(GL_TEXTURE_3D, 0)
+    return lut_texture
+
+# create the texture that will contain the final scaled image to render to screen.
+# the fused third pass (--fused-scale) writes it directly as an image.
+def create_scaled_texture(output_width, output_height, internal_format=GL_R16):
     framebuffer_texture = glGenTextures(1)
     glBindTexture(GL_TEXTURE_2D, framebuffer_texture)
 
-    glTexImage2D(GL_TEXTURE_2D, 0, GL_R16, output_width, output_height, 0, GL_RED, GL_UNSIGNED_SHORT, None)
+    glTexImage2D(GL_TEXTURE_2D, 0, internal_format, output_width, output_height, 0, GL_RED, GL_UNSIGNED_SHORT, None)
     glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
     glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
 
-    framebuffer = glGenFramebuffers(1)
-    glBindFramebuffer(GL_FRAMEBUFFER, framebuffer)
-    glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, framebuffer_texture, 0)
-
     glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_SWIZZLE_R, GL_RED)
     glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_SWIZZLE_G, GL_RED)
     glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_SWIZZLE_B, GL_RED)
 
-    glBindFramebuffer(GL_FRAMEBUFFER, 0)
-    return framebuffer, framebuffer_texture
+    glBindTexture(GL_TEXTURE_2D, 0)
+    return framebuffer_texture
 
+# upload a mapped frame to the input texture.
+# frame.ptr points straight at the Gst.Buffer memory, so the driver reads the camera
+# frame in place instead of from a Python copy of it. The input texture is GL_R16UI,
+# so the samples arrive as integers (GL_RED_INTEGER) without a round trip through float.
+def upload_frame(texture_id, frame, w, h):
+    if frame.size < w * h * 2:
+        raise RuntimeError(f"frame is {frame.size} bytes, expected {w * h * 2}")
 
-def main():
-    #np.set_printoptions(threshold=sys.maxsize) # for printing full data when debugging
+    glBindTexture(GL_TEXTURE_2D, texture_id)
+    glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, w, h, GL_RED_INTEGER, GL_UNSIGNED_SHORT, frame.ptr)
+
+# N-deep ring of pixel unpack buffers for asynchronous texture upload.
+# All slots live in one buffer object allocated with glBufferStorage and mapped once,
+# persistently and coherently, so uploading a frame is a memmove into the mapping followed
+# by a glTexSubImage2D that sources from the PBO and returns without waiting for the copy.
+# While the driver transfers slot N to the texture, frame N+1 is written into slot N+1.
+# Each slot is guarded by a fence so we never overwrite memory the GPU is still reading.
+class PBOUploadRing:
+    def __init__(self, depth, width, height):
+        self.depth = depth
+        self.width = width
+        self.height = height
+        self.frame_size = width * height * 2
+        self.index = 0
+        self.fences = [None] * depth
+
+        # number of uploads that had to wait for the GPU to release a slot.
+        # if this keeps climbing the ring is too shallow for the frame rate.
+        self.stalls = 0
+
+        flags = GL_MAP_WRITE_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT
+        self.pbo = glGenBuffers(1)
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, self.pbo)
+        glBufferStorage(GL_PIXEL_UNPACK_BUFFER, depth * self.frame_size, None, flags)
+        self.ptr = ctypes.c_void_p(glMapBufferRange(GL_PIXEL_UNPACK_BUFFER, 0, depth * self.frame_size, flags)).value
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        if not self.ptr:
+            raise RuntimeError("failed to persistently map the PBO upload ring")
+
+    def _wait_for_slot(self, index):
+        fence = self.fences[index]
+        if fence is None:
+            return
+
+        if glClientWaitSync(fence, 0, 0) == GL_TIMEOUT_EXPIRED:
+            self.stalls += 1
+            while glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, PBO_FENCE_TIMEOUT) == GL_TIMEOUT_EXPIRED:
+                pass
+        glDeleteSync(fence)
+        self.fences[index] = None
+
+    def upload(self, texture_id, frame):
+        if frame.size < self.frame_size:
+            raise RuntimeError(f"frame is {frame.size} bytes, expected {self.frame_size}")
+
+        self._wait_for_slot(self.index)
+        offset = self.index * self.frame_size
+
+        # the mapping is coherent, so the write is visible to the GPU without a flush
+        ctypes.memmove(self.ptr + offset, frame.ptr, self.frame_size)
+
+        # with a PBO bound, the last argument is an offset into the PBO, not a pointer
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, self.pbo)
+        glBindTexture(GL_TEXTURE_2D, texture_id)
+        glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, self.width, self.height, GL_RED_INTEGER, GL_UNSIGNED_SHORT, ctypes.c_void_p(offset))
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+
+        self.fences[self.index] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self.index = (self.index + 1) % self.depth
+
+    def close(self):
+        for i in range(self.depth):
+            self._wait_for_slot(i)
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, self.pbo)
+        glUnmapBuffer(GL_PIXEL_UNPACK_BUFFER)
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        glDeleteBuffers(1, [self.pbo])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="GPU accelerated CLAHE pipeline")
+    parser.add_argument('--width', type=int, default=default_w, help="input frame width.")
+    parser.add_argument('--height', type=int, default=default_h, help="input frame height.")
+    parser.add_argument('--tile-width', type=int, default=default_tile_size, help="CLAHE tile width.")
+    parser.add_argument('--tile-height', type=int, default=default_tile_size, help="CLAHE tile height.")
+    parser.add_argument('--bins', type=int, choices=BIN_COUNTS, default=BIN_COUNTS[0],
+                        help="histogram bins per tile.")
+    parser.add_argument('--bit-depth', type=int, default=DEFAULT_BIT_DEPTH,
+                        help="significant bits of the input samples.")
+    parser.add_argument('--clip-limit', type=int, default=DEFAULT_CLIP_LIMIT,
+                        help="histogram clip limit in pixels per bin at 256 bins, scaled for other bin counts.")
+    parser.add_argument('--histogram-copies', type=int, default=DEFAULT_HISTOGRAM_COPIES,
+                        help="shared memory sub-histograms per tile in the first pass, 0 (default) for global atomics.")
+    parser.add_argument('--histogram-stride', type=int, default=1, metavar='S',
+                        help="estimate the histograms from one pixel in every SxS cell of a tile (1 counts every pixel).")
+    parser.add_argument('--histogram-sampling', choices=HISTOGRAM_SAMPLINGS, default=DEFAULT_HISTOGRAM_SAMPLING,
+                        help="sample the center of each cell (regular) or a hashed pixel of it (jittered).")
+    parser.add_argument('--lut-format', choices=list(LUT_FORMATS), default=DEFAULT_LUT_FORMAT,
+                        help="storage format of the per-tile equalization LUTs. half is no smaller than uint16 and "
+                             "loses precision: up to 16 16-bit output steps off float (32 with --interpolation texture).")
+    parser.add_argument('--interpolation', choices=INTERPOLATIONS, default=DEFAULT_INTERPOLATION,
+                        help="blend the tile LUTs in the shader (alu) or with GL_LINEAR texture filtering (texture).")
+    parser.add_argument('--temporal', action='store_true',
+                        help="blend each tile cdf into the previous one and recompute histograms less often.")
+    parser.add_argument('--temporal-alpha', type=float, default=DEFAULT_ALPHA,
+                        help="weight of the new cdf in the temporal blend, 1 turns smoothing off.")
+    parser.add_argument('--histogram-interval', type=int, default=1, metavar='N',
+                        help="temporal mode: recompute the histograms every N frames.")
+    parser.add_argument('--histogram-rows', type=int, default=0, metavar='R',
+                        help="temporal mode: recompute R tile rows per frame, rotating down the image.")
+    parser.add_argument('--scene-cut-distance', type=float, default=DEFAULT_CUT_DISTANCE,
+                        help="temporal mode: mean cdf difference above which a tile counts as changed.")
+    parser.add_argument('--scene-cut-fraction', type=float, default=DEFAULT_CUT_FRACTION,
+                        help="temporal mode: fraction of changed tiles that forces a full refresh.")
+    parser.add_argument('--dirty-tiles', action='store_true',
+                        help="only recompute the histograms and LUTs of tiles that changed since the last frame.")
+    parser.add_argument('--change-metric', choices=CHANGE_METRICS, default=DEFAULT_CHANGE_METRIC,
+                        help="dirty tiles: mean (sad) or largest (max) absolute difference to the previous frame.")
+    parser.add_argument('--change-threshold', type=float, default=DEFAULT_CHANGE_THRESHOLD,
+                        help="dirty tiles: change in input sample steps above which a tile is recomputed.")
+    parser.add_argument('--fused-scale', action='store_true',
+                        help="have the third pass write the 1080p output directly, without the scaling draw.")
+    parser.add_argument('--present', choices=PRESENT_MODES, default=DEFAULT_PRESENT_MODE,
+                        help="draw the frame to the screen with a fullscreen triangle, or blit it (rgba16 output).")
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS,
+                        help="image format of the equalized output (default r16, rgba16 with --present blit). "
+                             "8-bit formats halve the bytes scaled, presented and read back.")
+    parser.add_argument('--program-cache', metavar='DIR', default=DEFAULT_CACHE_DIR,
+                        help="directory of the compiled program cache.")
+    parser.add_argument('--no-program-cache', action='store_true',
+                        help="always compile the shaders from source.")
+    parser.add_argument('--source', choices=sorted(SOURCES), default='v4l2',
+                        help="where frames come from. everything but v4l2 runs without a camera.")
+    parser.add_argument('--streams', type=int, default=1, metavar='N',
+                        help="equalize N camera streams together and present them as a tiled composite.")
+    parser.add_argument('--device', nargs='+', metavar='DEVICE',
+                        help="v4l2 device for --source v4l2, one per stream (default /dev/video0, 1, ...)")
+    parser.add_argument('--file', nargs='+', metavar='PATH', help="raw GRAY16_LE dump for --source file, one per stream")
+    parser.add_argument('--pattern', default='snow', help="videotestsrc pattern for --source testsrc")
+    parser.add_argument('--fps', type=int, default=0,
+                        help="frame rate of the source. 0 runs synthetic sources as fast as possible.")
+    parser.add_argument('--record', metavar='PATH', help="record the incoming frames to a raw recording.")
+    parser.add_argument('--replay', nargs='+', metavar='PATH',
+                        help="replay a recording instead of running a frame source, one per stream.")
+    parser.add_argument('--replay-pacing', choices=['original', 'fast'], default='original',
+                        help="replay at the recorded frame timing, or as fast as frames are processed.")
+    parser.add_argument('--output', choices=OUTPUT_TARGETS,
+                        help="also push the processed frames into a gstreamer output pipeline.")
+    parser.add_argument('--output-location', metavar='PATH',
+                        help="output file (file, x264) or socket path (shm).")
+    parser.add_argument('--batch', type=int, default=0, metavar='K',
+                        help="offline: equalize every frame of the --replay recording, K frames per dispatch, "
+                             "into a recording at --output-location (default clahe_batch.raw). Runs headless.")
+    parser.add_argument('--headless', nargs='?', const='egl', choices=sorted(HEADLESS_CONTEXTS),
+                        help="run without a window, rendering into an offscreen framebuffer (default backend: egl).")
+    parser.add_argument('--frames', type=int, default=0,
+                        help="stop after this many frames. 0 runs until the window is closed or the stream ends.")
+    parser.add_argument('--trace', action='store_true',
+                        help="trace per-frame latency through every stage and report p50/p95/p99 on exit.")
+    parser.add_argument('--pbo-depth', type=int, default=3,
+                        help="number of PBOs in the upload ring. 0 uploads straight from the mapped appsink buffer.")
+    parser.add_argument('--mailbox-depth', type=int,
+                        help="frames buffered between the capture thread and the render thread "
+                             "(default 1 for the latency policy, 4 for throughput).")
+    parser.add_argument('--policy', choices=POLICIES, default='latency',
+                        help="frame pacing: latency-first (vsync, late latch of the newest frame) "
+                             "or throughput-first (no vsync, frames in order).")
+    parser.add_argument('--swap-interval', type=int, help="override the swap interval picked by the policy.")
+    parser.add_argument('--max-frame-age', type=float, default=100.0, metavar='MS',
+                        help="throughput policy: skip live frames captured longer ago than this while newer ones are waiting.")
+    args = parser.parse_args(argv)
+    if args.record and args.replay:
+        parser.error("--record tees the frames of a live source, --replay already plays a recording")
+    return args
+
+
+def run_batch(args, geometry, programs, output_format):
+    # offline: equalize a recording into a new one, args.batch frames per dispatch.
+    # the frames go to the GPU straight out of the recording's memory map.
+    replay = FrameReplay(args.replay[0])
+    if (replay.width, replay.height) != (geometry.width, geometry.height):
+        raise SystemExit(f"{args.replay[0]} is {replay.width}x{replay.height}, "
+                         f"the pipeline expects {geometry.width}x{geometry.height}")
+    frame_count = min(len(replay), args.frames) if args.frames else len(replay)
+    location = args.output_location or 'clahe_batch.raw'
+
+    batch = BatchProcessor(geometry, programs, args.batch, args.lut_format, output_format)
+    batch.bind()
+    recorder = FrameRecorder(location, geometry.width, geometry.height, batch.frame_format)
+    start_time = time.monotonic()
+    for first in range(0, frame_count, args.batch):
+        output = batch.process(replay.frames[first:min(first + args.batch, frame_count)])
+        # the writer thread takes the frames from here, keeping their recorded timestamps
+        for i, frame in enumerate(output, first):
+            written = ArrayFrame(frame, i, int(replay.pts[i]) if replay.pts[i] >= 0 else None)
+            written.received_ns = int(replay.received_ns[i])
+            recorder.write(written)
+    recorder.close()
+    elapsed = time.monotonic() - start_time
+
+    print(f"processed {frame_count} frames in {elapsed:.2f}s ({frame_count / elapsed:.1f} fps)")
+    print(batch.report())
+    print(recorder.report())
+    batch.close()
+
+def run_streams(args, context, geometry, programs, mailbox_depth, output_format):
+    # equalize args.streams camera streams together and present them as a tiled composite.
+    # every stream has its own ingest and mailbox, the first one paces the composite.
+    w, h = geometry.width, geometry.height
+    mailboxes = [FrameMailbox(mailbox_depth) for _ in range(args.streams)]
+    ingests = [start_ingest(args, w, h, mailbox, stream) for stream, mailbox in enumerate(mailboxes)]
+
+    streams = StreamSet(geometry, programs, mailboxes, args.lut_format, output_format)
+    streams.bind()
+    presenter = Presenter(context, streams.output_texture, (w, h), (output_w, output_h), flip=True,
+                          mode=args.present, streams=args.streams)
+    copy_stats = CopyStats()
+    tracer = LatencyTracer(args.trace)
+    scheduler = FrameScheduler(context, mailboxes[0], args.policy, args.swap_interval, args.max_frame_age)
+
+    frames_processed = 0
+    start_time = None
+
+    while not context.should_close():
+        if args.frames and frames_processed >= args.frames:
+            break
+
+        lead = scheduler.next_frame(FRAME_WAIT_TIMEOUT)
+        if lead is None:
+            if mailboxes[0].closed:
+                break  # end of the first stream
+            context.poll_events()
+            continue
 
-    #initialize GLFW
-    if not glfw.init():
-        print("Failed to initialize GLFW")
-        sys.exit(1)
+        if start_time is None:
+            start_time = time.monotonic()
+        trace = tracer.begin(lead)
+
+        streams.upload(lead, copy_stats)
+        trace.gpu('upload')
+        streams.dispatch()
+        trace.gpu('third_pass')
+        presenter.present()
+        trace.gpu('scale')
+
+        scheduler.present()
+        trace.mark('present')
+        tracer.end(trace)
+        context.poll_events()
+        frames_processed += 1
+
+    glFinish()
+    if start_time is not None:
+        elapsed = time.monotonic() - start_time
+        print(f"processed {frames_processed} composite frames of {args.streams} streams in {elapsed:.2f}s "
+              f"({frames_processed / elapsed:.1f} fps)")
+
+    for ingest, pipeline, source in ingests:
+        stop_ingest(ingest, pipeline, source)
+        print(ingest.report())
+    print(scheduler.report())
+    if args.trace:
+        print(tracer.report())
+    print(copy_stats.report())
+    print(streams.report())
+    print(presenter.report())
+    presenter.close()
+    streams.close()
+
+def main(args):
+    #np.set_printoptions(threshold=sys.maxsize) # for printing full data when debugging
 
-    window = glfw.create_window(output_w, output_h, "pipeline test", None, None)
-    if not window:
-        glfw.terminate()
-        print("Failed to create GLFW window")
+    # open a window, or a headless context with an offscreen framebuffer standing in
+    # for the window. everything below runs the same either way.
+    try:
+        context = create_context(output_w, output_h, "pipeline test", args.headless or ('egl' if args.batch else None))
+    except RuntimeError as e:
+        print(e)
         sys.exit(1)
 
-    # Set context for OpenG
-    glfw.make_context_current(window)
-
-    texture_id = create_texture(w,h)
+    if args.dirty_tiles and args.temporal:
+        raise SystemExit("--dirty-tiles and --temporal both pick the tiles to recompute, use one of them")
+    if args.fused_scale and args.output:
+        raise SystemExit("--fused-scale never writes the frame at input size, which --output reads back")
+    if args.batch:
+        if not args.replay:
+            raise SystemExit("--batch equalizes a recording, pass it with --replay")
+        if args.temporal or args.dirty_tiles or args.fused_scale or args.output or args.record:
+            raise SystemExit("--batch equalizes every frame on its own into a recording, "
+                             "without --temporal, --dirty-tiles, --fused-scale, --output or --record")
+        if args.interpolation == 'texture':
+            raise SystemExit("--batch keeps the LUTs of all its frames in the LUT buffer, use --interpolation alu")
+    if args.replay and args.replay_pacing == 'fast' and args.policy == 'latency' and (args.mailbox_depth or 1) > 1:
+        raise SystemExit("--replay-pacing fast processes every frame, the latency policy would drop all but the "
+                         "newest of a --mailbox-depth above 1")
+    if args.output_format and args.output_format not in PRESENT_FORMATS[args.present]:
+        raise SystemExit(f"--present {args.present} draws {' or '.join(PRESENT_FORMATS[args.present])} outputs, "
+                         f"not {args.output_format}")
+    if args.streams < 1:
+        raise SystemExit("--streams needs at least 1 stream")
+    for option, values in (('--device', args.device), ('--file', args.file), ('--replay', args.replay)):
+        if values and len(values) > max(args.streams, 1):
+            raise SystemExit(f"{len(values)} {option} values for {args.streams} streams")
+    if args.source == 'v4l2' and not args.replay and args.device and len(args.device) < args.streams:
+        raise SystemExit(f"--streams {args.streams} needs a --device for every stream")
+    if args.streams > 1:
+        if args.batch or args.temporal or args.dirty_tiles or args.fused_scale or args.output or args.record:
+            raise SystemExit("--streams equalizes every stream on its own into a composite, "
+                             "without --batch, --temporal, --dirty-tiles, --fused-scale, --output or --record")
+        if args.interpolation == 'texture':
+            raise SystemExit("--streams keeps the LUTs of all streams in the LUT buffer, use --interpolation alu")
+        if args.present != 'triangle':
+            raise SystemExit("--streams draws its composite with --present triangle")
+
+    # frame and tile layout. the shaders are built for it, nothing is hard-coded in them.
+    geometry = ClaheGeometry(args.width, args.height, args.tile_width, args.tile_height,
+                             args.bins, args.bit_depth, args.clip_limit, args.histogram_stride)
+    w, h = geometry.width, geometry.height
+    numTilesX, numTilesY = geometry.num_tiles_x, geometry.num_tiles_y
+    print(f"clahe geometry: {geometry}")
+
+    # glBlitFramebuffer copies channels as they are, it needs the intensity in all of them
+    output_format = args.output_format or PRESENT_OUTPUT_FORMATS[args.present]
+    output_texture_format = OUTPUT_TEXTURE_FORMATS[output_format]
 
     # compile glsl compute shader programs 
-    first_pass_compute_program = create_compute_program(first_pass_compute_shader_src)
-    second_pass_compute_program = create_compute_program(second_pass_compute_shader_src)
-    third_pass_compute_program = create_compute_program(third_pass_compute_shader_src)
-
-    # begin running gstreamer pipeline to send camera frame buffers to appsink.
-    sink = start_camera_stream()
-
-    # bind texture object at texture_id to the GL_TEXTURE_2D target. 
-    # (future operations on GL_TEXTURE_2D will affect this texture in memory.)
-    glBindTexture(GL_TEXTURE_2D, texture_id)
-    glTexImage2D(GL_TEXTURE_2D, 0, GL_R16, w, h, 0, GL_RED, GL_UNSIGNED_SHORT, None)
-    glBindImageTexture(0, texture_id, 0, GL_FALSE, 0, GL_READ_WRITE, GL_R16)
-
-    # create the buffer that will contain the output image
-    framebuffer, framebuffer_texture = create_framebuffer(output_w, output_h)
+    program_cache = ProgramCache(args.program_cache, enabled=not args.no_program_cache)
+    first_pass_compute_program, second_pass_compute_program, third_pass_compute_program = \
+        create_clahe_programs(geometry, program_cache, args.histogram_copies, args.lut_format, args.interpolation,
+                              args.temporal, args.dirty_tiles, (output_w, output_h) if args.fused_scale else None,
+                              output_format, args.histogram_sampling, args.batch > 0 or args.streams > 1)
+    if args.dirty_tiles:
+        change_program = create_change_program(geometry, program_cache, args.change_metric)
+    print(program_cache.report())
+
+    if args.batch:
+        run_batch(args, geometry, [first_pass_compute_program, second_pass_compute_program,
+                                   third_pass_compute_program], output_format)
+        context.terminate()
+        return
+
+    mailbox_depth = args.mailbox_depth or (1 if args.policy == 'latency' else 4)
+    if args.streams > 1:
+        run_streams(args, context, geometry, [first_pass_compute_program, second_pass_compute_program,
+                                              third_pass_compute_program], mailbox_depth, output_format)
+        context.terminate()
+        return
+
+    mailbox = FrameMailbox(mailbox_depth)
+    recorder = None
+
+    if args.record:
+        recorder = FrameRecorder(args.record, w, h)
+    ingest, pipeline, source = start_ingest(args, w, h, mailbox, taps=[recorder.tee] if recorder else [])
+
+    input_texture = create_image_texture(w, h, GL_R16UI)
+    glBindImageTexture(0, input_texture, 0, GL_FALSE, 0, GL_READ_ONLY, GL_R16UI)
+    # with subsampled histograms the third pass bins every pixel itself
+    if geometry.histogram_stride == 1:
+        bin_format = BIN_TEXTURE_FORMATS[geometry.bin_image_format]
+        bin_texture = create_image_texture(w, h, bin_format)
+        glBindImageTexture(3, bin_texture, 0, GL_FALSE, 0, GL_READ_WRITE, bin_format)
+
+    # create the buffer that will contain the output image, and the stage that draws it to the
+    # screen with all of its state set up once. the equalized frame is scaled to the screen by
+    # the draw itself, flipped as it is stored top row first. the fused third pass writes the
+    # scaled texture itself, bottom up, without the frame sized output.
+    if args.fused_scale:
+        framebuffer_texture = create_scaled_texture(output_w, output_h, output_texture_format)
+        glBindImageTexture(4, framebuffer_texture, 0, GL_FALSE, 0, GL_WRITE_ONLY, output_texture_format)
+        presenter = Presenter(context, framebuffer_texture, (output_w, output_h), (output_w, output_h),
+                              flip=False, mode=args.present)
+    else:
+        # bind texture object at texture_id to the GL_TEXTURE_2D target. 
+        # (future operations on GL_TEXTURE_2D will affect this texture in memory.)
+        # texture_id only receives the equalized output of the third pass, the raw samples and
+        # the bins each get their own integer image, so no pass reads and writes the same image.
+        texture_id = create_texture(w,h)
+        glBindTexture(GL_TEXTURE_2D, texture_id)
+        glTexImage2D(GL_TEXTURE_2D, 0, output_texture_format, w, h, 0, GL_RED, GL_UNSIGNED_SHORT, None)
+        glBindImageTexture(4, texture_id, 0, GL_FALSE, 0, GL_WRITE_ONLY, output_texture_format)
+        presenter = Presenter(context, texture_id, (w, h), (output_w, output_h), flip=True, mode=args.present)
 
     # Create and allocate a shader storage buffer to persistently store histograms
     # and cdf functions for each tile of frame.
@@ -185,50 +653,160 @@ def main():
     glBindBuffer(GL_SHADER_STORAGE_BUFFER, histogramBuffer)
 
     # calculate total buffer size
-    numBins = 256
-    numTiles = numTilesX * numTilesY
-    totalBufferSize = numBins * numTiles * np.dtype(np.uint32).itemsize
+    numBins = geometry.num_bins
+    totalBufferSize = geometry.histogram_buffer_size
 
     # Allocate memory for histograms buffer
     glBufferData(GL_SHADER_STORAGE_BUFFER, totalBufferSize, None, GL_DYNAMIC_COPY)
 
-    while not glfw.window_should_close(window):
-        # recieve input image buffer from appsink
-        sample = sink.emit('pull-sample')
-        if sample is None:
+    # normalized equalization LUTs, written by the second pass and read by the third
+    if args.interpolation == 'texture':
+        if geometry.num_bins > glGetIntegerv(GL_MAX_3D_TEXTURE_SIZE):
+            raise SystemExit(f"{geometry.num_bins} bins do not fit in a 3D texture on this GPU, use --interpolation alu")
+        lut_texture = create_lut_texture(geometry, args.lut_format)
+        glBindImageTexture(1, lut_texture, 0, GL_TRUE, 0, GL_WRITE_ONLY, LUT_TEXTURE_FORMATS[args.lut_format])
+        glActiveTexture(GL_TEXTURE1)
+        glBindTexture(GL_TEXTURE_3D, lut_texture)
+        glActiveTexture(GL_TEXTURE0)
+    else:
+        lutBuffer = glGenBuffers(1)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, lutBuffer)
+        glBufferData(GL_SHADER_STORAGE_BUFFER, geometry.lut_buffer_size(args.lut_format), None, GL_DYNAMIC_COPY)
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 2, lutBuffer)
+
+    # temporal mode: smoothed cdfs, amortized histogram updates and scene cut detection
+    temporal = None
+    if args.temporal:
+        temporal = TemporalSchedule(geometry, args.temporal_alpha, args.histogram_interval, args.histogram_rows,
+                                    args.scene_cut_distance, args.scene_cut_fraction)
+        temporal.bind()
+        first_pass_uniforms = uniform_locations(first_pass_compute_program, 'firstTileRow')
+        second_pass_uniforms = uniform_locations(second_pass_compute_program, 'firstTileRow', 'temporalAlpha',
+                                                 'sceneCutDistance', 'sceneSlot')
+        third_pass_uniforms = uniform_locations(third_pass_compute_program, 'firstTileRow', 'tileRowCount')
+        glProgramUniform1f(second_pass_compute_program, second_pass_uniforms['sceneCutDistance'], temporal.cut_distance)
+
+    # dirty tiles: the first two passes only run on the tiles that changed since the last frame
+    changes = None
+    if args.dirty_tiles:
+        changes = ChangeDetector(geometry, change_program, args.change_threshold)
+        changes.bind()
+
+    # counts bytes copied into python objects by the ingest path (should stay 0)
+    copy_stats = CopyStats()
+
+    # asynchronous upload ring. frames are staged into persistently mapped PBOs so the
+    # texture upload does not block the render thread.
+    upload_ring = None
+    if args.pbo_depth > 0:
+        upload_ring = PBOUploadRing(args.pbo_depth, w, h)
+
+    # optional output branch, reads the processed frames back and feeds them to appsrc
+    output = None
+    if args.output:
+        default_locations = {'file': 'clahe_output.raw', 'x264': 'clahe_output.mkv', 'shm': '/tmp/clahe_output'}
+        output = AppsrcOutput(args.output, args.output_location or default_locations[args.output],
+                              w, h, args.fps, OUTPUT_FRAME_FORMATS[output_format])
+
+    # per-frame latency tracing, no-op unless --trace is passed
+    tracer = LatencyTracer(args.trace)
+
+    # decides which frame to render next and when, and presents it
+    scheduler = FrameScheduler(context, mailbox, args.policy, args.swap_interval, args.max_frame_age)
+
+    frames_processed = 0
+    start_time = None
+
+    while not context.should_close():
+        if args.frames and frames_processed >= args.frames:
+            break
+
+        # take the next frame from the capture thread, as picked by the pacing policy.
+        # blocks with a timeout instead of spinning when no frame is ready.
+        latest = scheduler.next_frame(FRAME_WAIT_TIMEOUT)
+        if latest is None:
+            if mailbox.closed:
+                break  # end of stream
+            context.poll_events()
             continue
 
-        buffer = sample.get_buffer()
-        info = buffer.extract_dup(0, buffer.get_size())
-
-        # Update image buffer with new data
-        glBindTexture(GL_TEXTURE_2D, texture_id)
-        glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, w, h, GL_RED, GL_UNSIGNED_SHORT, info)
-
-        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 1, histogramBuffer)
-        # clean histograms buffer for each new input frame.
-        glClearBufferData(GL_SHADER_STORAGE_BUFFER, GL_R32UI, GL_RED_INTEGER, GL_UNSIGNED_INT, None)
-
-        # Dispatch the compute_shaders:
-        # First pass: compute histograms for each tile. 
-        # (each dispatch deploys a workgroup of 1521 threads to process each image tile)
-        glUseProgram(first_pass_compute_program)
-        glDispatchCompute(numTilesX, numTilesY, 1)
-        # ensure that all threads are done writing to the buffer before moving on.
-        glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT)
-        
-        # Second pass: apply clip limiting and compute cdf on each histogram.
-        # (each dispatch deploys a workgroup of 256 threads to process each tile's histogram).
-        glUseProgram(second_pass_compute_program)
-        glDispatchCompute(numTilesX, numTilesY, 1)
-        glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT)
+        if start_time is None:
+            start_time = time.monotonic()
+        trace = tracer.begin(latest)
+
+        # Update image buffer with new data.
+        # The buffer is only mapped for the duration of the upload.
+        with latest.map(copy_stats) as frame:
+            if upload_ring is not None:
+                upload_ring.upload(input_texture, frame)
+            else:
+                upload_frame(input_texture, frame, w, h)
+        copy_stats.end_frame()
+        trace.gpu('upload')
+
+        # tile rows whose histograms are recomputed this frame (all of them unless in temporal mode)
+        firstTileRow, tileRowCount = 0, numTilesY
+        if temporal is not None:
+            firstTileRow, tileRowCount, alpha, slot = temporal.next_frame()
+            glProgramUniform1ui(first_pass_compute_program, first_pass_uniforms['firstTileRow'], firstTileRow)
+            glProgramUniform1ui(second_pass_compute_program, second_pass_uniforms['firstTileRow'], firstTileRow)
+            glProgramUniform1f(second_pass_compute_program, second_pass_uniforms['temporalAlpha'], alpha)
+            glProgramUniform1ui(second_pass_compute_program, second_pass_uniforms['sceneSlot'], slot)
+            glProgramUniform1ui(third_pass_compute_program, third_pass_uniforms['firstTileRow'], firstTileRow)
+            glProgramUniform1ui(third_pass_compute_program, third_pass_uniforms['tileRowCount'], tileRowCount)
+
+        if changes is not None:
+            changes.detect()
+
+        if tileRowCount:
+            # the first pass zeroes the histograms of the tiles it bins, the buffer is not cleared
+            glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 1, histogramBuffer)
+
+            # Dispatch the compute_shaders:
+            # First pass: compute histograms for each tile. 
+            # (each dispatch deploys a workgroup of 1521 threads to process each image tile)
+            glUseProgram(first_pass_compute_program)
+            if changes is not None:
+                changes.dispatch()
+            else:
+                glDispatchCompute(numTilesX, tileRowCount, 1)
+            trace.gpu('first_pass')
+            # ensure that all threads are done writing to the buffer (and the bin image) before moving on.
+            glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT | GL_SHADER_IMAGE_ACCESS_BARRIER_BIT)
+
+            # Second pass: apply clip limiting and compute cdf on each histogram, and turn it into
+            # the tile's normalized LUT.
+            # (each dispatch deploys a workgroup of 256 threads to process each tile's histogram).
+            glUseProgram(second_pass_compute_program)
+            if changes is not None:
+                changes.dispatch()
+            else:
+                glDispatchCompute(numTilesX, tileRowCount, 1)
+            trace.gpu('second_pass')
+            glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT | GL_TEXTURE_FETCH_BARRIER_BIT)
+        else:
+            # the LUTs of the last frame are reused as they are
+            trace.gpu('first_pass')
+            trace.gpu('second_pass')
   
-        # Third pass: compute equalized and interpolated pixel values, and write them back 
-        # to the image buffer.
+        # Third pass: compute equalized and interpolated pixel values from the LUTs, and write
+        # them to the output image.
         # (each dispatch deploys a workgroup of 1521 threads to process each image tile)
+        # Fused with the scaling, it runs a work group per block of output pixels instead.
         glUseProgram(third_pass_compute_program)
-        glDispatchCompute(numTilesX, numTilesY, 1)
-        glMemoryBarrier(GL_SHADER_IMAGE_ACCESS_BARRIER_BIT)
+        if args.fused_scale:
+            glDispatchCompute(math.ceil(output_w / SCALED_LOCAL_SIZE), math.ceil(output_h / SCALED_LOCAL_SIZE), 1)
+        else:
+            glDispatchCompute(numTilesX, numTilesY, 1)
+        trace.gpu('third_pass')
+        # the output is sampled by the scaling stage and read back by the output stream
+        glMemoryBarrier(GL_SHADER_IMAGE_ACCESS_BARRIER_BIT | GL_TEXTURE_FETCH_BARRIER_BIT | GL_TEXTURE_UPDATE_BARRIER_BIT)
+        if temporal is not None:
+            temporal.frame_done()
+
+        # queue the processed frame for the output pipeline
+        if output is not None:
+            output.submit(texture_id, latest.pts)
 
         ### Use this block to bring histogram buffer into cpu memory as a numpy object
         #histodata = np.zeros(totalBufferSize, dtype=np.uint8)
@@ -237,55 +815,54 @@ def main():
 
         ### use this block to plot histogram data after loading it into a numpy object
         #histodata = histodata.view(np.uint32)
-        #histodata = histodata.reshape((numTilesX*numTilesY, 256))
+        #histodata = histodata.reshape((numTilesX*numTilesY, numBins))
         #tile_index_to_plot = 0
-        #plt.bar(range(256), histodata[tile_index_to_plot])
+        #plt.bar(range(numBins), histodata[tile_index_to_plot])
         #plt.show()
 
-        # Bind the framebuffer for rendering the scaled image
-        glBindFramebuffer(GL_FRAMEBUFFER, framebuffer)
-        glViewport(0, 0, output_w, output_h)  # Match the target 1080p resolution
-
-        # Clear previous framebuffer content
-        glClear(GL_COLOR_BUFFER_BIT)
-
-        # Enable texturing and bind the source texture
-        glEnable(GL_TEXTURE_2D)
-        glBindTexture(GL_TEXTURE_2D, texture_id)
-
-        # Render the source texture onto a fullscreen quad
-        glBegin(GL_QUADS)
-        glTexCoord2f(0.0, 1.0); glVertex2f(-1.0, -1.0)
-        glTexCoord2f(1.0, 1.0); glVertex2f(1.0, -1.0)
-        glTexCoord2f(1.0, 0.0); glVertex2f(1.0, 1.0)
-        glTexCoord2f(0.0, 0.0); glVertex2f(-1.0, 1.0)
-        glEnd()
-
-        # reset the framebuffer for screen rendering
-        glBindFramebuffer(GL_FRAMEBUFFER, 0)
-
-        # Clear the window content
-        glClear(GL_COLOR_BUFFER_BIT)
-
-        # Bind the scaled framebuffer texture
-        glBindTexture(GL_TEXTURE_2D, framebuffer_texture)
-
-        # render the scaled texture onto the screen
-        # for some reason i have to horizontally and vertically flip the texture
-        glBegin(GL_QUADS)
-        glTexCoord2f(-1.0, -1.0); glVertex2f(-1.0, -1.0)
-        glTexCoord2f(0.0, -1.0); glVertex2f(1.0, -1.0)
-        glTexCoord2f(0.0, 0.0); glVertex2f(1.0, 1.0)
-        glTexCoord2f(-1.0, 0.0); glVertex2f(-1.0, 1.0)
-        glEnd()
-
+        # scale the output to the screen (the fused third pass has already scaled it)
+        presenter.present()
+        trace.gpu('scale')
 
         # render current buffer to the screen
-        glfw.swap_buffers(window)
-        glfw.poll_events()
-
-    glfw.terminate()
+        scheduler.present()
+        trace.mark('present')
+        tracer.end(trace)
+        context.poll_events()
+        frames_processed += 1
+
+    glFinish()
+    if start_time is not None:
+        elapsed = time.monotonic() - start_time
+        print(f"processed {frames_processed} frames in {elapsed:.2f}s ({frames_processed / elapsed:.1f} fps)")
+
+    stop_ingest(ingest, pipeline, source)
+    if recorder is not None:
+        recorder.close()
+        print(recorder.report())
+
+    if output is not None:
+        output.close()
+        print(output.report())
+
+    print(ingest.report())
+    print(scheduler.report())
+    if args.trace:
+        print(tracer.report())
+    print(copy_stats.report())
+    if temporal is not None:
+        print(temporal.report())
+        temporal.close()
+    if changes is not None:
+        print(changes.report())
+        changes.close()
+    print(presenter.report())
+    presenter.close()
+    if upload_ring is not None:
+        print(f"pbo upload ring: depth {upload_ring.depth}, {upload_ring.stalls} stalled uploads")
+        upload_ring.close()
+    context.terminate()
 
 
 if __name__ == "__main__":
-    main()
+    main(parse_args())
@@ -0,0 +1,170 @@
+# frame_batch.py
+# PROVUU
+#
+# Batched offline processing of recorded footage (--batch).
+#
+# The realtime pipeline runs the three passes once per frame, and pays the dispatches, barriers
+# and driver round trips of every pass for every frame. Offline nothing waits on a single frame,
+# so K frames go through the passes together:
+#
+#   * the K frames are uploaded with one glTexSubImage3D into the layers of a GL_TEXTURE_2D_ARRAY,
+#     straight out of the recording's memory map
+#   * the histogram and LUT buffers hold the tiles of all K frames, one frame after the other
+#   * each pass is a single (numTilesX, numTilesY, K) dispatch. The shaders are built with
+#     FRAME_ARRAY and take the frame's layer from gl_WorkGroupID.z
+#   * the K equalized frames are read back in bulk, one glGetTexImage of the whole output array
+#     into a pack buffer and one memmove out of its mapping
+#
+# A batch takes about 5 bytes of GPU memory per pixel per frame (input, bins, output), so K is a
+# trade between memory and the per frame overhead. An 8-bit output format is read back and
+# recorded as GRAY8 frames, half the bytes of GRAY16_LE. The last batch of a recording may be short,
+# its dispatches only cover the frames it has.
+
+import ctypes
+import time
+import numpy as np
+from OpenGL.GL import *
+from shader_build import (BIN_TEXTURE_FORMATS, DEFAULT_LUT_FORMAT, DEFAULT_OUTPUT_FORMAT, OUTPUT_FRAME_FORMATS,
+                          OUTPUT_TEXTURE_FORMATS, READBACK_TYPES)
+
+DEFAULT_BATCH_FRAMES = 8
+
+
+def create_array_texture(width, height, layers, internal_format, filter=GL_NEAREST):
+    texture = glGenTextures(1)
+    glBindTexture(GL_TEXTURE_2D_ARRAY, texture)
+    glTexStorage3D(GL_TEXTURE_2D_ARRAY, 1, internal_format, width, height, layers)
+    glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MIN_FILTER, filter)
+    glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MAG_FILTER, filter)
+    glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+    glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+    glBindTexture(GL_TEXTURE_2D_ARRAY, 0)
+    return texture
+
+
+def dispatch_frame_array(geometry, programs, layers):
+    # run the three passes over the first `layers` frames of the bound arrays, one dispatch
+    # and one barrier per pass for all of them. the first pass zeroes the histograms itself.
+    first_pass, second_pass, third_pass = programs
+    glUseProgram(first_pass)
+    glDispatchCompute(geometry.num_tiles_x, geometry.num_tiles_y, layers)
+    glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT | GL_SHADER_IMAGE_ACCESS_BARRIER_BIT)
+    glUseProgram(second_pass)
+    glDispatchCompute(geometry.num_tiles_x, geometry.num_tiles_y, layers)
+    glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT)
+    glUseProgram(third_pass)
+    glDispatchCompute(geometry.num_tiles_x, geometry.num_tiles_y, layers)
+
+
+class BatchProcessor:
+    def __init__(self, geometry, programs, batch_frames=DEFAULT_BATCH_FRAMES, lut_format=DEFAULT_LUT_FORMAT,
+                 output_format=DEFAULT_OUTPUT_FORMAT):
+        if batch_frames < 1:
+            raise ValueError(f"a batch needs at least 1 frame, not {batch_frames}")
+        max_layers = glGetIntegerv(GL_MAX_ARRAY_TEXTURE_LAYERS)
+        if batch_frames > max_layers:
+            raise ValueError(f"{batch_frames} frames do not fit in a texture array, this GPU takes {max_layers}")
+        self.geometry = geometry
+        self.programs = programs
+        self.batch_frames = batch_frames
+        self.lut_format = lut_format
+        self.output_format = output_format
+        self.frame_format = OUTPUT_FRAME_FORMATS[output_format]
+        self.output_texture_format = OUTPUT_TEXTURE_FORMATS[output_format]
+
+        # statistics
+        self.frames = 0
+        self.batches = 0
+        self.upload_ns = 0
+        self.compute_ns = 0
+        self.readback_ns = 0
+
+        self._create_buffers()
+
+    def _create_buffers(self):
+        geometry = self.geometry
+        w, h, k = geometry.width, geometry.height, self.batch_frames
+
+        self.input_texture = create_array_texture(w, h, k, GL_R16UI)
+        self.output_texture = create_array_texture(w, h, k, self.output_texture_format)
+        self.bin_texture = None
+        if geometry.histogram_stride == 1:
+            self.bin_format = BIN_TEXTURE_FORMATS[geometry.bin_image_format]
+            self.bin_texture = create_array_texture(w, h, k, self.bin_format)
+
+        self.histogram_buffer = glGenBuffers(1)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, self.histogram_buffer)
+        glBufferData(GL_SHADER_STORAGE_BUFFER, k * geometry.histogram_buffer_size, None, GL_DYNAMIC_COPY)
+        self.lut_buffer = glGenBuffers(1)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, self.lut_buffer)
+        glBufferData(GL_SHADER_STORAGE_BUFFER, k * geometry.lut_buffer_size(self.lut_format), None, GL_DYNAMIC_COPY)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+
+        # the whole output array is packed into this buffer, then copied out in one go
+        self.pack_buffer = glGenBuffers(1)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pack_buffer)
+        sample_bytes = np.dtype(READBACK_TYPES[self.frame_format][1]).itemsize
+        glBufferData(GL_PIXEL_PACK_BUFFER, k * w * h * sample_bytes, None, GL_STREAM_READ)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+    def bind(self):
+        # every layer of the arrays is bound, the shaders pick theirs from gl_WorkGroupID.z
+        glBindImageTexture(0, self.input_texture, 0, GL_TRUE, 0, GL_READ_ONLY, GL_R16UI)
+        if self.bin_texture is not None:
+            glBindImageTexture(3, self.bin_texture, 0, GL_TRUE, 0, GL_READ_WRITE, self.bin_format)
+        glBindImageTexture(4, self.output_texture, 0, GL_TRUE, 0, GL_WRITE_ONLY, self.output_texture_format)
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 1, self.histogram_buffer)
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 2, self.lut_buffer)
+
+    def process(self, frames):
+        # equalize a (count, height, width) uint16 block of frames, count up to batch_frames.
+        # returns the equalized frames as a new array of the same shape, uint8 for 8-bit outputs.
+        geometry = self.geometry
+        count = len(frames)
+        if not 1 <= count <= self.batch_frames:
+            raise ValueError(f"a batch holds 1 to {self.batch_frames} frames, not {count}")
+        start = time.perf_counter_ns()
+
+        glBindTexture(GL_TEXTURE_2D_ARRAY, self.input_texture)
+        glTexSubImage3D(GL_TEXTURE_2D_ARRAY, 0, 0, 0, 0, geometry.width, geometry.height, count,
+                        GL_RED_INTEGER, GL_UNSIGNED_SHORT, np.ascontiguousarray(frames))
+        glBindTexture(GL_TEXTURE_2D_ARRAY, 0)
+        uploaded = time.perf_counter_ns()
+
+        dispatch_frame_array(geometry, self.programs, count)
+        glMemoryBarrier(GL_TEXTURE_UPDATE_BARRIER_BIT | GL_PIXEL_BUFFER_BARRIER_BIT)
+        computed = time.perf_counter_ns()
+
+        pixel_type, dtype = READBACK_TYPES[self.frame_format]
+        output = np.empty((count, geometry.height, geometry.width), dtype=dtype)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pack_buffer)
+        glBindTexture(GL_TEXTURE_2D_ARRAY, self.output_texture)
+        glGetTexImage(GL_TEXTURE_2D_ARRAY, 0, GL_RED, pixel_type, ctypes.c_void_p(0))
+        ptr = glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, output.nbytes, GL_MAP_READ_BIT)
+        ctypes.memmove(output.ctypes.data, ptr, output.nbytes)
+        glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+        glBindTexture(GL_TEXTURE_2D_ARRAY, 0)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        done = time.perf_counter_ns()
+
+        # drivers that queue the dispatches account their GPU time to the readback, which waits for them
+        self.upload_ns += uploaded - start
+        self.compute_ns += computed - uploaded
+        self.readback_ns += done - computed
+        self.frames += count
+        self.batches += 1
+        return output
+
+    def close(self):
+        textures = [self.input_texture, self.output_texture]
+        if self.bin_texture is not None:
+            textures.append(self.bin_texture)
+        glDeleteTextures(len(textures), textures)
+        glDeleteBuffers(3, [self.histogram_buffer, self.lut_buffer, self.pack_buffer])
+
+    def report(self):
+        frames = max(self.frames, 1)
+        total_ms = (self.upload_ns + self.compute_ns + self.readback_ns) / 1e6
+        return (f"batch ({self.batch_frames} {self.frame_format} frames per dispatch): {self.frames} frames in {self.batches} batches, "
+                f"{total_ms / frames:.2f} ms per frame (upload {self.upload_ns / 1e6 / frames:.2f}, "
+                f"passes {self.compute_ns / 1e6 / frames:.2f}, readback {self.readback_ns / 1e6 / frames:.2f})")
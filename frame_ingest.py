@@ -0,0 +1,300 @@
+# frame_ingest.py
+# PROVUU
+#
+# Frame ingest path between the appsink and the texture upload.
+#
+# Buffers pulled from the appsink are mapped read-only with gst_buffer_map() through
+# ctypes, and the raw pointer to the mapped memory is handed straight to glTexSubImage2D.
+# The frame never becomes a Python bytes object, so the hot loop does no Python-side copies.
+# The mapping is released as soon as the upload has been issued.
+#
+# If libgstreamer can not be loaded through ctypes we fall back to extract_dup(), which
+# copies the frame. Every byte copied that way is counted by CopyStats so the fallback
+# shows up in the stats instead of silently costing ~1.8MB per frame.
+#
+# Samples are taken off the appsink on the GStreamer streaming thread (new-sample signal)
+# and dropped into a small FrameMailbox. The render thread takes the newest frame out of
+# the mailbox whenever it is ready for one, so a slow frame never leaves a queue of stale
+# buffers behind it. Frames that get replaced before the renderer takes them are counted.
+
+import collections
+import ctypes
+import ctypes.util
+import threading
+import time
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+GST_MAP_READ = 1 << 0
+GST_MAP_WRITE = 1 << 1
+
+
+# mirror of the C GstMapInfo struct (gst/gstmemory.h)
+class GstMapInfo(ctypes.Structure):
+    _fields_ = [
+        ('memory', ctypes.c_void_p),
+        ('flags', ctypes.c_int),
+        ('data', ctypes.c_void_p),
+        ('size', ctypes.c_size_t),
+        ('maxsize', ctypes.c_size_t),
+        ('user_data', ctypes.c_void_p * 4),
+        ('_gst_reserved', ctypes.c_void_p * 4),
+    ]
+
+
+def _load_libgst():
+    name = ctypes.util.find_library('gstreamer-1.0') or 'libgstreamer-1.0.so.0'
+    try:
+        lib = ctypes.CDLL(name)
+    except OSError:
+        return None
+
+    lib.gst_buffer_map.argtypes = [ctypes.c_void_p, ctypes.POINTER(GstMapInfo), ctypes.c_int]
+    lib.gst_buffer_map.restype = ctypes.c_int
+    lib.gst_buffer_unmap.argtypes = [ctypes.c_void_p, ctypes.POINTER(GstMapInfo)]
+    lib.gst_buffer_unmap.restype = None
+    return lib
+
+libgst = _load_libgst()
+
+
+class CopyStats:
+    # Counts the bytes the ingest path copies into Python objects.
+    # With the mapped path working, bytes_copied stays at 0 for the whole run.
+
+    def __init__(self):
+        self.frames = 0
+        self.copied_frames = 0
+        self.bytes_copied = 0
+        self.frame_bytes_copied = 0
+        self.max_frame_bytes_copied = 0
+
+    def add(self, nbytes):
+        self.frame_bytes_copied += nbytes
+
+    def end_frame(self):
+        self.frames += 1
+        self.bytes_copied += self.frame_bytes_copied
+        if self.frame_bytes_copied:
+            self.copied_frames += 1
+        self.max_frame_bytes_copied = max(self.max_frame_bytes_copied, self.frame_bytes_copied)
+        self.frame_bytes_copied = 0
+
+    def report(self):
+        per_frame = self.bytes_copied / self.frames if self.frames else 0.0
+        return (f"ingest copies: {self.bytes_copied} bytes over {self.frames} frames "
+                f"({per_frame:.0f} bytes/frame avg, {self.max_frame_bytes_copied} max, "
+                f"{self.copied_frames} frames copied)")
+
+
+class MappedBuffer:
+    # Read-only view of a Gst.Buffer for the duration of a with-block.
+    #
+    #   with MappedBuffer(buffer, stats) as frame:
+    #       glTexSubImage2D(..., frame.ptr)
+    #
+    # frame.ptr is a ctypes.c_void_p into the buffer's memory (or a bytes copy on the
+    # fallback path), frame.size is the number of readable bytes.
+
+    def __init__(self, buffer, stats=None):
+        self.buffer = buffer
+        self.stats = stats
+        self.ptr = None
+        self.size = 0
+        self._info = None
+        self._copy = None
+
+    def __enter__(self):
+        if libgst is not None:
+            info = GstMapInfo()
+            # hash() of a boxed PyGObject wrapper is the address of the underlying GstBuffer
+            if not libgst.gst_buffer_map(hash(self.buffer), ctypes.byref(info), GST_MAP_READ):
+                raise RuntimeError("failed to map Gst.Buffer for reading")
+            self._info = info
+            self.ptr = ctypes.c_void_p(info.data)
+            self.size = info.size
+        else:
+            self._copy = self.buffer.extract_dup(0, self.buffer.get_size())
+            if self.stats is not None:
+                self.stats.add(len(self._copy))
+            self.ptr = self._copy
+            self.size = len(self._copy)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._info is not None:
+            libgst.gst_buffer_unmap(hash(self.buffer), ctypes.byref(self._info))
+            self._info = None
+        self._copy = None
+        self.ptr = None
+        return False
+
+
+class Frame:
+    # a sample handed from the streaming thread to the render thread.
+    # sequence counts frames seen by the ingest, pts is the buffer timestamp in ns.
+    # capture_ns is the pts on the pipeline clock (the monotonic system clock), comparable
+    # with time.monotonic_ns().
+
+    def __init__(self, sample, sequence, base_time=None):
+        self.sample = sample
+        self.sequence = sequence
+        self.received_ns = time.monotonic_ns()
+        buffer = sample.get_buffer()
+        self.pts = buffer.pts if buffer.pts != Gst.CLOCK_TIME_NONE else None
+        self.capture_ns = None
+        if base_time is not None and self.pts is not None:
+            self.capture_ns = base_time + self.pts
+
+    def map(self, stats=None):
+        return MappedBuffer(self.sample.get_buffer(), stats)
+
+
+class MappedArray:
+    # same interface as MappedBuffer for frames that live in a numpy array.
+    # the array must be C-contiguous, ptr points at its data without copying it.
+
+    def __init__(self, array):
+        if not array.flags['C_CONTIGUOUS']:
+            raise ValueError("frame arrays must be C-contiguous")
+        self.array = array
+        self.ptr = None
+        self.size = 0
+
+    def __enter__(self):
+        self.ptr = ctypes.c_void_p(self.array.ctypes.data)
+        self.size = self.array.nbytes
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.ptr = None
+        return False
+
+
+class ArrayFrame:
+    # a frame backed by a numpy array (e.g. a page of an np.memmap) instead of a Gst.Sample.
+    # capture_ns is set when the frame stands in for a live one (replay at the recorded
+    # timing), offline frames have none and are never dropped as stale by the FrameScheduler.
+
+    def __init__(self, array, sequence, pts=None, capture_ns=None):
+        self.array = array
+        self.sequence = sequence
+        self.received_ns = time.monotonic_ns()
+        self.pts = pts
+        self.capture_ns = capture_ns
+
+    def map(self, stats=None):
+        return MappedArray(self.array)
+
+
+class FrameMailbox:
+    # Bounded mailbox between one producer (the streaming thread) and the render thread.
+    #
+    # put() does not block by default: when the mailbox is full the oldest frame is dropped.
+    # With block=True it waits up to `timeout` seconds for room instead and returns False if
+    # there still is none, which lets offline producers process every frame.
+    # get() blocks for up to `timeout` seconds. With latest=True it returns the newest frame
+    # and discards everything older, otherwise frames come out in arrival order.
+    # Every frame dropped without being rendered is counted in `superseded`.
+
+    def __init__(self, depth=1):
+        if depth < 1:
+            raise ValueError("mailbox depth must be at least 1")
+        self.depth = depth
+        self.received = 0
+        self.delivered = 0
+        self.superseded = 0
+        self.closed = False
+        self._frames = collections.deque()
+        self._cond = threading.Condition()
+
+    def put(self, frame, block=False, timeout=None):
+        with self._cond:
+            if block and not self._cond.wait_for(lambda: len(self._frames) < self.depth, timeout):
+                return False
+            if len(self._frames) >= self.depth:
+                self._frames.popleft()
+                self.superseded += 1
+            self._frames.append(frame)
+            self.received += 1
+            self._cond.notify_all()
+            return True
+
+    def get(self, timeout=None, latest=True):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._frames or self.closed, timeout):
+                return None
+            if not self._frames:
+                return None
+
+            if latest:
+                frame = self._frames.pop()
+                self.superseded += len(self._frames)
+                self._frames.clear()
+            else:
+                frame = self._frames.popleft()
+            self.delivered += 1
+            self._cond.notify_all()
+            return frame
+
+    def pending(self):
+        with self._cond:
+            return len(self._frames)
+
+    def close(self):
+        # wake up the render thread, e.g. on EOS
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class AppsinkIngest:
+    # Feeds a FrameMailbox from an appsink's new-sample signal.
+    #
+    # The appsink is set to keep a single buffer and drop the old one when it is full, so
+    # neither the appsink nor the mailbox ever holds on to stale frames. Gaps in the buffer
+    # offsets (the v4l2 sequence number) are counted as frames dropped upstream of us.
+    #
+    # taps are called with every Frame on the streaming thread (e.g. FrameRecorder.tee) and
+    # must not block.
+
+    def __init__(self, sink, mailbox, taps=()):
+        self.sink = sink
+        self.mailbox = mailbox
+        self.taps = list(taps)
+        self.sequence = 0
+        self.dropped_upstream = 0
+        self._last_offset = None
+
+        sink.set_property('emit-signals', True)
+        sink.set_property('max-buffers', 1)
+        sink.set_property('drop', True)
+        sink.connect('new-sample', self._on_new_sample)
+        sink.connect('eos', self._on_eos)
+
+    def _on_new_sample(self, sink):
+        sample = sink.emit('pull-sample')
+        if sample is None:
+            return Gst.FlowReturn.ERROR
+
+        offset = sample.get_buffer().offset
+        if offset != Gst.BUFFER_OFFSET_NONE:
+            if self._last_offset is not None and offset > self._last_offset + 1:
+                self.dropped_upstream += offset - self._last_offset - 1
+            self._last_offset = offset
+
+        frame = Frame(sample, self.sequence, sink.get_base_time())
+        for tap in self.taps:
+            tap(frame)
+        self.mailbox.put(frame)
+        self.sequence += 1
+        return Gst.FlowReturn.OK
+
+    def _on_eos(self, sink):
+        self.mailbox.close()
+
+    def report(self):
+        m = self.mailbox
+        return (f"ingest: {m.received} frames received, {m.delivered} rendered, "
+                f"{m.superseded} superseded in mailbox, {self.dropped_upstream} dropped upstream")
@@ -0,0 +1,148 @@
+# frame_pacing.py
+# PROVUU
+#
+# Frame pacing for the render loop.
+#
+# The scheduler decides which frame the render loop processes next and when, and presents it.
+#
+#   latency     (latency-first) vsync on. The render loop waits until just before the next
+#               expected vblank, minus the time a frame usually takes to render, and then
+#               takes the newest frame. Whatever arrived in between is skipped, so the frame
+#               on screen is as fresh as possible.
+#   throughput  (throughput-first) vsync off. Frames are processed in arrival order so none
+#               are wasted. When processing falls behind, frames captured more than
+#               max_frame_age ago are skipped while there are newer frames waiting. Frames
+#               without a capture time (offline frames, fast replay) are never skipped.
+#
+# Waiting is always a blocking wait with a timeout, never a spin. The vblank estimate comes
+# from the monitor refresh rate when the context knows it, and is corrected by the measured
+# swap intervals. A frame whose swap lands more than half a refresh period after the vblank
+# it was aiming for is counted as late.
+
+import time
+
+POLICIES = ('latency', 'throughput')
+
+# safety margin for the late latch, on top of the render time estimate (ns)
+LATCH_MARGIN_NS = 2_000_000
+
+# smoothing factor for the render time and refresh period estimates
+EMA_ALPHA = 0.1
+
+
+class FrameScheduler:
+    def __init__(self, context, mailbox, policy='latency', swap_interval=None, max_frame_age_ms=100):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown pacing policy '{policy}', expected one of {', '.join(POLICIES)}")
+        self.context = context
+        self.mailbox = mailbox
+        self.policy = policy
+        self.swap_interval = swap_interval if swap_interval is not None else (1 if policy == 'latency' else 0)
+        self.max_frame_age_ns = int(max_frame_age_ms * 1e6)
+        context.set_swap_interval(self.swap_interval)
+
+        refresh_rate = context.refresh_rate()
+        self.refresh_period_ns = int(1e9 / refresh_rate) if refresh_rate else None
+        self.last_present_ns = None
+        self.render_ns = 0
+        self._taken_ns = None
+
+        # statistics
+        self.frames_presented = 0
+        self.frames_skipped = 0     # stale frames dropped by the scheduler
+        self.frames_late = 0        # presented after the vblank they were meant for
+        self.timeouts = 0           # waits that ended without a frame
+
+    def next_vblank_ns(self):
+        # expected time of the next vblank, or None when we are not syncing to one
+        if not self.swap_interval or self.refresh_period_ns is None or self.last_present_ns is None:
+            return None
+        period = self.refresh_period_ns * self.swap_interval
+        now = time.monotonic_ns()
+        missed = max(0, (now - self.last_present_ns) // period)
+        return self.last_present_ns + (missed + 1) * period
+
+    def next_frame(self, timeout):
+        # block until there is a frame to render, for at most `timeout` seconds.
+        # returns None on timeout or end of stream.
+        if self.policy == 'latency':
+            frame = self._latch_newest(timeout)
+        else:
+            frame = self._next_in_order(timeout)
+
+        if frame is None:
+            self.timeouts += 1
+        else:
+            self._taken_ns = time.monotonic_ns()
+        return frame
+
+    def _latch_newest(self, timeout):
+        # sleep until the last moment the frame can still make the next vblank
+        vblank = self.next_vblank_ns()
+        if vblank is not None:
+            latch = vblank - self.render_ns - LATCH_MARGIN_NS
+            delay = latch - time.monotonic_ns()
+            if delay > 0:
+                time.sleep(min(delay / 1e9, timeout))
+        return self.mailbox.get(timeout=timeout, latest=True)
+
+    def _next_in_order(self, timeout):
+        frame = self.mailbox.get(timeout=timeout, latest=False)
+        # catch up: skip stale frames as long as something newer is waiting
+        while frame is not None and self.mailbox.pending() and self._is_stale(frame):
+            self.frames_skipped += 1
+            frame = self.mailbox.get(timeout=0, latest=False)
+        return frame
+
+    def _is_stale(self, frame):
+        # only live frames age. the time an offline frame was read says nothing about it.
+        captured = getattr(frame, 'capture_ns', None)
+        return captured is not None and time.monotonic_ns() - captured > self.max_frame_age_ns
+
+    def present(self):
+        # swap buffers and update the render time and vblank estimates
+        rendered = time.monotonic_ns()
+        if self._taken_ns is not None:
+            self._update_ema('render_ns', rendered - self._taken_ns)
+
+        expected_vblank = self.next_vblank_ns()
+        self.context.swap_buffers()
+        now = time.monotonic_ns()
+
+        if self.swap_interval and self.last_present_ns is not None:
+            interval = now - self.last_present_ns
+            period = self.refresh_period_ns
+            # only refine the refresh period from swaps that hit consecutive vblanks
+            if period is None or abs(interval - period * self.swap_interval) < period // 4:
+                self._update_ema('refresh_period_ns', interval // self.swap_interval)
+            if expected_vblank is not None and now - expected_vblank > self.refresh_period_ns // 2:
+                self.frames_late += 1
+
+        self.last_present_ns = now
+        self._taken_ns = None
+        self.frames_presented += 1
+
+    def _update_ema(self, name, value):
+        current = getattr(self, name)
+        setattr(self, name, value if not current else int(current + EMA_ALPHA * (value - current)))
+
+    def stats(self):
+        return {
+            'policy': self.policy,
+            'swap_interval': self.swap_interval,
+            'frames_presented': self.frames_presented,
+            'frames_skipped': self.frames_skipped,
+            'frames_superseded': self.mailbox.superseded,
+            'frames_late': self.frames_late,
+            'timeouts': self.timeouts,
+            'render_ms': self.render_ns / 1e6,
+            'refresh_period_ms': self.refresh_period_ns / 1e6 if self.refresh_period_ns else None,
+        }
+
+    def report(self):
+        s = self.stats()
+        refresh = f"{s['refresh_period_ms']:.2f}ms" if s['refresh_period_ms'] else "unknown"
+        return (f"pacing ({s['policy']}, swap interval {s['swap_interval']}): "
+                f"{s['frames_presented']} presented, {s['frames_skipped']} skipped stale, "
+                f"{s['frames_superseded']} superseded, {s['frames_late']} late, {s['timeouts']} timeouts, "
+                f"render {s['render_ms']:.2f}ms, refresh period {refresh}")
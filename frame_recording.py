@@ -0,0 +1,234 @@
+# frame_recording.py
+# PROVUU
+#
+# Raw frame recording and deterministic replay.
+#
+# File layout (little endian):
+#
+#   header   HEADER_DTYPE, padded to DATA_OFFSET bytes
+#   payload  frame_count contiguous width x height frames in the header's format (GRAY16_LE, or
+#            GRAY8), starting at DATA_OFFSET
+#   index    frame_count INDEX_DTYPE records (pts and capture time in ns), at index_offset
+#            pts is -1 for buffers that had no timestamp
+#
+# The payload starts on a page boundary so the replayer can serve every frame straight out
+# of an np.memmap, the frames are never read into python memory before the texture upload.
+# The index goes after the payload because the recorder only knows the frame count when it
+# is closed, the header is patched at the same time.
+
+import ctypes
+import queue
+import threading
+import time
+import numpy as np
+from frame_ingest import ArrayFrame
+
+MAGIC = b'PROVUURF'
+VERSION = 1
+DATA_OFFSET = 4096
+
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('width', '<u4'),
+    ('height', '<u4'),
+    ('format', 'S16'),
+    ('frame_count', '<u8'),
+    ('index_offset', '<u8'),
+])
+
+INDEX_DTYPE = np.dtype([
+    ('pts', '<i8'),
+    ('received_ns', '<i8'),
+])
+
+# bytes per sample of the frame formats a recording holds. only GRAY16_LE recordings can be
+# replayed, GRAY8 ones come out of --batch with an 8-bit --output-format.
+FORMAT_SAMPLE_BYTES = {'GRAY16_LE': 2, 'GRAY8': 1}
+
+# frames the recorder may fall behind by before it starts dropping them, the slots of its ring
+RECORDER_QUEUE_DEPTH = 8
+
+
+def read_header(path):
+    header = np.fromfile(path, dtype=HEADER_DTYPE, count=1)
+    if len(header) != 1 or header['magic'][0] != MAGIC:
+        raise ValueError(f"{path} is not a PROVUU frame recording")
+    if header['version'][0] != VERSION:
+        raise ValueError(f"{path} is recording version {header['version'][0]}, expected {VERSION}")
+    return header[0]
+
+
+class FrameRecorder:
+    # Tees frames off the ingest stream into a recording.
+    #
+    # tee() is called on the streaming thread. It copies the frame into a free slot of a ring
+    # allocated up front and lets go of the buffer right away, the writer thread writes the slot
+    # to disk. Holding on to the Gst buffers instead would pin them in v4l2src's small capture
+    # pool and stall the camera. If the disk can not keep up and the ring is full, frames are
+    # dropped (and counted) rather than stalling the camera. write() waits for a free slot
+    # instead, for producers that have all the time in the world (--batch).
+
+    def __init__(self, path, width, height, format='GRAY16_LE'):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.format = format
+        self.frame_size = width * height * FORMAT_SAMPLE_BYTES[format]
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self._index = []
+        self._ring = np.empty((RECORDER_QUEUE_DEPTH, self.frame_size), dtype=np.uint8)
+        self._free_slots = queue.Queue()
+        for slot in range(RECORDER_QUEUE_DEPTH):
+            self._free_slots.put(slot)
+        self._queue = queue.Queue()
+        self._file = open(path, 'wb')
+        self._file.write(b'\0' * DATA_OFFSET)
+        self._thread = threading.Thread(target=self._write_frames, name='frame-recorder', daemon=True)
+        self._thread.start()
+
+    def tee(self, frame):
+        try:
+            slot = self._free_slots.get_nowait()
+        except queue.Empty:
+            self.frames_dropped += 1
+            return
+        self._copy(frame, slot)
+
+    def write(self, frame):
+        # like tee(), but waits for room instead of dropping the frame, for offline writers
+        self._copy(frame, self._free_slots.get())
+
+    def _copy(self, frame, slot):
+        with frame.map() as mapped:
+            if mapped.size < self.frame_size:
+                self.frames_dropped += 1
+                self._free_slots.put(slot)
+                return
+            if isinstance(mapped.ptr, ctypes.c_void_p):
+                ctypes.memmove(self._ring[slot].ctypes.data, mapped.ptr, self.frame_size)
+            else:
+                self._ring[slot] = np.frombuffer(mapped.ptr, dtype=np.uint8, count=self.frame_size)
+        self._queue.put((slot, frame.pts if frame.pts is not None else -1, frame.received_ns))
+
+    def _write_frames(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            slot, pts, received_ns = item
+            self._file.write(self._ring[slot].data)
+            self._free_slots.put(slot)
+            self._index.append((pts, received_ns))
+            self.frames_written += 1
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+        index = np.array(self._index, dtype=INDEX_DTYPE)
+        index_offset = self._file.tell()
+        self._file.write(index.tobytes())
+
+        header = np.zeros(1, dtype=HEADER_DTYPE)
+        header['magic'] = MAGIC
+        header['version'] = VERSION
+        header['width'] = self.width
+        header['height'] = self.height
+        header['format'] = self.format.encode()
+        header['frame_count'] = len(index)
+        header['index_offset'] = index_offset
+        self._file.seek(0)
+        self._file.write(header.tobytes())
+        self._file.close()
+
+    def report(self):
+        return f"recorder: {self.frames_written} frames written to {self.path}, {self.frames_dropped} dropped"
+
+
+class FrameReplay:
+    # Read-only view of a recording. frames[i] is an (height, width) uint16 page of the
+    # np.memmap, pts[i] its original timestamp.
+
+    def __init__(self, path):
+        header = read_header(path)
+        self.path = path
+        self.width = int(header['width'])
+        self.height = int(header['height'])
+        self.format = header['format'].decode()
+        self.frame_count = int(header['frame_count'])
+        if self.frame_count == 0:
+            raise ValueError(f"{path} holds no frames")
+        if self.format != 'GRAY16_LE':
+            raise ValueError(f"{path} holds {self.format} frames, only GRAY16_LE can be replayed")
+
+        self.frames = np.memmap(path, dtype='<u2', mode='r', offset=DATA_OFFSET,
+                                shape=(self.frame_count, self.height, self.width))
+        index = np.memmap(path, dtype=INDEX_DTYPE, mode='r', offset=int(header['index_offset']),
+                          shape=(self.frame_count,))
+        self.pts = np.array(index['pts'])
+        self.received_ns = np.array(index['received_ns'])
+
+        # pace on the buffer timestamps, or on arrival times if the source had none
+        self.timestamps = self.pts if (self.pts >= 0).all() else self.received_ns
+
+    def __len__(self):
+        return self.frame_count
+
+
+class ReplayIngest:
+    # Plays a recording into a FrameMailbox from its own thread, standing in for
+    # AppsinkIngest. Frames go into the mailbox as zero-copy views of the memmap.
+    #
+    # pacing='original' reproduces the recorded frame timing from the index. Each frame is
+    # stamped with the instant it is replayed for as its capture_ns, so a renderer that falls
+    # behind skips stale frames exactly as it would with the camera.
+    # pacing='fast' pushes frames as soon as the renderer has taken the previous one, so
+    # every recorded frame is processed exactly once, in order. Those frames carry no
+    # capture_ns, which tells the FrameScheduler they are never stale, and the output does
+    # not depend on how fast the host is.
+
+    def __init__(self, replay, mailbox, pacing='original'):
+        if pacing not in ('original', 'fast'):
+            raise ValueError(f"unknown replay pacing '{pacing}'")
+        self.replay = replay
+        self.mailbox = mailbox
+        self.pacing = pacing
+        self.sequence = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._play, name='frame-replay', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=1.0)
+
+    def _play(self):
+        replay = self.replay
+        start = time.monotonic_ns()
+        for i in range(len(replay)):
+            if self._stop.is_set():
+                break
+
+            pts = int(replay.pts[i]) if replay.pts[i] >= 0 else None
+            if self.pacing == 'original':
+                capture_ns = start + int(replay.timestamps[i] - replay.timestamps[0])
+                delay = capture_ns - time.monotonic_ns()
+                if delay > 0:
+                    time.sleep(delay / 1e9)
+                self.mailbox.put(ArrayFrame(replay.frames[i], self.sequence, pts, capture_ns))
+            else:
+                while not self.mailbox.put(ArrayFrame(replay.frames[i], self.sequence, pts), block=True, timeout=0.1):
+                    if self._stop.is_set():
+                        break
+            self.sequence += 1
+
+        self.mailbox.close()
+
+    def report(self):
+        m = self.mailbox
+        return (f"replay: {self.sequence}/{len(self.replay)} frames from {self.replay.path}, "
+                f"{m.delivered} rendered, {m.superseded} superseded in mailbox")
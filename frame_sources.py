@@ -0,0 +1,227 @@
+# frame_sources.py
+# PROVUU
+#
+# Pluggable frame sources for the CLAHE pipeline.
+#
+# Every source produces GRAY16_LE frames of the configured size and is linked into the same
+# capsfilter -> appsink tail by accelerated_clahe.start_camera_stream(), so the ingest path
+# (AppsinkIngest -> FrameMailbox -> upload) is identical no matter where frames come from.
+#
+#   v4l2     the camera on /dev/video0 (or --device)
+#   testsrc  videotestsrc test pattern, scaled to the camera's bit depth
+#   file     raw GRAY16_LE frames dumped back to back in a file
+#   numpy    frames generated in-process by a python generator and pushed through appsrc
+#
+# With fps > 0 the synthetic sources are paced to that rate, with fps = 0 they run as fast
+# as the pipeline can take frames, which is what we want for throughput testing.
+
+import abc
+import subprocess
+import threading
+import time
+import numpy as np
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+
+class FrameSource(abc.ABC):
+    # base class for frame sources.
+    #
+    # create_elements() returns the source elements in link order. The last one must output
+    # video/x-raw GRAY16_LE at width x height. start() and stop() are called once the
+    # pipeline is playing and before it is torn down.
+
+    def __init__(self, width, height, fps=0):
+        self.width = width
+        self.height = height
+        self.fps = fps
+
+    def prepare(self):
+        pass
+
+    @abc.abstractmethod
+    def create_elements(self):
+        pass
+
+    def caps(self, framerate=None):
+        caps = f'video/x-raw, width={self.width}, height={self.height}, format=GRAY16_LE'
+        framerate = framerate or self.fps
+        if framerate:
+            caps += f', framerate={framerate}/1'
+        return Gst.Caps.from_string(caps)
+
+    def start(self, pipeline):
+        pass
+
+    def stop(self):
+        pass
+
+
+class V4L2Source(FrameSource):
+    def __init__(self, width, height, fps=0, device='/dev/video0'):
+        super().__init__(width, height, fps)
+        self.device = device
+
+    def prepare(self):
+        subprocess.run(['v4l2-ctl', '-d', self.device, f'--set-fmt-video=width={self.width},height={self.height}'])
+
+    def create_elements(self):
+        source = Gst.ElementFactory.make('v4l2src', 'camera')
+        source.set_property('device', self.device)
+        source.set_property('io-mode', 4)
+        return [source]
+
+
+class RawFileSource(FrameSource):
+    # raw dump of back to back GRAY16_LE frames, e.g. from
+    #   gst-launch-1.0 v4l2src num-buffers=300 ! video/x-raw,format=GRAY16_LE ! filesink location=dump.raw
+    def __init__(self, width, height, fps=0, path=None):
+        super().__init__(width, height, fps)
+        if path is None:
+            raise ValueError("the file source needs a path")
+        self.path = path
+
+    def create_elements(self):
+        source = Gst.ElementFactory.make('filesrc', 'filesrc')
+        source.set_property('location', self.path)
+
+        parse = Gst.ElementFactory.make('rawvideoparse', 'rawvideoparse')
+        parse.set_property('width', self.width)
+        parse.set_property('height', self.height)
+        Gst.util_set_object_arg(parse, 'format', 'gray16-le')
+        parse.set_property('framerate', Gst.Fraction(self.fps or 30, 1))
+        elements = [source, parse]
+
+        # the appsink does not sync to the clock, so pace the file here
+        if self.fps:
+            pace = Gst.ElementFactory.make('identity', 'pace')
+            pace.set_property('sync', True)
+            elements.append(pace)
+        return elements
+
+
+def synthetic_frames(width, height, bit_depth=10, count=8, seed=0):
+    # endless generator of noisy moving gradients in the camera's bit depth.
+    # a handful of frames are generated up front and cycled, so producing a frame
+    # costs nothing and the source can run at arbitrary rates.
+    rng = np.random.default_rng(seed)
+    max_value = (1 << bit_depth) - 1
+    x = np.linspace(0.0, 1.0, width, dtype=np.float32)
+    y = np.linspace(0.0, 1.0, height, dtype=np.float32)[:, None]
+    frames = []
+    for i in range(count):
+        phase = i / count
+        base = 0.5 + 0.25 * np.sin(2.0 * np.pi * (x + y + phase))
+        noise = rng.normal(0.0, 0.05, (height, width))
+        frame = np.clip(base + noise, 0.0, 1.0) * max_value
+        frames.append(frame.astype(np.uint16))
+
+    while True:
+        yield from frames
+
+
+class NumpySource(FrameSource):
+    # pushes frames from a python generator into the pipeline through appsrc.
+    # the copy into a Gst.Buffer happens on the producer thread, not the render thread.
+
+    def __init__(self, width, height, fps=0, frames=None):
+        super().__init__(width, height, fps)
+        self.frames = frames if frames is not None else synthetic_frames(width, height)
+        self.appsrc = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def caps(self, framerate=None):
+        return super().caps(framerate or self.fps or 30)
+
+    def create_elements(self):
+        self.appsrc = Gst.ElementFactory.make('appsrc', 'numpysrc')
+        self.appsrc.set_property('caps', self.caps())
+        self.appsrc.set_property('format', Gst.Format.TIME)
+        self.appsrc.set_property('is-live', bool(self.fps))
+        # block instead of queueing when we produce faster than the pipeline consumes
+        self.appsrc.set_property('block', True)
+        self.appsrc.set_property('max-bytes', 2 * self.width * self.height * 2)
+        return [self.appsrc]
+
+    def start(self, pipeline):
+        self._thread = threading.Thread(target=self._push_frames, name='numpy-source', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+
+    def _push_frames(self):
+        duration = Gst.SECOND // (self.fps or 30)
+        start = time.monotonic()
+        for index, frame in enumerate(self.frames):
+            if self._stop.is_set():
+                break
+            if frame.shape != (self.height, self.width) or frame.dtype != np.uint16:
+                raise ValueError(f"numpy source frame is {frame.shape} {frame.dtype}, "
+                                 f"expected ({self.height}, {self.width}) uint16")
+
+            buffer = Gst.Buffer.new_wrapped(frame.tobytes())
+            buffer.pts = index * duration
+            buffer.duration = duration
+            buffer.offset = index
+            if self.appsrc.emit('push-buffer', buffer) != Gst.FlowReturn.OK:
+                break
+
+            if self.fps:
+                delay = start + (index + 1) / self.fps - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+        self.appsrc.emit('end-of-stream')
+
+
+def pattern_frames(width, height, pattern='snow', bit_depth=10, count=30):
+    # endless generator of videotestsrc frames in the camera's bit depth. videotestsrc uses the
+    # full 16 bit range, which the histograms would put into their top bin, so `count` frames
+    # are rendered once through a short pipeline, shifted down to bit_depth and cycled.
+    pipeline = Gst.parse_launch(
+        f'videotestsrc pattern={pattern} num-buffers={count} ! '
+        f'video/x-raw, width={width}, height={height}, format=GRAY16_LE ! appsink name=sink sync=false')
+    sink = pipeline.get_by_name('sink')
+    pipeline.set_state(Gst.State.PLAYING)
+    frames = []
+    while True:
+        sample = sink.emit('pull-sample')
+        if sample is None:
+            break
+        buffer = sample.get_buffer()
+        data = np.frombuffer(buffer.extract_dup(0, buffer.get_size()), dtype='<u2')
+        # rows are padded to 4 bytes
+        rows = data.reshape(height, -1)[:, :width]
+        frames.append((rows >> (16 - bit_depth)).astype(np.uint16))
+    pipeline.set_state(Gst.State.NULL)
+    if not frames:
+        raise RuntimeError(f"videotestsrc rendered no frames of pattern '{pattern}'")
+
+    while True:
+        yield from frames
+
+
+class TestPatternSource(NumpySource):
+    # a videotestsrc pattern, pushed through appsrc like the numpy source once it is rendered
+    def __init__(self, width, height, fps=0, pattern='snow', bit_depth=10):
+        super().__init__(width, height, fps, pattern_frames(width, height, pattern, bit_depth))
+        self.pattern = pattern
+
+
+SOURCES = {
+    'v4l2': V4L2Source,
+    'testsrc': TestPatternSource,
+    'file': RawFileSource,
+    'numpy': NumpySource,
+}
+
+
+def create_frame_source(kind, width, height, fps=0, **options):
+    if kind not in SOURCES:
+        raise ValueError(f"unknown frame source '{kind}', expected one of {', '.join(SOURCES)}")
+    return SOURCES[kind](width, height, fps, **options)
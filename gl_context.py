@@ -0,0 +1,233 @@
+# gl_context.py
+# PROVUU
+#
+# OpenGL context backends.
+#
+# WindowContext opens a GLFW window and presents to it, which is what runs on the Nano.
+# The headless backends (EGL surfaceless and OSMesa) need no display at all, so the compute
+# passes and the presentation stage can run on servers and CI boxes, including on Mesa llvmpipe.
+# They render into an offscreen framebuffer the size of the output, which takes the place of
+# the window's default framebuffer. The render loop only ever talks to the context through
+#
+#   context.framebuffer     framebuffer object the final image is drawn into
+#   context.should_close()
+#   context.set_swap_interval(n)
+#   context.refresh_rate()      display refresh rate in Hz, None when there is no display
+#   context.swap_buffers()
+#   context.poll_events()
+#   context.terminate()
+#
+# so the windowed and headless runs execute the exact same GL code.
+#
+# PyOpenGL binds to a platform when OpenGL is first imported. The headless backends need
+# PYOPENGL_PLATFORM to be 'egl' or 'osmesa' before that happens, accelerated_clahe.py takes
+# care of it when --headless is passed.
+
+import collections
+import ctypes
+import os
+from OpenGL.GL import *
+
+# frames the headless backends let the GPU fall behind by, like a double buffered swapchain
+MAX_FRAMES_IN_FLIGHT = 2
+
+# EGL_MESA_platform_surfaceless, not exposed by PyOpenGL
+EGL_PLATFORM_SURFACELESS_MESA = 0x31DD
+
+# GL version requested from every backend.
+# compute shaders need 4.3. nothing uses fixed function state, so all of them ask for a core profile.
+GL_MAJOR_VERSION, GL_MINOR_VERSION = 4, 3
+
+
+class WindowContext:
+    def __init__(self, width, height, title):
+        # imported here, like the headless backends, so headless runs need no GLFW at all
+        import glfw
+        self._glfw = glfw
+
+        #initialize GLFW
+        if not glfw.init():
+            raise RuntimeError("Failed to initialize GLFW")
+
+        glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, GL_MAJOR_VERSION)
+        glfw.window_hint(glfw.CONTEXT_VERSION_MINOR, GL_MINOR_VERSION)
+        glfw.window_hint(glfw.OPENGL_PROFILE, glfw.OPENGL_CORE_PROFILE)
+        self.window = glfw.create_window(width, height, title, None, None)
+        if not self.window:
+            glfw.terminate()
+            raise RuntimeError("Failed to create GLFW window")
+
+        # Set context for OpenGL
+        glfw.make_context_current(self.window)
+        self.width = width
+        self.height = height
+        self.framebuffer = 0
+
+    def should_close(self):
+        return self._glfw.window_should_close(self.window)
+
+    def set_swap_interval(self, interval):
+        self._glfw.swap_interval(interval)
+
+    def refresh_rate(self):
+        glfw = self._glfw
+        monitor = glfw.get_window_monitor(self.window) or glfw.get_primary_monitor()
+        mode = glfw.get_video_mode(monitor) if monitor else None
+        return mode.refresh_rate if mode else None
+
+    def swap_buffers(self):
+        self._glfw.swap_buffers(self.window)
+
+    def poll_events(self):
+        self._glfw.poll_events()
+
+    def terminate(self):
+        self._glfw.terminate()
+
+
+class HeadlessContext:
+    # shared part of the headless backends: an offscreen color target standing in for the
+    # window, and fence based throttling standing in for the swapchain.
+
+    platform = None
+
+    def __init__(self, width, height):
+        if os.environ.get('PYOPENGL_PLATFORM') != self.platform:
+            raise RuntimeError(f"headless {self.platform} needs PYOPENGL_PLATFORM={self.platform} "
+                               "to be set before OpenGL is imported")
+        self.width = width
+        self.height = height
+        self.framebuffer = None
+        self.texture = None
+        self._fences = collections.deque()
+
+    def _create_target(self):
+        self.texture = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, self.texture)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA8, self.width, self.height, 0, GL_RGBA, GL_UNSIGNED_BYTE, None)
+        glBindTexture(GL_TEXTURE_2D, 0)
+
+        self.framebuffer = glGenFramebuffers(1)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.framebuffer)
+        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, self.texture, 0)
+        if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+            raise RuntimeError("offscreen framebuffer is incomplete")
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+
+    def should_close(self):
+        # headless runs end on end of stream or a frame limit
+        return False
+
+    def set_swap_interval(self, interval):
+        # nothing to sync to
+        pass
+
+    def refresh_rate(self):
+        return None
+
+    def swap_buffers(self):
+        # nothing to present, but keep the CPU from queueing up unbounded GPU work
+        self._fences.append(glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0))
+        glFlush()
+        while len(self._fences) > MAX_FRAMES_IN_FLIGHT:
+            fence = self._fences.popleft()
+            glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, GL_TIMEOUT_IGNORED)
+            glDeleteSync(fence)
+
+    def poll_events(self):
+        pass
+
+    def terminate(self):
+        while self._fences:
+            glDeleteSync(self._fences.popleft())
+        glDeleteFramebuffers(1, [self.framebuffer])
+        glDeleteTextures(1, [self.texture])
+
+
+class EGLContext(HeadlessContext):
+    # EGL on the surfaceless platform, no window system or pbuffer involved.
+    platform = 'egl'
+
+    def __init__(self, width, height):
+        super().__init__(width, height)
+        from OpenGL import EGL
+        from OpenGL.EGL.EXT.platform_base import eglGetPlatformDisplayEXT
+        self._egl = EGL
+
+        self.display = eglGetPlatformDisplayEXT(EGL_PLATFORM_SURFACELESS_MESA, EGL.EGL_DEFAULT_DISPLAY, None)
+        if not self.display or not EGL.eglInitialize(self.display, None, None):
+            raise RuntimeError("Failed to initialize a surfaceless EGL display")
+        if not EGL.eglBindAPI(EGL.EGL_OPENGL_API):
+            raise RuntimeError("EGL display does not support desktop OpenGL")
+
+        attributes = (EGL.EGLint * 7)(
+            EGL.EGL_CONTEXT_MAJOR_VERSION, GL_MAJOR_VERSION,
+            EGL.EGL_CONTEXT_MINOR_VERSION, GL_MINOR_VERSION,
+            EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK, EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT,
+            EGL.EGL_NONE)
+        # no config needed, EGL_KHR_no_config_context
+        self.context = EGL.eglCreateContext(self.display, EGL.EGLConfig(), EGL.EGL_NO_CONTEXT, attributes)
+        if not self.context:
+            raise RuntimeError(f"Failed to create an OpenGL {GL_MAJOR_VERSION}.{GL_MINOR_VERSION} EGL context")
+        if not EGL.eglMakeCurrent(self.display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, self.context):
+            raise RuntimeError("Failed to make the EGL context current")
+
+        self._create_target()
+
+    def terminate(self):
+        super().terminate()
+        EGL = self._egl
+        EGL.eglMakeCurrent(self.display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, EGL.EGL_NO_CONTEXT)
+        EGL.eglDestroyContext(self.display, self.context)
+        EGL.eglTerminate(self.display)
+
+
+class OSMesaContext(HeadlessContext):
+    # Mesa's off-screen software rasterizer, for boxes without libEGL.
+    platform = 'osmesa'
+
+    def __init__(self, width, height):
+        super().__init__(width, height)
+        from OpenGL import osmesa
+        self._osmesa = osmesa
+
+        attributes = (ctypes.c_int * 9)(
+            osmesa.OSMESA_FORMAT, osmesa.OSMESA_RGBA,
+            osmesa.OSMESA_PROFILE, osmesa.OSMESA_CORE_PROFILE,
+            osmesa.OSMESA_CONTEXT_MAJOR_VERSION, GL_MAJOR_VERSION,
+            osmesa.OSMESA_CONTEXT_MINOR_VERSION, GL_MINOR_VERSION,
+            0)
+        self.context = osmesa.OSMesaCreateContextAttribs(attributes, None)
+        if not self.context:
+            raise RuntimeError(f"Failed to create an OpenGL {GL_MAJOR_VERSION}.{GL_MINOR_VERSION} OSMesa context")
+
+        # OSMesa always wants a client side color buffer to be current, we never draw to it
+        self._buffer = (ctypes.c_ubyte * (width * height * 4))()
+        if not osmesa.OSMesaMakeCurrent(self.context, self._buffer, GL_UNSIGNED_BYTE, width, height):
+            raise RuntimeError("Failed to make the OSMesa context current")
+
+        self._create_target()
+
+    def terminate(self):
+        super().terminate()
+        self._osmesa.OSMesaDestroyContext(self.context)
+
+
+HEADLESS_CONTEXTS = {
+    'egl': EGLContext,
+    'osmesa': OSMesaContext,
+}
+
+
+def create_context(width, height, title, headless=None):
+    if headless is None:
+        context = WindowContext(width, height, title)
+    elif headless not in HEADLESS_CONTEXTS:
+        raise ValueError(f"unknown headless backend '{headless}', expected one of {', '.join(HEADLESS_CONTEXTS)}")
+    else:
+        context = HEADLESS_CONTEXTS[headless](width, height)
+    # rows of the 8-bit frames are not a multiple of 4 bytes for every width, pack and unpack
+    # them tightly, as GStreamer and numpy lay them out
+    glPixelStorei(GL_PACK_ALIGNMENT, 1)
+    glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+    return context
@@ -0,0 +1,161 @@
+# latency_trace.py
+# PROVUU
+#
+# Per-frame latency tracing, from the capture timestamp to the buffer swap.
+#
+# Every traced frame carries a FrameTrace with its PTS and sequence number, and collects one
+# timestamp per pipeline stage:
+#
+#   capture      v4l2src timestamp (pipeline base time + PTS, on the same monotonic clock)
+#   appsink      new-sample callback on the streaming thread
+#   pull         render thread took the frame out of the mailbox
+#   upload       texture upload finished on the GPU
+#   first_pass   histogram pass finished on the GPU
+#   second_pass  clip limit + cdf pass finished on the GPU
+#   third_pass   equalization pass finished on the GPU
+#   scale        scaling stage finished on the GPU
+#   present      swap_buffers returned
+#
+# GPU stages are GL_TIMESTAMP queries, mapped onto time.monotonic_ns() with an offset that is
+# recalibrated every few hundred frames. Queries are read back a few frames later, once they
+# are available, so tracing never stalls the pipeline.
+#
+# report() gives p50/p95/p99 of the time spent in each stage (time since the previous stage)
+# and of the end to end latency.
+
+import collections
+import ctypes
+import time
+import numpy as np
+from OpenGL.GL import *
+
+STAGES = ('capture', 'appsink', 'pull', 'upload', 'first_pass', 'second_pass', 'third_pass', 'scale', 'present')
+
+# frames between GPU/CPU clock offset measurements
+CALIBRATE_INTERVAL = 300
+
+# traced frames kept for the percentiles
+MAX_SAMPLES = 100_000
+
+
+class FrameTrace:
+    def __init__(self, tracer, frame):
+        self.tracer = tracer
+        self.sequence = frame.sequence
+        self.pts = frame.pts
+        self.cpu_ns = {}
+        self.gpu_queries = {}
+
+        if getattr(frame, 'capture_ns', None) is not None:
+            self.cpu_ns['capture'] = frame.capture_ns
+        self.cpu_ns['appsink'] = frame.received_ns
+        self.cpu_ns['pull'] = time.monotonic_ns()
+
+    def mark(self, stage):
+        # CPU timestamp, now
+        self.cpu_ns[stage] = time.monotonic_ns()
+
+    def gpu(self, stage):
+        # GPU timestamp, taken when the GPU gets through the commands issued so far
+        query = self.tracer._acquire_query()
+        glQueryCounter(query, GL_TIMESTAMP)
+        self.gpu_queries[stage] = query
+
+
+class _NullTrace:
+    # stands in for FrameTrace when tracing is off
+    def mark(self, stage):
+        pass
+
+    def gpu(self, stage):
+        pass
+
+_NULL_TRACE = _NullTrace()
+
+
+class LatencyTracer:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.frames = 0
+        self.latencies = {stage: collections.deque(maxlen=MAX_SAMPLES) for stage in STAGES}
+        self.end_to_end = collections.deque(maxlen=MAX_SAMPLES)
+        self._pending = collections.deque()
+        self._free_queries = []
+        self._offset_ns = 0
+        if enabled:
+            self._calibrate()
+
+    def _calibrate(self):
+        # offset that maps GL_TIMESTAMP onto time.monotonic_ns()
+        gpu_ns = ctypes.c_int64()
+        before = time.monotonic_ns()
+        glGetInteger64v(GL_TIMESTAMP, ctypes.byref(gpu_ns))
+        after = time.monotonic_ns()
+        self._offset_ns = (before + after) // 2 - gpu_ns.value
+
+    def _acquire_query(self):
+        if not self._free_queries:
+            self._free_queries.extend(int(q) for q in glGenQueries(len(STAGES) * 4))
+        return self._free_queries.pop()
+
+    def begin(self, frame):
+        if not self.enabled:
+            return _NULL_TRACE
+        return FrameTrace(self, frame)
+
+    def end(self, trace):
+        if trace is _NULL_TRACE:
+            return
+        self._pending.append(trace)
+        self.frames += 1
+        if self.frames % CALIBRATE_INTERVAL == 0:
+            self._calibrate()
+        self.resolve()
+
+    def resolve(self, wait=False):
+        # read back the GPU timestamps of every finished frame, oldest first
+        available = ctypes.c_int()
+        result = ctypes.c_uint64()
+        while self._pending:
+            trace = self._pending[0]
+            if trace.gpu_queries and not wait:
+                last_query = list(trace.gpu_queries.values())[-1]
+                glGetQueryObjectiv(last_query, GL_QUERY_RESULT_AVAILABLE, ctypes.byref(available))
+                if not available.value:
+                    break
+            self._pending.popleft()
+
+            stamps = dict(trace.cpu_ns)
+            for stage, query in trace.gpu_queries.items():
+                glGetQueryObjectui64v(query, GL_QUERY_RESULT, ctypes.byref(result))
+                stamps[stage] = result.value + self._offset_ns
+                self._free_queries.append(query)
+            self._record(stamps)
+
+    def _record(self, stamps):
+        previous = None
+        first = None
+        for stage in STAGES:
+            if stage not in stamps:
+                continue
+            if previous is None:
+                first = stamps[stage]
+            else:
+                self.latencies[stage].append(stamps[stage] - previous)
+            previous = stamps[stage]
+        if previous is not None and previous != first:
+            self.end_to_end.append(previous - first)
+
+    def report(self):
+        if not self.enabled:
+            return ""
+        self.resolve(wait=True)
+
+        lines = [f"latency over {len(self.end_to_end)} frames (ms)     p50      p95      p99"]
+        rows = [(stage, self.latencies[stage]) for stage in STAGES] + [('end to end', self.end_to_end)]
+        for name, samples in rows:
+            if not samples:
+                continue
+            p50, p95, p99 = np.percentile(np.array(samples, dtype=np.float64) / 1e6, [50, 95, 99])
+            lines.append(f"  {name:<30}{p50:8.3f} {p95:8.3f} {p99:8.3f}")
+        return "\n".join(lines)
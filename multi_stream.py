@@ -0,0 +1,125 @@
+# multi_stream.py
+# PROVUU
+#
+# Several camera streams equalized and presented by one process and one GL context (--streams).
+#
+# Every stream keeps its own ingest and mailbox, the GPU side is shared: the frames of all N
+# streams are layers of GL_TEXTURE_2D_ARRAYs and the histogram and LUT buffers hold the tiles
+# of all of them, one stream after the other, exactly like a --batch of N frames (see
+# frame_batch.py). So a composite frame still costs
+#
+#   * one upload per stream that delivered a new frame, into its layer
+#   * a single (numTilesX, numTilesY, N) dispatch and barrier per pass
+#   * one draw of the tiled composite (presentation.py)
+#
+# and only the uploads grow with the number of cameras.
+#
+# The first stream paces the composite: the render loop waits for its frames (through the
+# FrameScheduler), and the other streams contribute the newest frame they have at that moment.
+# A stream that has nothing new keeps its previous frame in its layer, which is counted as a
+# repeat. The composite ends when the first stream does.
+
+import time
+from OpenGL.GL import *
+from frame_batch import create_array_texture, dispatch_frame_array
+from shader_build import BIN_TEXTURE_FORMATS, DEFAULT_LUT_FORMAT, DEFAULT_OUTPUT_FORMAT, OUTPUT_TEXTURE_FORMATS
+
+
+def stream_value(values, stream):
+    # per stream command line values, the last one is used by every stream past the end
+    return values[min(stream, len(values) - 1)]
+
+
+class StreamSet:
+    def __init__(self, geometry, programs, mailboxes, lut_format=DEFAULT_LUT_FORMAT, output_format=DEFAULT_OUTPUT_FORMAT):
+        streams = len(mailboxes)
+        max_layers = glGetIntegerv(GL_MAX_ARRAY_TEXTURE_LAYERS)
+        if streams > max_layers:
+            raise ValueError(f"{streams} streams do not fit in a texture array, this GPU takes {max_layers}")
+        self.geometry = geometry
+        self.programs = programs
+        self.mailboxes = mailboxes
+        self.streams = streams
+        self.lut_format = lut_format
+        self.output_texture_format = OUTPUT_TEXTURE_FORMATS[output_format]
+
+        # statistics
+        self.frames = 0
+        self.uploads = [0] * streams
+        self.repeats = [0] * streams
+        self.upload_ns = 0
+
+        self._create_buffers()
+
+    def _create_buffers(self):
+        geometry = self.geometry
+        w, h, n = geometry.width, geometry.height, self.streams
+
+        # streams that have not delivered a frame yet show black
+        self.input_texture = create_array_texture(w, h, n, GL_R16UI)
+        glClearTexImage(self.input_texture, 0, GL_RED_INTEGER, GL_UNSIGNED_SHORT, None)
+        # the output is sampled by the composite draw
+        self.output_texture = create_array_texture(w, h, n, self.output_texture_format, GL_LINEAR)
+        self.bin_texture = None
+        if geometry.histogram_stride == 1:
+            self.bin_format = BIN_TEXTURE_FORMATS[geometry.bin_image_format]
+            self.bin_texture = create_array_texture(w, h, n, self.bin_format)
+
+        self.histogram_buffer = glGenBuffers(1)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, self.histogram_buffer)
+        glBufferData(GL_SHADER_STORAGE_BUFFER, n * geometry.histogram_buffer_size, None, GL_DYNAMIC_COPY)
+        self.lut_buffer = glGenBuffers(1)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, self.lut_buffer)
+        glBufferData(GL_SHADER_STORAGE_BUFFER, n * geometry.lut_buffer_size(self.lut_format), None, GL_DYNAMIC_COPY)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+
+    def bind(self):
+        # every layer of the arrays is bound, the shaders pick theirs from gl_WorkGroupID.z
+        glBindImageTexture(0, self.input_texture, 0, GL_TRUE, 0, GL_READ_ONLY, GL_R16UI)
+        if self.bin_texture is not None:
+            glBindImageTexture(3, self.bin_texture, 0, GL_TRUE, 0, GL_READ_WRITE, self.bin_format)
+        glBindImageTexture(4, self.output_texture, 0, GL_TRUE, 0, GL_WRITE_ONLY, self.output_texture_format)
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 1, self.histogram_buffer)
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 2, self.lut_buffer)
+
+    def upload(self, lead, stats=None):
+        # upload the first stream's frame and the newest frame of every other stream into their layers
+        geometry = self.geometry
+        start = time.perf_counter_ns()
+        glBindTexture(GL_TEXTURE_2D_ARRAY, self.input_texture)
+        for stream, mailbox in enumerate(self.mailboxes):
+            frame = lead if stream == 0 else mailbox.get(timeout=0, latest=True)
+            if frame is None:
+                self.repeats[stream] += 1
+                continue
+            # the buffer is only mapped for the duration of the upload
+            with frame.map(stats) as mapped:
+                if mapped.size < geometry.frame_size:
+                    raise RuntimeError(f"stream {stream} frame is {mapped.size} bytes, expected {geometry.frame_size}")
+                glTexSubImage3D(GL_TEXTURE_2D_ARRAY, 0, 0, 0, stream, geometry.width, geometry.height, 1,
+                                GL_RED_INTEGER, GL_UNSIGNED_SHORT, mapped.ptr)
+            self.uploads[stream] += 1
+        glBindTexture(GL_TEXTURE_2D_ARRAY, 0)
+        self.upload_ns += time.perf_counter_ns() - start
+        if stats is not None:
+            stats.end_frame()
+        self.frames += 1
+
+    def dispatch(self):
+        # equalize the layers of all streams together, one dispatch per pass
+        dispatch_frame_array(self.geometry, self.programs, self.streams)
+        # the output is sampled by the composite draw
+        glMemoryBarrier(GL_SHADER_IMAGE_ACCESS_BARRIER_BIT | GL_TEXTURE_FETCH_BARRIER_BIT)
+
+    def close(self):
+        textures = [self.input_texture, self.output_texture]
+        if self.bin_texture is not None:
+            textures.append(self.bin_texture)
+        glDeleteTextures(len(textures), textures)
+        glDeleteBuffers(2, [self.histogram_buffer, self.lut_buffer])
+
+    def report(self):
+        upload_ms = self.upload_ns / max(self.frames, 1) / 1e6
+        streams = ', '.join(f"{uploads} new/{repeats} repeated" for uploads, repeats in zip(self.uploads, self.repeats))
+        return (f"streams ({self.streams} per dispatch): {self.frames} composite frames, "
+                f"{upload_ms:.2f} ms of uploads per frame, frames per stream: {streams}")
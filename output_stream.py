@@ -0,0 +1,230 @@
+# output_stream.py
+# PROVUU
+#
+# Output branch that sends processed frames into a second GStreamer pipeline.
+#
+#   CLAHE texture --glGetTexImage--> readback PBO ring --memmove--> pooled Gst.Buffer --> appsrc
+#
+# Frames go out as GRAY16_LE, or as GRAY8 when the third pass writes an 8-bit output, which
+# halves the readback and everything downstream of it.
+#
+# The readback is asynchronous: each frame is read back into a slot of a persistently mapped
+# pixel pack buffer ring and only pushed once its fence has signaled, a few frames later.
+# The render loop never waits on the GPU or on the output pipeline. If the readback ring or
+# the appsrc queue is full the frame is dropped and counted instead.
+#
+# Gst.Buffers come from a Gst.BufferPool, so steady state output does not allocate. Buffers
+# carry the capture PTS of the frame they were computed from, rebased to start at 0.
+#
+# Targets:
+#   file   raw processed frames written to a file
+#   x264   software H.264 encode into a matroska file
+#   shm    shmsink, for other processes on the box to pick the frames up
+
+import collections
+import ctypes
+import time
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+from OpenGL.GL import *
+from frame_ingest import GST_MAP_WRITE, GstMapInfo, libgst
+from frame_recording import FORMAT_SAMPLE_BYTES
+from shader_build import READBACK_TYPES
+
+# frames read back from the GPU at the same time
+READBACK_DEPTH = 3
+
+# frames the appsrc may queue before we start dropping
+OUTPUT_QUEUE_FRAMES = 4
+
+# how long close() waits for the output pipeline to finish writing (ns)
+EOS_TIMEOUT = 5 * Gst.SECOND
+
+OUTPUT_TARGETS = ('file', 'x264', 'shm')
+
+
+class AppsrcOutput:
+    def __init__(self, target, location, width, height, fps=30, format='GRAY16_LE'):
+        if target not in OUTPUT_TARGETS:
+            raise ValueError(f"unknown output target '{target}', expected one of {', '.join(OUTPUT_TARGETS)}")
+        if format not in READBACK_TYPES:
+            raise ValueError(f"unknown output frame format '{format}', expected one of {', '.join(READBACK_TYPES)}")
+
+        self.target = target
+        self.location = location
+        self.width = width
+        self.height = height
+        self.fps = fps or 30
+        self.format = format
+        self.frame_size = width * height * FORMAT_SAMPLE_BYTES[format]
+        self.caps = Gst.Caps.from_string(
+            f'video/x-raw, width={width}, height={height}, format={format}, framerate={self.fps}/1')
+
+        self.frames_pushed = 0
+        self.dropped_readback = 0       # readback ring was full
+        self.dropped_backpressure = 0   # appsrc queue or buffer pool was full
+
+        self._first_pts = None
+        self._last_pts = None
+        self._start_ns = time.monotonic_ns()
+
+        self._create_pipeline()
+        self._create_pool()
+        self._create_readback_ring()
+
+    def _create_pipeline(self):
+        self.pipeline = Gst.Pipeline()
+        self.appsrc = Gst.ElementFactory.make('appsrc', 'output_src')
+        self.appsrc.set_property('caps', self.caps)
+        self.appsrc.set_property('format', Gst.Format.TIME)
+        self.appsrc.set_property('is-live', True)
+        self.appsrc.set_property('do-timestamp', False)
+        self.appsrc.set_property('block', False)
+        self.appsrc.set_property('max-bytes', OUTPUT_QUEUE_FRAMES * self.frame_size)
+        elements = [self.appsrc]
+
+        if self.target == 'file':
+            sink = Gst.ElementFactory.make('filesink', 'output_sink')
+            sink.set_property('location', self.location)
+        elif self.target == 'x264':
+            elements.append(Gst.ElementFactory.make('videoconvert', 'output_convert'))
+            encoder = Gst.ElementFactory.make('x264enc', 'output_encoder')
+            Gst.util_set_object_arg(encoder, 'tune', 'zerolatency')
+            Gst.util_set_object_arg(encoder, 'speed-preset', 'ultrafast')
+            elements.append(encoder)
+            elements.append(Gst.ElementFactory.make('matroskamux', 'output_mux'))
+            sink = Gst.ElementFactory.make('filesink', 'output_sink')
+            sink.set_property('location', self.location)
+        else:
+            sink = Gst.ElementFactory.make('shmsink', 'output_sink')
+            sink.set_property('socket-path', self.location)
+            sink.set_property('wait-for-connection', False)
+            sink.set_property('shm-size', (OUTPUT_QUEUE_FRAMES + 2) * self.frame_size)
+        sink.set_property('sync', False)
+        elements.append(sink)
+
+        for element in elements:
+            if element is None:
+                raise RuntimeError(f"could not create the elements for the {self.target} output")
+            self.pipeline.add(element)
+        for upstream, downstream in zip(elements, elements[1:]):
+            if not upstream.link(downstream):
+                raise RuntimeError(f"could not link {upstream.get_name()} to {downstream.get_name()}")
+
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def _create_pool(self):
+        # enough buffers for everything the appsrc may queue plus the ones in flight downstream
+        self.pool = Gst.BufferPool.new()
+        config = self.pool.get_config()
+        Gst.BufferPool.config_set_params(config, self.caps, self.frame_size, 2, OUTPUT_QUEUE_FRAMES + 2)
+        if not self.pool.set_config(config) or not self.pool.set_active(True):
+            raise RuntimeError("failed to configure the output buffer pool")
+        self._acquire_params = Gst.BufferPoolAcquireParams()
+        self._acquire_params.flags = Gst.BufferPoolAcquireFlags.DONTWAIT
+
+    def _create_readback_ring(self):
+        flags = GL_MAP_READ_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT
+        self.pbo = glGenBuffers(1)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pbo)
+        glBufferStorage(GL_PIXEL_PACK_BUFFER, READBACK_DEPTH * self.frame_size, None, flags)
+        self.ptr = ctypes.c_void_p(glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, READBACK_DEPTH * self.frame_size, flags)).value
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        if not self.ptr:
+            raise RuntimeError("failed to persistently map the readback ring")
+
+        self._free_slots = collections.deque(range(READBACK_DEPTH))
+        self._pending = collections.deque()     # (slot, fence, pts) in submission order
+
+    def submit(self, texture_id, pts=None):
+        # queue an asynchronous readback of the processed frame in texture_id and push any
+        # earlier readbacks that have completed. never blocks.
+        self.push_completed()
+
+        if not self._free_slots:
+            self.dropped_readback += 1
+            return
+        if self.appsrc.get_property('current-level-bytes') >= OUTPUT_QUEUE_FRAMES * self.frame_size:
+            self.dropped_backpressure += 1
+            return
+
+        slot = self._free_slots.popleft()
+
+        # the compute passes wrote the texture through image stores
+        glMemoryBarrier(GL_TEXTURE_UPDATE_BARRIER_BIT)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pbo)
+        glBindTexture(GL_TEXTURE_2D, texture_id)
+        pixel_type = READBACK_TYPES[self.format][0]
+        glGetTexImage(GL_TEXTURE_2D, 0, GL_RED, pixel_type, ctypes.c_void_p(slot * self.frame_size))
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+        fence = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self._pending.append((slot, fence, pts))
+
+    def push_completed(self, wait=False):
+        while self._pending:
+            slot, fence, pts = self._pending[0]
+            timeout = GL_TIMEOUT_IGNORED if wait else 0
+            if glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, timeout) == GL_TIMEOUT_EXPIRED:
+                break
+            glDeleteSync(fence)
+            self._pending.popleft()
+            self._push(self.ptr + slot * self.frame_size, pts)
+            self._free_slots.append(slot)
+
+    def _timestamp(self, pts):
+        # rebase capture timestamps to start at 0, fall back on the render clock
+        if pts is None:
+            pts = time.monotonic_ns() - self._start_ns
+        if self._first_pts is None:
+            self._first_pts = pts
+        return max(pts - self._first_pts, 0)
+
+    def _push(self, ptr, pts):
+        ret, buffer = self.pool.acquire_buffer(self._acquire_params)
+        if ret != Gst.FlowReturn.OK or buffer is None:
+            self.dropped_backpressure += 1
+            return
+
+        if libgst is not None:
+            info = GstMapInfo()
+            if not libgst.gst_buffer_map(hash(buffer), ctypes.byref(info), GST_MAP_WRITE):
+                raise RuntimeError("failed to map output Gst.Buffer for writing")
+            ctypes.memmove(info.data, ptr, self.frame_size)
+            libgst.gst_buffer_unmap(hash(buffer), ctypes.byref(info))
+        else:
+            buffer.fill(0, ctypes.string_at(ptr, self.frame_size))
+
+        timestamp = self._timestamp(pts)
+        if self._last_pts is not None and timestamp <= self._last_pts:
+            timestamp = self._last_pts + 1
+        buffer.pts = timestamp
+        buffer.dts = timestamp
+        buffer.duration = Gst.SECOND // self.fps
+        buffer.offset = self.frames_pushed
+        self._last_pts = timestamp
+
+        if self.appsrc.emit('push-buffer', buffer) == Gst.FlowReturn.OK:
+            self.frames_pushed += 1
+        else:
+            self.dropped_backpressure += 1
+
+    def close(self):
+        self.push_completed(wait=True)
+
+        self.appsrc.emit('end-of-stream')
+        bus = self.pipeline.get_bus()
+        bus.timed_pop_filtered(EOS_TIMEOUT, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+        self.pipeline.set_state(Gst.State.NULL)
+        self.pool.set_active(False)
+
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pbo)
+        glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        glDeleteBuffers(1, [self.pbo])
+
+    def report(self):
+        return (f"output ({self.target} {self.format} -> {self.location}): {self.frames_pushed} frames pushed, "
+                f"{self.dropped_readback} dropped waiting on readback, "
+                f"{self.dropped_backpressure} dropped on backpressure")
@@ -0,0 +1,143 @@
+# presentation.py
+# PROVUU
+#
+# Presentation stage: scales the processed frame to the output size and draws it into the
+# context's framebuffer (the window, or the offscreen target when running headless).
+#
+# Everything the draw needs is set up once, when the presenter is created, so a frame costs a
+# fixed and minimal number of GL calls from the render thread:
+#
+#   triangle    glUseProgram + glDrawArrays. A core profile fullscreen triangle
+#               (shaders/present_vertex.glsl, present_fragment.glsl) samples the frame with
+#               GL_LINEAR. Its vertex array has no buffers, the corners come from gl_VertexID.
+#   blit        glBlitFramebuffer with GL_LINEAR filtering from a read framebuffer the frame
+#               texture is attached to. Blits copy color channels as they are and ignore the
+#               texture swizzle, so the third pass writes an rgba16 (or rgba8) output for it.
+#
+# The frame texture, the vertex array, the read and draw framebuffers and the viewport stay
+# bound for the whole session, nothing else in the pipeline touches them. The compute passes
+# switch programs, so the triangle's program is the one thing that is rebound every frame.
+#
+# Textures stored top row first (the equalized frame at input size) are flipped on the way,
+# textures written bottom up (the fused third pass output) are drawn as they are.
+#
+# With several camera streams (--streams) the frame texture is a GL_TEXTURE_2D_ARRAY with a
+# layer per stream, and the triangle draws all of them as a tiled composite in the same two
+# calls (see stream_grid). A blit would take one call per stream, it presents single frames only.
+
+import math
+import time
+from OpenGL.GL import *
+from shader_build import OUTPUT_FORMATS, build_shader_source
+
+PRESENT_MODES = ('triangle', 'blit')
+DEFAULT_PRESENT_MODE = 'triangle'
+
+# output image format of the third pass each mode needs by default, and the ones it can draw.
+# see OUTPUT_FORMATS in shader_build.py
+PRESENT_OUTPUT_FORMATS = {'triangle': 'r16', 'blit': 'rgba16'}
+PRESENT_FORMATS = {'triangle': OUTPUT_FORMATS, 'blit': ('rgba16', 'rgba8')}
+
+# texture unit the frame stays bound to. 0 is used by the uploads, 1 by the LUT texture.
+PRESENT_TEXTURE_UNIT = 2
+
+PRESENT_SHADERS = (('present_vertex.glsl', GL_VERTEX_SHADER), ('present_fragment.glsl', GL_FRAGMENT_SHADER))
+
+# GL calls per presented frame
+PRESENT_CALLS = {'triangle': 2, 'blit': 1}
+
+
+def stream_grid(streams):
+    # columns and rows of the composite. the grid is square so every stream keeps the aspect
+    # ratio of the output, cells past the last stream stay black.
+    side = math.ceil(math.sqrt(streams))
+    return side, side
+
+
+class Presenter:
+    def __init__(self, context, texture, frame_size, output_size, flip=False, mode=DEFAULT_PRESENT_MODE, streams=1):
+        if mode not in PRESENT_MODES:
+            raise ValueError(f"unknown present mode '{mode}', expected one of {', '.join(PRESENT_MODES)}")
+        if streams > 1 and mode != 'triangle':
+            raise ValueError(f"a composite of {streams} streams is only presented with the triangle")
+        self.mode = mode
+        self.texture = texture
+        self.flip = flip
+        self.streams = streams
+        self.program = None
+        self.vertex_array = None
+        self.read_framebuffer = None
+
+        # statistics
+        self.frames = 0
+        self.present_ns = 0
+
+        frame_width, frame_height = frame_size
+        output_width, output_height = output_size
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, context.framebuffer)
+        glViewport(0, 0, output_width, output_height)
+
+        if mode == 'triangle':
+            self.program = self._create_program(flip, streams)
+            # core profiles draw nothing without a vertex array, even an empty one
+            self.vertex_array = glGenVertexArrays(1)
+            glBindVertexArray(self.vertex_array)
+            glActiveTexture(GL_TEXTURE0 + PRESENT_TEXTURE_UNIT)
+            glBindTexture(GL_TEXTURE_2D_ARRAY if streams > 1 else GL_TEXTURE_2D, texture)
+            glActiveTexture(GL_TEXTURE0)
+        else:
+            self.read_framebuffer = glGenFramebuffers(1)
+            glBindFramebuffer(GL_READ_FRAMEBUFFER, self.read_framebuffer)
+            glFramebufferTexture2D(GL_READ_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, texture, 0)
+            if glCheckFramebufferStatus(GL_READ_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+                raise RuntimeError("present read framebuffer is incomplete")
+            # a flipped blit swaps the destination rows
+            top, bottom = (output_height, 0) if flip else (0, output_height)
+            self._blit = (0, 0, frame_width, frame_height, 0, top, output_width, bottom,
+                          GL_COLOR_BUFFER_BIT, GL_LINEAR)
+
+    def _create_program(self, flip, streams):
+        columns, rows = stream_grid(streams)
+        defines = {'FLIP_Y': flip, 'PRESENT_TEXTURE_UNIT': PRESENT_TEXTURE_UNIT,
+                   'STREAMS': streams, 'STREAM_COLUMNS': columns, 'STREAM_ROWS': rows}
+        program = glCreateProgram()
+        shaders = []
+        for name, shader_type in PRESENT_SHADERS:
+            shader = glCreateShader(shader_type)
+            glShaderSource(shader, build_shader_source(name, defines))
+            glCompileShader(shader)
+            if glGetShaderiv(shader, GL_COMPILE_STATUS) != GL_TRUE:
+                raise RuntimeError(glGetShaderInfoLog(shader).decode())
+            glAttachShader(program, shader)
+            shaders.append(shader)
+        glLinkProgram(program)
+        if glGetProgramiv(program, GL_LINK_STATUS) != GL_TRUE:
+            raise RuntimeError(glGetProgramInfoLog(program).decode())
+        for shader in shaders:
+            glDeleteShader(shader)
+        return program
+
+    def present(self):
+        # draw the frame into the context's framebuffer, everything else is already bound
+        start = time.perf_counter_ns()
+        if self.program is not None:
+            glUseProgram(self.program)
+            glDrawArrays(GL_TRIANGLES, 0, 3)
+        else:
+            glBlitFramebuffer(*self._blit)
+        self.present_ns += time.perf_counter_ns() - start
+        self.frames += 1
+
+    def close(self):
+        if self.program is not None:
+            glDeleteProgram(self.program)
+            glDeleteVertexArrays(1, [self.vertex_array])
+        if self.read_framebuffer is not None:
+            glDeleteFramebuffers(1, [self.read_framebuffer])
+
+    def report(self):
+        present_us = self.present_ns / max(self.frames, 1) / 1e3
+        composite = f", {self.streams} streams" if self.streams > 1 else ''
+        return (f"presentation ({self.mode}{', flipped' if self.flip else ''}{composite}): "
+                f"{PRESENT_CALLS[self.mode]} GL calls, "
+                f"{present_us:.1f} us of render thread time per frame over {self.frames} frames")
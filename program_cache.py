@@ -0,0 +1,128 @@
+# program_cache.py
+# PROVUU
+#
+# On-disk cache of linked compute programs.
+#
+# Compiling and linking the three CLAHE passes from source on every launch is a large part of
+# the cold start on the Nano. After a program is linked from source its driver binary is saved
+# with glGetProgramBinary, and later launches load it back with glProgramBinary instead.
+#
+# Entries are keyed by a hash of the shader source, the #defines it was built with and the
+# GL_VENDOR / GL_RENDERER / GL_VERSION strings, so a shader edit, a different geometry or a
+# driver update never picks up a stale binary. Drivers may still reject a binary they wrote
+# themselves (e.g. after an update that kept the version string), in which case the program is
+# compiled from source and the entry is rewritten.
+#
+# Each entry is one file: the binary format as a little endian uint32, then the binary.
+
+import ctypes
+import hashlib
+import os
+import struct
+import time
+from OpenGL.GL import *
+from OpenGL.error import GLError
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                                 'provuu', 'programs')
+
+ENTRY_HEADER = struct.Struct('<I')
+
+
+class ProgramCache:
+    def __init__(self, directory=DEFAULT_CACHE_DIR, enabled=True):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0       # binaries the driver refused to load
+        self.build_ns = 0       # time spent creating programs, cached or not
+
+        # the driver has to be able to hand out program binaries at all
+        self.enabled = enabled and glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS) > 0
+        self._driver = b'\0'.join(glGetString(name) or b'' for name in (GL_VENDOR, GL_RENDERER, GL_VERSION))
+
+    def key(self, source, defines=None):
+        digest = hashlib.sha256()
+        digest.update(self._driver)
+        digest.update(b'\0')
+        for name, value in sorted((defines or {}).items()):
+            digest.update(f'{name}={value}\n'.encode())
+        digest.update(b'\0')
+        digest.update(source.encode())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.bin')
+
+    def program(self, source, defines=None, compile_program=None):
+        # linked program for `source`, from the cache if possible.
+        # compile_program(source) builds it from source on a miss.
+        start = time.perf_counter_ns()
+        try:
+            if not self.enabled:
+                return compile_program(source)
+
+            key = self.key(source, defines)
+            program = self._load(key)
+            if program is not None:
+                self.hits += 1
+                return program
+
+            self.misses += 1
+            program = compile_program(source)
+            self._store(key, program)
+            return program
+        finally:
+            self.build_ns += time.perf_counter_ns() - start
+
+    def _load(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if len(data) <= ENTRY_HEADER.size:
+            return None
+
+        (binary_format,) = ENTRY_HEADER.unpack_from(data)
+        binary = data[ENTRY_HEADER.size:]
+        program = glCreateProgram()
+        try:
+            # an unknown binary format is an error rather than a failed link
+            glProgramBinary(program, binary_format, binary, len(binary))
+            loaded = glGetProgramiv(program, GL_LINK_STATUS) == GL_TRUE
+        except GLError:
+            loaded = False
+        if not loaded:
+            glDeleteProgram(program)
+            self.rejected += 1
+            return None
+        return program
+
+    def _store(self, key, program):
+        length = glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH)
+        if length <= 0:
+            return
+        binary = (ctypes.c_ubyte * length)()
+        written = GLsizei()
+        binary_format = GLenum()
+        glGetProgramBinary(program, length, ctypes.byref(written), ctypes.byref(binary_format), binary)
+
+        # write to a temporary file first so a concurrent or interrupted run never sees half an entry
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(key)
+            temporary = f'{path}.{os.getpid()}.tmp'
+            with open(temporary, 'wb') as f:
+                f.write(ENTRY_HEADER.pack(binary_format.value))
+                f.write(bytes(binary)[:written.value])
+            os.replace(temporary, path)
+        except OSError as e:
+            print(f"program cache: could not write {self.directory}: {e}")
+
+    def report(self):
+        if not self.enabled:
+            return f"programs: cache disabled, built in {self.build_ns / 1e6:.1f}ms"
+        rejected = f", {self.rejected} rejected by the driver" if self.rejected else ""
+        return (f"programs: {self.hits} cache hits, {self.misses} misses{rejected}, "
+                f"built in {self.build_ns / 1e6:.1f}ms ({self.directory})")
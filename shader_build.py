@@ -0,0 +1,309 @@
+# shader_build.py
+# PROVUU
+#
+# Builds the CLAHE compute shader sources for a given frame and tile geometry.
+#
+# The shaders in shaders/ do not hard-code any sizes. Everything that depends on the sensor
+# resolution or the tile layout is injected as #defines right after the #version line:
+#
+#   IMAGE_WIDTH, IMAGE_HEIGHT     input frame size
+#   TILE_WIDTH, TILE_HEIGHT       CLAHE tile size
+#   NUM_TILES_X, NUM_TILES_Y      tiles across and down, edge tiles may be partial
+#   NUM_BINS                      histogram bins per tile
+#   INPUT_BIT_DEPTH               significant bits of the GRAY16 input samples
+#   CLIP_LIMIT                    histogram clip limit in pixels per bin
+#   LOCAL_SIZE_X, LOCAL_SIZE_Y    work group size of the per-pixel passes
+#   LOCAL_SIZE_BINS               work group size of the per-bin pass
+#   HISTOGRAM_STRIDE              the first pass samples one pixel per HISTOGRAM_STRIDE^2 pixel cell
+#   HISTOGRAM_SAMPLES_X, _Y       samples across and down a tile
+#   HISTOGRAM_LOCAL_SIZE_X, _Y    work group size of the first pass, over the samples of a tile
+#   HISTOGRAM_SAMPLING            where in its cell a sample is taken, one of
+#                                 HISTOGRAM_SAMPLING_REGULAR, HISTOGRAM_SAMPLING_JITTERED (also defined)
+#   BIN_IMAGE_FORMAT              image format qualifier of the per-pixel bin image
+#   HISTOGRAM_COPIES              shared memory sub-histograms of the first pass, 0 for global atomics
+#   LUT_FORMAT                    storage of the equalization LUTs, one of LUT_FORMAT_UINT16,
+#                                 LUT_FORMAT_HALF, LUT_FORMAT_FLOAT (also defined)
+#   LUT_TEXTURE                   1 to keep the LUTs in a 3D texture sampled with GL_LINEAR
+#   LUT_IMAGE_FORMAT              image format qualifier of that texture
+#   TEMPORAL                      1 to blend the cdfs over time, see temporal_lut.py
+#   DIRTY_TILES                   1 to run the first two passes on the changed tiles only
+#   FRAME_ARRAY                   1 to process a frame per layer of 2D array images, layers in z,
+#                                 see frame_batch.py
+#   SCALED_OUTPUT                 1 to have the third pass write the display sized output itself
+#   OUTPUT_WIDTH, OUTPUT_HEIGHT   size of that output
+#   SCALED_LOCAL_SIZE             work group width and height of the third pass in that case
+#   SCALED_INPUT_BLOCK_X, _Y      input pixels a work group of it equalizes into shared memory
+#   OUTPUT_IMAGE_FORMAT           image format qualifier of the equalized output of the third pass
+#   CHANGE_METRIC                 tile change measure of the change pass, one of
+#                                 CHANGE_METRIC_SAD, CHANGE_METRIC_MAX (also defined)
+#
+# The per-pixel passes run one work group per tile. When a tile has more pixels than the GPU
+# allows invocations per work group, every invocation strides over several pixels, so any
+# tile size works on any GPU (the Nano takes 39x39 = 1521 invocations, llvmpipe only 1024).
+#
+# The GL internal formats and pixel types that go with the image formats of the shaders are
+# defined here too, next to them, so every module creating the images or reading them back
+# uses the same tables.
+
+import math
+import os
+import numpy as np
+from OpenGL.GL import (GL_R8, GL_R8UI, GL_R16, GL_R16F, GL_R16UI, GL_R32F, GL_RGBA8, GL_RGBA16,
+                       GL_UNSIGNED_BYTE, GL_UNSIGNED_SHORT)
+
+SHADER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shaders")
+
+# supported histogram bin counts. the cdf scan needs a power of two.
+BIN_COUNTS = (256, 512, 1024, 4096)
+
+# internal formats of the bin image, see ClaheGeometry.bin_image_format
+BIN_TEXTURE_FORMATS = {'r8ui': GL_R8UI, 'r16ui': GL_R16UI}
+
+# input bit depth of the sensor (10-bit samples in GRAY16_LE)
+DEFAULT_BIT_DEPTH = 10
+
+# clip limit in pixels per bin, for 256 bins. finer histograms spread the same pixels over
+# more bins, so the limit is scaled down by the bin count.
+DEFAULT_CLIP_LIMIT = 40
+
+# shared memory sub-histograms per work group in the first pass. global atomics until the
+# shared memory variant has been measured faster on the Nano (histogram_benchmark.py)
+DEFAULT_HISTOGRAM_COPIES = 0
+
+# storage formats of the normalized per-tile equalization LUTs, and their size per entry.
+# uint16 is unorm16 (exact to 1/65535), float is the full precision reference. half is the
+# same size as uint16 but only has 11 significant bits, on 16-bit output it measured up to
+# 16.3 steps off float (32.2 with --interpolation texture), 10.6 on average. It is only
+# kept for GPUs where decoding fp16 is cheaper than unorm16.
+LUT_FORMATS = {'uint16': 2, 'half': 2, 'float': 4}
+DEFAULT_LUT_FORMAT = 'uint16'
+
+# image format qualifiers of the LUT texture for each LUT format
+LUT_IMAGE_FORMATS = {'uint16': 'r16', 'half': 'r16f', 'float': 'r32f'}
+
+# internal formats of the LUT texture for each LUT format
+LUT_TEXTURE_FORMATS = {'uint16': GL_R16, 'half': GL_R16F, 'float': GL_R32F}
+
+# how the third pass blends the LUTs of the four surrounding tiles.
+# alu reads them from the LUT buffer and blends in the shader, texture leaves the blend to
+# the texture unit (GL_LINEAR filtering), at the filtering precision of the GPU.
+INTERPOLATIONS = ('alu', 'texture')
+DEFAULT_INTERPOLATION = 'alu'
+
+# the CLAHE passes, in dispatch order
+CLAHE_SHADERS = ('clahe_first_pass.glsl', 'clahe_second_pass.glsl', 'clahe_third_pass.glsl')
+
+# work group width and height of the third pass when it writes the scaled output.
+# it then runs per output pixel rather than per tile.
+SCALED_LOCAL_SIZE = 16
+
+# image formats the third pass can write its output in. the intensity goes to every channel,
+# rgba is for presenting with glBlitFramebuffer, which ignores the texture swizzle. 8 bits are
+# all a display shows, the 8-bit formats halve the bytes the scaling, the present and the
+# readback of the output move.
+OUTPUT_FORMATS = ('r16', 'rgba16', 'r8', 'rgba8')
+DEFAULT_OUTPUT_FORMAT = 'r16'
+
+# internal formats of the output image for each output format
+OUTPUT_TEXTURE_FORMATS = {'r16': GL_R16, 'rgba16': GL_RGBA16, 'r8': GL_R8, 'rgba8': GL_RGBA8}
+
+# GStreamer format of the frames read back from each output format
+OUTPUT_FRAME_FORMATS = {'r16': 'GRAY16_LE', 'rgba16': 'GRAY16_LE', 'r8': 'GRAY8', 'rgba8': 'GRAY8'}
+
+# pixel type and array type the output is read back as, for each frame format
+READBACK_TYPES = {'GRAY16_LE': (GL_UNSIGNED_SHORT, np.uint16), 'GRAY8': (GL_UNSIGNED_BYTE, np.uint8)}
+
+# where the first pass samples each cell of HISTOGRAM_STRIDE x HISTOGRAM_STRIDE pixels when it
+# subsamples the histograms. regular takes the cell's center, jittered a pixel picked by a hash
+# of the cell's position, which breaks up the aliasing of regular sampling on periodic texture.
+HISTOGRAM_SAMPLINGS = ('regular', 'jittered')
+DEFAULT_HISTOGRAM_SAMPLING = 'regular'
+
+# tile change detector that runs ahead of the first pass with dirty tiles
+CHANGE_SHADER = 'clahe_change_pass.glsl'
+
+# how the change pass measures a tile's change against the previous frame, in input steps.
+# sad is the mean absolute difference over the tile's pixels and rides out sensor noise,
+# max is the largest single difference and catches small moving objects.
+CHANGE_METRICS = ('sad', 'max')
+DEFAULT_CHANGE_METRIC = 'sad'
+DEFAULT_CHANGE_THRESHOLD = 4.0
+
+
+class ClaheGeometry:
+    def __init__(self, width, height, tile_width=39, tile_height=39, num_bins=256,
+                 bit_depth=DEFAULT_BIT_DEPTH, clip_limit=DEFAULT_CLIP_LIMIT, histogram_stride=1):
+        if tile_width < 1 or tile_height < 1:
+            raise ValueError("tile size must be positive")
+        if num_bins < 2 or num_bins & (num_bins - 1):
+            raise ValueError(f"bin count must be a power of two, not {num_bins}")
+        if not 1 <= bit_depth <= 16:
+            raise ValueError(f"bit depth must be between 1 and 16, not {bit_depth}")
+        if num_bins > 1 << bit_depth:
+            raise ValueError(f"{num_bins} bins is more than the {1 << bit_depth} levels of {bit_depth}-bit input")
+        if not 1 <= histogram_stride <= min(tile_width, tile_height):
+            raise ValueError(f"histogram stride must be between 1 and the tile size, not {histogram_stride}")
+        self.width = width
+        self.height = height
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.num_bins = num_bins
+        self.bit_depth = bit_depth
+        self.clip_limit = clip_limit
+        self.histogram_stride = histogram_stride
+        self.num_tiles_x = math.ceil(width / tile_width)
+        self.num_tiles_y = math.ceil(height / tile_height)
+
+    @property
+    def num_tiles(self):
+        return self.num_tiles_x * self.num_tiles_y
+
+    @property
+    def frame_size(self):
+        # bytes in one GRAY16 input frame
+        return self.width * self.height * 2
+
+    @property
+    def histogram_buffer_size(self):
+        # one uint32 per bin per tile
+        return self.num_tiles * self.num_bins * np.dtype(np.uint32).itemsize
+
+    @property
+    def bin_clip_limit(self):
+        # clip limit for this bin count
+        return max(1, round(self.clip_limit * 256 / self.num_bins))
+
+    @property
+    def bin_image_format(self):
+        # smallest unsigned integer format that holds every bin
+        return 'r8ui' if self.num_bins <= 256 else 'r16ui'
+
+    @property
+    def histogram_samples(self):
+        # samples across and down a tile, one per cell of stride x stride pixels.
+        # every sample counts for the pixels of its cell, so the histograms keep their pixel
+        # totals and the clip limit applies to them unchanged.
+        return math.ceil(self.tile_width / self.histogram_stride), math.ceil(self.tile_height / self.histogram_stride)
+
+    def lut_buffer_size(self, lut_format):
+        # one LUT entry per bin per tile
+        return self.num_tiles * self.num_bins * LUT_FORMATS[lut_format]
+
+    def local_size(self, max_invocations):
+        # largest work group that covers the tile without exceeding the invocation limit.
+        # halve the longer side until it fits, invocations then stride over the tile.
+        return fit_local_size(self.tile_width, self.tile_height, max_invocations)
+
+    def defines(self, max_invocations):
+        local_x, local_y = self.local_size(max_invocations)
+        samples_x, samples_y = self.histogram_samples
+        histogram_x, histogram_y = fit_local_size(samples_x, samples_y, max_invocations)
+        return {
+            'IMAGE_WIDTH': self.width,
+            'IMAGE_HEIGHT': self.height,
+            'TILE_WIDTH': self.tile_width,
+            'TILE_HEIGHT': self.tile_height,
+            'NUM_TILES_X': self.num_tiles_x,
+            'NUM_TILES_Y': self.num_tiles_y,
+            'NUM_BINS': self.num_bins,
+            'INPUT_BIT_DEPTH': self.bit_depth,
+            'CLIP_LIMIT': self.bin_clip_limit,
+            'LOCAL_SIZE_X': local_x,
+            'LOCAL_SIZE_Y': local_y,
+            'LOCAL_SIZE_BINS': min(self.num_bins, max_invocations),
+            'BIN_IMAGE_FORMAT': self.bin_image_format,
+            'HISTOGRAM_STRIDE': self.histogram_stride,
+            'HISTOGRAM_SAMPLES_X': samples_x,
+            'HISTOGRAM_SAMPLES_Y': samples_y,
+            'HISTOGRAM_LOCAL_SIZE_X': histogram_x,
+            'HISTOGRAM_LOCAL_SIZE_Y': histogram_y,
+        }
+
+    def __str__(self):
+        sampling = f", histograms from 1 in {self.histogram_stride ** 2} pixels" if self.histogram_stride > 1 else ""
+        return (f"{self.width}x{self.height}, {self.num_tiles_x}x{self.num_tiles_y} tiles of "
+                f"{self.tile_width}x{self.tile_height}, {self.num_bins} bins of {self.bit_depth}-bit input, "
+                f"clip limit {self.bin_clip_limit}{sampling}")
+
+
+def fit_local_size(width, height, max_invocations):
+    # work group of at most max_invocations over a width x height area, halving the longer side
+    local_x, local_y = width, height
+    while local_x * local_y > max_invocations:
+        if local_x >= local_y:
+            local_x = math.ceil(local_x / 2)
+        else:
+            local_y = math.ceil(local_y / 2)
+    return local_x, local_y
+
+
+def fit_histogram_copies(requested, num_bins, max_shared_bytes):
+    # as many of the requested sub-histogram copies as fit in the work group's shared memory
+    return max(0, min(requested, max_shared_bytes // (num_bins * np.dtype(np.uint32).itemsize)))
+
+
+def lut_defines(lut_format, interpolation=DEFAULT_INTERPOLATION):
+    defines = {f'LUT_FORMAT_{name.upper()}': i for i, name in enumerate(LUT_FORMATS)}
+    defines['LUT_FORMAT'] = defines[f'LUT_FORMAT_{lut_format.upper()}']
+    defines['LUT_TEXTURE'] = interpolation == 'texture'
+    defines['LUT_IMAGE_FORMAT'] = LUT_IMAGE_FORMATS[lut_format]
+    return defines
+
+
+def scaled_output_defines(geometry, output_size=None):
+    # output_size is (width, height) of the display, None to write the output at input size
+    if output_size is None:
+        return {'SCALED_OUTPUT': False}
+    output_width, output_height = output_size
+    return {
+        'SCALED_OUTPUT': True,
+        'OUTPUT_WIDTH': output_width,
+        'OUTPUT_HEIGHT': output_height,
+        'SCALED_LOCAL_SIZE': SCALED_LOCAL_SIZE,
+        # input pixels under a work group's output pixels, plus the right and bottom neighbors
+        'SCALED_INPUT_BLOCK_X': math.ceil(SCALED_LOCAL_SIZE * geometry.width / output_width) + 2,
+        'SCALED_INPUT_BLOCK_Y': math.ceil(SCALED_LOCAL_SIZE * geometry.height / output_height) + 2,
+    }
+
+
+def output_defines(output_format=DEFAULT_OUTPUT_FORMAT):
+    return {'OUTPUT_IMAGE_FORMAT': output_format}
+
+
+def sampling_defines(histogram_sampling=DEFAULT_HISTOGRAM_SAMPLING):
+    defines = {f'HISTOGRAM_SAMPLING_{name.upper()}': i for i, name in enumerate(HISTOGRAM_SAMPLINGS)}
+    defines['HISTOGRAM_SAMPLING'] = defines[f'HISTOGRAM_SAMPLING_{histogram_sampling.upper()}']
+    return defines
+
+
+def change_defines(change_metric):
+    defines = {f'CHANGE_METRIC_{name.upper()}': i for i, name in enumerate(CHANGE_METRICS)}
+    defines['CHANGE_METRIC'] = defines[f'CHANGE_METRIC_{change_metric.upper()}']
+    return defines
+
+
+def format_define(value):
+    # plain literals, so the values also work in #if and layout qualifiers
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return str(value)
+
+
+def inject_defines(source, defines):
+    # insert #defines after the #version line (which has to stay first).
+    # the #line directive keeps compiler errors pointing at the line numbers of the file.
+    lines = source.splitlines()
+    for i, line in enumerate(lines):
+        if line.strip().startswith('#version'):
+            break
+    else:
+        raise ValueError("shader source has no #version line")
+
+    injected = [f'#define {name} {format_define(value)}' for name, value in defines.items()]
+    injected.append(f'#line {i + 2}')
+    return '\n'.join(lines[:i + 1] + injected + lines[i + 1:]) + '\n'
+
+
+def build_shader_source(name, defines, shader_dir=SHADER_DIR):
+    with open(os.path.join(shader_dir, name)) as f:
+        return inject_defines(f.read(), defines)
@@ -0,0 +1,127 @@
+/*
+clahe_change_pass.glsl
+Charles Rothbaum
+PROVUU
+
+Change pass (runs before the first pass with --dirty-tiles):
+
+Spawns a work group for each tile, like the first pass. The invocations compare every input
+sample of the tile with the same sample of the reference frame. The tile is dirty when its change
+is above changeThreshold, in input sample steps:
+
+  CHANGE_METRIC_SAD   sum of absolute differences, per pixel of the tile
+  CHANGE_METRIC_MAX   largest absolute difference
+
+The sum of a large tile does not fit in 32 bits (65537 pixels of 16-bit samples already wrap),
+so the work group adds it up in 64 bits, as a low word and a carry count. Each invocation's own
+sum stays in a uint, ChangeDetector rejects the tile sizes where even that could wrap.
+
+Only dirty tiles are copied into the reference frame, as the frame their LUTs were computed
+from. A clean tile keeps its old reference, so a slow drift adds up over the frames until it
+crosses the threshold, instead of being compared away one small step at a time.
+
+Dirty tiles are appended to a compacted list that starts with the work group counts of
+glDispatchComputeIndirect, so the first and second pass run on the dirty tiles only and the
+clean tiles keep their LUTs. The third pass reads the per-tile flags to know which tiles the
+first pass binned. forceDirty marks every tile, for the first frame.
+*/
+
+#version 430
+
+#ifndef NUM_BINS
+#error "build this shader with shader_build.py, it defines the frame and tile geometry"
+#endif
+
+layout(local_size_x = LOCAL_SIZE_X, local_size_y = LOCAL_SIZE_Y) in;
+
+layout(binding = 0, r16ui) readonly uniform uimage2D inputImage;
+layout(binding = 2, r16ui) uniform uimage2D previousFrame;
+
+layout(std430, binding = 5) buffer DirtyTiles {
+    uint numGroupsX;    // indirect dispatch arguments, numGroupsX is the dirty tile count
+    uint numGroupsY;
+    uint numGroupsZ;
+    uint tiles[NUM_TILES_X * NUM_TILES_Y];
+    uint dirty[NUM_TILES_X * NUM_TILES_Y];
+};
+
+uniform float changeThreshold = 4.0;
+uniform bool forceDirty = false;
+
+shared uint change;
+shared uint changeCarry;   // SAD: times the sum in change wrapped around
+shared uint pixels;
+shared bool tileDirty;
+
+void main() {
+    if (gl_LocalInvocationIndex == 0u) {
+        change = 0u;
+        changeCarry = 0u;
+        pixels = 0u;
+    }
+    barrier();
+
+    uint tileIndex = gl_WorkGroupID.y * uint(NUM_TILES_X) + gl_WorkGroupID.x;
+    ivec2 tileOrigin = ivec2(gl_WorkGroupID.xy) * ivec2(TILE_WIDTH, TILE_HEIGHT);
+
+    uint localChange = 0u;
+    uint localPixels = 0u;
+    for (int y = int(gl_LocalInvocationID.y); y < TILE_HEIGHT; y += LOCAL_SIZE_Y) {
+        for (int x = int(gl_LocalInvocationID.x); x < TILE_WIDTH; x += LOCAL_SIZE_X) {
+            ivec2 pos = tileOrigin + ivec2(x, y);
+            if (pos.x >= IMAGE_WIDTH || pos.y >= IMAGE_HEIGHT) {
+                continue; // edge tiles hang over the image
+            }
+
+            uint current = imageLoad(inputImage, pos).r;
+            uint previous = imageLoad(previousFrame, pos).r;
+            uint difference = max(current, previous) - min(current, previous);
+#if CHANGE_METRIC == CHANGE_METRIC_MAX
+            localChange = max(localChange, difference);
+#else
+            localChange += difference;
+#endif
+            localPixels++;
+        }
+    }
+
+    // one shared atomic per invocation rather than per pixel
+#if CHANGE_METRIC == CHANGE_METRIC_MAX
+    atomicMax(change, localChange);
+#else
+    uint previousChange = atomicAdd(change, localChange);
+    if (previousChange + localChange < previousChange) {
+        atomicAdd(changeCarry, 1u);
+    }
+#endif
+    atomicAdd(pixels, localPixels);
+    barrier();
+
+    if (gl_LocalInvocationIndex == 0u) {
+#if CHANGE_METRIC == CHANGE_METRIC_MAX
+        float tileChange = float(change);
+#else
+        float tileChange = (float(changeCarry) * 4294967296.0 + float(change)) / float(max(pixels, 1u));
+#endif
+        tileDirty = forceDirty || tileChange > changeThreshold;
+        dirty[tileIndex] = tileDirty ? 1u : 0u;
+        if (tileDirty) {
+            tiles[atomicAdd(numGroupsX, 1u)] = tileIndex;
+        }
+    }
+    barrier();
+
+    // the dirty tile becomes the reference for the next comparisons
+    if (!tileDirty) {
+        return;
+    }
+    for (int y = int(gl_LocalInvocationID.y); y < TILE_HEIGHT; y += LOCAL_SIZE_Y) {
+        for (int x = int(gl_LocalInvocationID.x); x < TILE_WIDTH; x += LOCAL_SIZE_X) {
+            ivec2 pos = tileOrigin + ivec2(x, y);
+            if (pos.x >= IMAGE_WIDTH || pos.y >= IMAGE_HEIGHT) {
+                continue;
+            }
+            imageStore(previousFrame, pos, imageLoad(inputImage, pos));
+        }
+    }
+}
@@ -5,43 +5,192 @@ PROVUU
 
 First pass:
 
-Spawns a work group of 1521 parallel threads that read the intensity value 
-of each pixel in a 39x39 tile and compute the histogram of the tile.
+Spawns a work group for each tile of the image. The invocations of the work group read the 
+intensity value of each pixel in the tile and compute the histogram of the tile. When the tile
+has more pixels than the work group has invocations, each invocation strides over several pixels.
 
-Each work group saves the histogram to the corresponding index in the shared 
-histograms buffer, and also saves the computed bin for each pixel in the shared
-image buffer.
+The histogram is built in shared memory, split into HISTOGRAM_COPIES sub-histograms that
+the invocations are spread over, so that invocations hitting the same bin (low contrast
+tiles) contend on fewer atomics. Once the tile is done the copies are summed and the work
+group writes its histogram to the corresponding index in the shared histograms buffer, one
+store per bin. HISTOGRAM_COPIES = 0 skips shared memory and increments the buffer directly
+with global atomics, after the work group has zeroed its tile's histogram. Either way a work
+group only ever touches its own tile, so the buffer needs no clearing between frames and tiles
+that are not dispatched (temporal mode, dirty tiles) cost nothing.
+
+The input samples are read as integers from the r16ui input image, and the computed bin of
+each pixel is saved in the bin image (r8ui up to 256 bins, r16ui above, BIN_IMAGE_FORMAT) for
+the third pass. The input is never written, so the next frame can be uploaded while the third
+pass or the presentation of this frame still read from their own images.
+
+With HISTOGRAM_STRIDE above 1 the histograms are estimated from a subsample of the tile: the
+tile is split into cells of HISTOGRAM_STRIDE x HISTOGRAM_STRIDE pixels and one pixel of each cell
+is counted, for as many pixels as the cell has (edge cells are smaller). The histogram totals
+stay the tile's pixel count, so the clip limit of the second pass keeps its meaning. The
+pixel is the cell's center with HISTOGRAM_SAMPLING_REGULAR, or one picked by a hash of the
+cell's position with HISTOGRAM_SAMPLING_JITTERED. The work group then spans the samples of a
+tile (HISTOGRAM_LOCAL_SIZE_X x _Y) and no bins are stored, the third pass bins every pixel itself.
+
+With FRAME_ARRAY the images are 2D arrays holding a frame per layer, and the dispatch covers the
+frames in z: gl_WorkGroupID.z is the layer, and each frame has its own NUM_TILES_X * NUM_TILES_Y
+histograms in the buffer, one after the other.
+
+The frame and tile geometry (IMAGE_WIDTH, TILE_WIDTH, NUM_TILES_X, NUM_BINS, LOCAL_SIZE_X, ...)
+is defined by shader_build.py when the shader is built.
+
+The dispatch may cover only some of the tile rows, starting at firstTileRow and wrapping around
+the bottom of the image (temporal mode recomputes a rotating subset of rows each frame).
+With DIRTY_TILES it is an indirect dispatch over the tiles the change pass found dirty, one
+work group per entry of the dirty tile list.
 */
 
 #version 430
 
-layout(local_size_x = 39, local_size_y = 39) in;
+#ifndef NUM_BINS
+#error "build this shader with shader_build.py, it defines the frame and tile geometry"
+#endif
+
+layout(local_size_x = HISTOGRAM_LOCAL_SIZE_X, local_size_y = HISTOGRAM_LOCAL_SIZE_Y) in;
 
-layout(binding = 0, r16) uniform image2D img;
+#if FRAME_ARRAY
+layout(binding = 0, r16ui) readonly uniform uimage2DArray inputImage;
+#if HISTOGRAM_STRIDE == 1
+layout(binding = 3, BIN_IMAGE_FORMAT) writeonly uniform uimage2DArray binImage;
+#endif
+// position of a pixel in the frame's layer
+#define FRAME_POSITION(pos) ivec3(pos, gl_WorkGroupID.z)
+#else
+layout(binding = 0, r16ui) readonly uniform uimage2D inputImage;
+#if HISTOGRAM_STRIDE == 1
+layout(binding = 3, BIN_IMAGE_FORMAT) writeonly uniform uimage2D binImage;
+#endif
+#define FRAME_POSITION(pos) (pos)
+#endif
 
 layout(std430, binding = 1) buffer HistogramBuffer {
     uint histograms[];
 };
 
-const uint numBins = 256u;
+#if DIRTY_TILES
+layout(std430, binding = 5) readonly buffer DirtyTiles {
+    uint numGroups[3];
+    uint tiles[NUM_TILES_X * NUM_TILES_Y];
+    uint dirty[NUM_TILES_X * NUM_TILES_Y];
+};
+#endif
+
+#ifndef HISTOGRAM_COPIES
+#define HISTOGRAM_COPIES 0
+#endif
+
+const uint numBins = uint(NUM_BINS);
+const uint localSize = uint(HISTOGRAM_LOCAL_SIZE_X * HISTOGRAM_LOCAL_SIZE_Y);
 uniform uint clipLimit = 10u;
+uniform uint firstTileRow = 0u;
+
+#if HISTOGRAM_COPIES > 0
+shared uint localHistograms[HISTOGRAM_COPIES * NUM_BINS];
+#endif
 
-uint numTilesX = 33;
+#if HISTOGRAM_STRIDE > 1
+// pixel of a cell the histogram sample is taken from, as an offset into the cell
+ivec2 sampleOffset(ivec2 cell, ivec2 cellSize) {
+#if HISTOGRAM_SAMPLING == HISTOGRAM_SAMPLING_JITTERED
+    // integer hash of the cell position (lowbias32), the same pixel every frame
+    uint h = uint(cell.y) * 65536u + uint(cell.x);
+    h ^= h >> 16;
+    h *= 0x7feb352du;
+    h ^= h >> 15;
+    h *= 0x846ca68bu;
+    h ^= h >> 16;
+    return ivec2(int(h & 0xffffu) % cellSize.x, int(h >> 16) % cellSize.y);
+#else
+    return cellSize / 2;
+#endif
+}
+#endif
 
 void main() {
+#if DIRTY_TILES
+    // indirect dispatch over the dirty tiles only
+    uint tileIndex = tiles[gl_WorkGroupID.x];
+    uint tileX = tileIndex % uint(NUM_TILES_X);
+    uint tileY = tileIndex / uint(NUM_TILES_X);
+#else
     uint tileX = gl_WorkGroupID.x;
-    uint tileY = gl_WorkGroupID.y;
-    uint tileIndex = tileY * numTilesX + tileX;
+    uint tileY = (firstTileRow + gl_WorkGroupID.y) % uint(NUM_TILES_Y);
+    uint tileIndex = tileY * uint(NUM_TILES_X) + tileX;
+#endif
+    ivec2 tileOrigin = ivec2(tileX, tileY) * ivec2(TILE_WIDTH, TILE_HEIGHT);
+    // the frame's histograms follow those of the frames in the layers before it
+    uint histogramBase = (gl_WorkGroupID.z * uint(NUM_TILES_X * NUM_TILES_Y) + tileIndex) * numBins;
+
+#if HISTOGRAM_COPIES > 0
+    for (uint i = gl_LocalInvocationIndex; i < uint(HISTOGRAM_COPIES) * numBins; i += localSize) {
+        localHistograms[i] = 0u;
+    }
+    barrier();
+
+    // neighbouring invocations see similar intensities, so they go to different copies
+    uint copyOffset = (gl_LocalInvocationIndex % uint(HISTOGRAM_COPIES)) * numBins;
+#else
+    // zero the tile's histogram before accumulating into it
+    for (uint i = gl_LocalInvocationIndex; i < numBins; i += localSize) {
+        histograms[histogramBase + i] = 0u;
+    }
+    memoryBarrierBuffer();
+    barrier();
+#endif
+
+    for (int y = int(gl_LocalInvocationID.y); y < HISTOGRAM_SAMPLES_Y; y += HISTOGRAM_LOCAL_SIZE_Y) {
+        for (int x = int(gl_LocalInvocationID.x); x < HISTOGRAM_SAMPLES_X; x += HISTOGRAM_LOCAL_SIZE_X) {
+#if HISTOGRAM_STRIDE > 1
+            // the cell, cut to the tile and the image, and the pixel sampled in it
+            ivec2 cell = tileOrigin + ivec2(x, y) * HISTOGRAM_STRIDE;
+            ivec2 cellEnd = min(min(cell + HISTOGRAM_STRIDE, tileOrigin + ivec2(TILE_WIDTH, TILE_HEIGHT)),
+                                ivec2(IMAGE_WIDTH, IMAGE_HEIGHT));
+            ivec2 cellSize = cellEnd - cell;
+            if (cellSize.x <= 0 || cellSize.y <= 0) {
+                continue; // edge tiles hang over the image
+            }
+            ivec2 pos = cell + sampleOffset(cell, cellSize);
+            uint weight = uint(cellSize.x * cellSize.y);
+#else
+            ivec2 pos = tileOrigin + ivec2(x, y);
+            if (pos.x >= IMAGE_WIDTH || pos.y >= IMAGE_HEIGHT) {
+                continue; // edge tiles hang over the image
+            }
+            const uint weight = 1u;
+#endif
+
+            uint intensity = imageLoad(inputImage, FRAME_POSITION(pos)).r; // INPUT_BIT_DEPTH significant bits
+
+            uint bin = (intensity * numBins) >> uint(INPUT_BIT_DEPTH); // range [0 - numBins]
+            bin = min(bin, numBins - 1u); // samples above the bit depth (test sources use the full 16 bit range) go to the top bin
 
-    ivec2 pos = ivec2(gl_GlobalInvocationID.xy);
-    float intensity = imageLoad(img, pos).r; // range [0.0 - 0.015625]
-    uint uint_scaled_intensity = uint(intensity  * 65535.0); // range [0 - 1023]
+#if HISTOGRAM_COPIES > 0
+            atomicAdd(localHistograms[copyOffset + bin], weight); //increment histogram for the bin.
+#else
+            atomicAdd(histograms[histogramBase + bin], weight); //increment histogram for the bin.
+#endif
 
-    uint bin = (uint_scaled_intensity * numBins) / 1024u; // range [0 - 256]
+#if HISTOGRAM_STRIDE == 1
+            // store bin for each pixel so they can be retrieved in the 3rd pass.
+            imageStore(binImage, FRAME_POSITION(pos), uvec4(bin, 0u, 0u, 0u));
+#endif
+        }
+    }
 
-    atomicAdd(histograms[tileIndex * numBins + bin], 1u); //increment histogram for the bin.
+#if HISTOGRAM_COPIES > 0
+    barrier();
 
-    // store bin for each pixel so they can be retrieved in the 3rd pass.
-    float float_bin = float(bin) / numBins; // have to make bin fractional so that it fits in r16 image buffer.
-    imageStore(img, pos, vec4(float_bin, 0.0, 0.0, 1.0));
+    // sum the copies and flush the tile histogram to the buffer
+    for (uint i = gl_LocalInvocationIndex; i < numBins; i += localSize) {
+        uint count = 0u;
+        for (uint c = 0u; c < uint(HISTOGRAM_COPIES); c++) {
+            count += localHistograms[c * numBins + i];
+        }
+        histograms[histogramBase + i] = count;
+    }
+#endif
 }
@@ -5,56 +5,225 @@ PROVUU
 
 Second pass:
 
-spawms 256 parallel threads to span the histograms buffer object, and compute the clip limit
+spawns LOCAL_SIZE_BINS parallel threads per tile to span the histograms buffer object (each thread
+takes several bins when NUM_BINS is above the GPU's work group limit), and compute the clip limit
 for each bin in the histograms buffer, and redistributes the clipped values evenly across
-the histogram.
+the histogram. What does not divide evenly is handed out one pixel each to evenly spaced bins.
 
-One thread is delegated to finally compute the cdf for the histogram, overwriting the histograms
-buffer with the cdf values.
+The clipped histogram is then turned into the cdf with a work-efficient (Blelloch) scan in 
+shared memory: an up-sweep builds partial sums in a tree, a down-sweep turns them into the
+exclusive prefix sum, shifted by one bin that is the inclusive cdf, which is written back over
+the histograms buffer. NUM_BINS has to be a power of two.
+
+Finally the cdf is divided by the tile's pixel count once per bin, and stored as the tile's
+normalized equalization LUT in the LUT buffer, in the format selected by LUT_FORMAT.
+uint16 and half entries are packed two per uint, so the third pass only needs a fetch per tile.
+With LUT_TEXTURE the LUTs go to a 3D texture instead (x, y = tile, z = bin, in the image format
+LUT_IMAGE_FORMAT), which the third pass samples with hardware bilinear filtering.
+
+With TEMPORAL the normalized cdf is blended into the tile's previous one (kept in the temporal
+buffer) with an exponential moving average, weight temporalAlpha for the new cdf. The mean
+absolute difference between the new and the previous cdf measures how much the tile changed.
+Above sceneCutDistance the tile takes the new cdf as is and is counted in the scene buffer
+slot sceneSlot, so the host can detect a scene cut and refresh every tile. Like the first pass,
+the dispatch may cover only the tile rows from firstTileRow on. With DIRTY_TILES it covers
+the dirty tile list of the change pass, and the LUTs of the clean tiles are left as they are.
+
+With FRAME_ARRAY the dispatch covers several frames in z, each with its own histograms and LUTs
+one after the other in the buffers (the LUT texture holds a single frame).
 */
 
 #version 430
 
-layout(local_size_x = 16, local_size_y = 16) in;
+#ifndef NUM_BINS
+#error "build this shader with shader_build.py, it defines the frame and tile geometry"
+#endif
+
+#if (NUM_BINS & (NUM_BINS - 1)) != 0
+#error "the cdf scan needs a power of two NUM_BINS"
+#endif
+
+#if FRAME_ARRAY && LUT_TEXTURE
+#error "the LUT texture holds the LUTs of a single frame"
+#endif
+
+layout(local_size_x = LOCAL_SIZE_BINS) in;
 
 layout(std430, binding = 1) buffer HistogramBuffer {
     uint histograms[];
 };
 
-const uint numBins = 256u;
-uniform uint clipLimit = 40u;
-uint numTilesX = 33;
-uint numTilesY = 19;
+#if LUT_TEXTURE
+layout(binding = 1, LUT_IMAGE_FORMAT) writeonly uniform image3D lutImage;
+#else
+layout(std430, binding = 2) writeonly buffer LutBuffer {
+    uint luts[];
+};
+#endif
+
+#if DIRTY_TILES
+layout(std430, binding = 5) readonly buffer DirtyTiles {
+    uint numGroups[3];
+    uint tiles[NUM_TILES_X * NUM_TILES_Y];
+    uint dirty[NUM_TILES_X * NUM_TILES_Y];
+};
+#endif
+
+#if TEMPORAL
+layout(std430, binding = 3) buffer TemporalBuffer {
+    float smoothed[];
+};
+
+layout(std430, binding = 4) buffer SceneBuffer {
+    uint changedTiles[];
+};
+#endif
+
+const uint numBins = uint(NUM_BINS);
+const uint localSize = uint(LOCAL_SIZE_BINS);
+uniform uint clipLimit = uint(CLIP_LIMIT);
+uniform uint firstTileRow = 0u;
 shared uint excess_values;
+shared uint total;
+shared uint cdf[NUM_BINS];
+
+#if TEMPORAL
+uniform float temporalAlpha = 1.0;
+uniform float sceneCutDistance = 0.1;
+uniform uint sceneSlot = 0u;
+shared uint distance;
+#endif
+
+// inclusive cdf of a bin, from the exclusive scan in cdf[]
+uint inclusiveCdf(uint bin) {
+    return bin + 1u < numBins ? cdf[bin + 1u] : total;
+}
 
 void main() {
-    if(gl_LocalInvocationIndex == 0){
+    if(gl_LocalInvocationIndex == 0u){
         excess_values = 0u;
+#if TEMPORAL
+        distance = 0u;
+#endif
     }
+    barrier();
 
+#if DIRTY_TILES
+    // indirect dispatch over the dirty tiles only
+    uint tileIndex = tiles[gl_WorkGroupID.x];
+    uint tileX = tileIndex % uint(NUM_TILES_X);
+    uint tileY = tileIndex / uint(NUM_TILES_X);
+#else
     uint tileX = gl_WorkGroupID.x;
-    uint tileY = gl_WorkGroupID.y;
-    uint tileIndex = tileY * numTilesX + tileX;
-    uint num_bins_at_index = histograms[tileIndex * 256 + gl_LocalInvocationIndex];
+    uint tileY = (firstTileRow + gl_WorkGroupID.y) % uint(NUM_TILES_Y);
+    uint tileIndex = tileY * uint(NUM_TILES_X) + tileX;
+#endif
+    // the frame's tiles follow those of the frames in the layers before it
+    uint tileBase = (gl_WorkGroupID.z * uint(NUM_TILES_X * NUM_TILES_Y) + tileIndex) * numBins;
 
     // clip histogram where it exceeds clipLimit
     // keep track of excess values for later.
-    if(num_bins_at_index > clipLimit){
-        histograms[tileIndex * 256 + gl_LocalInvocationIndex] = clipLimit;
-        atomicAdd(excess_values, (num_bins_at_index - clipLimit));
+    for (uint bin = gl_LocalInvocationIndex; bin < numBins; bin += localSize) {
+        uint num_bins_at_index = histograms[tileBase + bin];
+        if(num_bins_at_index > clipLimit){
+            atomicAdd(excess_values, (num_bins_at_index - clipLimit));
+            num_bins_at_index = clipLimit;
+        }
+        cdf[bin] = num_bins_at_index;
+    }
+
+    barrier(); //make sure every thread has added its excess before it is redistributed
+
+    // distribute clipped value excess across all bins uniformly, and the remainder
+    // one each to every residualStep-th bin
+    uint share = excess_values / numBins;
+    uint residual = excess_values % numBins;
+    uint residualStep = max(numBins / max(residual, 1u), 1u);
+    for (uint bin = gl_LocalInvocationIndex; bin < numBins; bin += localSize) {
+        bool extra = bin % residualStep == 0u && bin / residualStep < residual;
+        cdf[bin] += share + (extra ? 1u : 0u);
     }
+    barrier();
 
-    // distribute clipped value excess across all bins uniformly
-    atomicAdd(histograms[tileIndex * 256 + gl_LocalInvocationIndex], uint(excess_values / numBins));
+    // up-sweep: after the step with stride `offset` every (2 * offset)th element holds
+    // the sum of the 2 * offset elements ending at it
+    for (uint offset = 1u; offset < numBins; offset <<= 1u) {
+        for (uint i = gl_LocalInvocationIndex; i < numBins / (2u * offset); i += localSize) {
+            uint index = (i + 1u) * offset * 2u - 1u;
+            cdf[index] += cdf[index - offset];
+        }
+        barrier();
+    }
 
-    barrier(); //make sure all threads are finished before thread 0 computes the cdf
+    // keep the total, clear it and push the partial sums back down the tree
+    if (gl_LocalInvocationIndex == 0u) {
+        total = cdf[numBins - 1u];
+        cdf[numBins - 1u] = 0u;
+    }
+    barrier();
 
-    //compute cdf
-    if (gl_LocalInvocationIndex == 0){
-        uint sum = 0u;
-        for(uint i = 0u; i < numBins; i++){
-            sum += histograms[tileIndex * 256 + i];
-            histograms[tileIndex * 256 + i] = sum;
+    for (uint offset = numBins >> 1u; offset > 0u; offset >>= 1u) {
+        for (uint i = gl_LocalInvocationIndex; i < numBins / (2u * offset); i += localSize) {
+            uint index = (i + 1u) * offset * 2u - 1u;
+            uint temp = cdf[index - offset];
+            cdf[index - offset] = cdf[index];
+            cdf[index] += temp;
         }
+        barrier();
+    }
+
+    // store the cdf, normalize it by the total pixel count and store the LUT
+    float scale = 1.0 / float(max(total, 1u));
+
+#if TEMPORAL
+    // how far the cdf moved since the last time, in 1/65535 steps
+    for (uint bin = gl_LocalInvocationIndex; bin < numBins; bin += localSize) {
+        float difference = abs(float(inclusiveCdf(bin)) * scale - smoothed[tileBase + bin]);
+        atomicAdd(distance, uint(difference * 65535.0 + 0.5));
+    }
+    barrier();
+
+    // a tile that changed too much starts over from the new cdf
+    bool cut = float(distance) / (65535.0 * float(numBins)) > sceneCutDistance;
+    float alpha = cut ? 1.0 : temporalAlpha;
+    if (cut && gl_LocalInvocationIndex == 0u) {
+        atomicAdd(changedTiles[sceneSlot], 1u);
+    }
+#endif
+
+    for (uint bin = gl_LocalInvocationIndex; bin < numBins; bin += localSize) {
+        uint inclusive = inclusiveCdf(bin);
+        histograms[tileBase + bin] = inclusive;
+        float value = float(inclusive) * scale;
+#if TEMPORAL
+        value = mix(smoothed[tileBase + bin], value, alpha);
+        smoothed[tileBase + bin] = value;
+#endif
+#if LUT_TEXTURE
+        imageStore(lutImage, ivec3(tileX, tileY, bin), vec4(value, 0.0, 0.0, 1.0));
+#elif LUT_FORMAT == LUT_FORMAT_FLOAT
+        luts[tileBase + bin] = floatBitsToUint(value);
+#endif
+    }
+
+#if !LUT_TEXTURE && LUT_FORMAT != LUT_FORMAT_FLOAT
+#if TEMPORAL
+    memoryBarrierBuffer();
+    barrier(); //the smoothed values of the neighboring bin come from another thread
+#endif
+    // two bins packed into one uint
+    for (uint pair = gl_LocalInvocationIndex; pair < numBins / 2u; pair += localSize) {
+        uint bin = pair * 2u;
+#if TEMPORAL
+        vec2 values = vec2(smoothed[tileBase + bin], smoothed[tileBase + bin + 1u]);
+#else
+        vec2 values = vec2(float(inclusiveCdf(bin)), float(inclusiveCdf(bin + 1u))) * scale;
+#endif
+#if LUT_FORMAT == LUT_FORMAT_HALF
+        luts[(tileBase + bin) >> 1u] = packHalf2x16(values);
+#else
+        luts[(tileBase + bin) >> 1u] = packUnorm2x16(values);
+#endif
     }
+#endif
 }
@@ -5,48 +5,164 @@ PROVUU
 
 Third pass:
 
-spawns work group of 1521 threads that access the stored bin values for each pixel in the 
-image buffer, and the cdf functions for each tile in the histograms buffer. The uses
-bilinear interpolation to finally compute the equalized intensity for each pixel, and writes
-the equalized intensities to the image buffer.
+spawns a work group per tile whose threads access the stored bin values for each pixel in the 
+bin image, and the normalized LUTs the second pass computed for each tile in the LUT buffer. 
+The uses bilinear interpolation to finally compute the equalized intensity for each pixel, and
+writes the equalized intensities to the output image (OUTPUT_IMAGE_FORMAT, presented by the
+scaling stage). The intensity goes to every color channel, so an rgba output is grey when it is
+blitted to the screen without the red swizzle of texture sampling.
+
+Each tile's LUT applies in full at the tile's center, pixels between tile centers blend the LUTs
+of the four surrounding tiles, and pixels outside the outermost centers use the nearest tiles.
+With LUT_TEXTURE the LUTs are a 3D texture (x, y = tile, z = bin) and one GL_LINEAR sample at
+the pixel's position in tile space, on the bin's texel center, lets the texture unit do the
+blend. Otherwise the four LUT values are fetched from the LUT buffer and blended in the shader.
+
+With TEMPORAL the first pass may have skipped some tile rows this frame (see firstTileRow and
+tileRowCount), and with DIRTY_TILES the tiles the change pass found clean. Their bins in the bin
+image are from an older frame, so those pixels are binned here from the input image. With
+HISTOGRAM_STRIDE above 1 the first pass only looked at a subsample of the pixels and stores no
+bins, every pixel is binned here.
+
+With SCALED_OUTPUT the pass also does the scaling to the display: it runs one invocation per
+pixel of the OUTPUT_WIDTH x OUTPUT_HEIGHT presentable texture, equalizes the four input pixels
+around it and blends them bilinearly, like GL_LINEAR sampling of the equalized frame did but
+without rounding the equalized frame to 16 bits first. Each work group first equalizes the
+input pixels under its block of output pixels into shared memory (SCALED_INPUT_BLOCK_X x
+SCALED_INPUT_BLOCK_Y), so no input pixel is equalized more than once per block. The equalized frame is never written at
+input resolution and there is no scaling draw.
+
+With FRAME_ARRAY the images are 2D arrays holding a frame per layer, gl_WorkGroupID.z is the
+layer, and each frame's LUTs follow those of the frames before it in the LUT buffer.
 */
 
 #version 430
 
-layout(local_size_x = 39, local_size_y = 39) in;
+#ifndef NUM_BINS
+#error "build this shader with shader_build.py, it defines the frame and tile geometry"
+#endif
+
+#if SCALED_OUTPUT
+layout(local_size_x = SCALED_LOCAL_SIZE, local_size_y = SCALED_LOCAL_SIZE) in;
+#else
+layout(local_size_x = LOCAL_SIZE_X, local_size_y = LOCAL_SIZE_Y) in;
+#endif
+
+#if FRAME_ARRAY
+layout(binding = 0, r16ui) readonly uniform uimage2DArray inputImage;
+#if HISTOGRAM_STRIDE == 1
+layout(binding = 3, BIN_IMAGE_FORMAT) readonly uniform uimage2DArray binImage;
+#endif
+layout(binding = 4, OUTPUT_IMAGE_FORMAT) writeonly uniform image2DArray outputImage;
+// position of a pixel in the frame's layer
+#define FRAME_POSITION(pos) ivec3(pos, gl_WorkGroupID.z)
+#else
+layout(binding = 0, r16ui) readonly uniform uimage2D inputImage;
+#if HISTOGRAM_STRIDE == 1
+layout(binding = 3, BIN_IMAGE_FORMAT) readonly uniform uimage2D binImage;
+#endif
+layout(binding = 4, OUTPUT_IMAGE_FORMAT) writeonly uniform image2D outputImage;
+#define FRAME_POSITION(pos) (pos)
+#endif
+
+#if LUT_TEXTURE
+layout(binding = 1) uniform sampler3D lutTexture;
+#else
+layout(std430, binding = 2) readonly buffer LutBuffer {
+    uint luts[];
+};
+#endif
+
+const uint numBins = uint(NUM_BINS);
+const uint numTilesX = uint(NUM_TILES_X);
+const uint numTilesY = uint(NUM_TILES_Y);
+const vec2 inverseTileSize = 1.0 / vec2(TILE_WIDTH, TILE_HEIGHT);
+#if SCALED_OUTPUT
+const vec2 inputScale = vec2(IMAGE_WIDTH, IMAGE_HEIGHT) / vec2(OUTPUT_WIDTH, OUTPUT_HEIGHT);
+#endif
+
+#if DIRTY_TILES
+layout(std430, binding = 5) readonly buffer DirtyTiles {
+    uint numGroups[3];
+    uint tiles[NUM_TILES_X * NUM_TILES_Y];
+    uint dirty[NUM_TILES_X * NUM_TILES_Y];
+};
+#endif
 
-layout(binding = 0, r16) uniform image2D img;
+#if TEMPORAL
+uniform uint firstTileRow = 0u;
+uniform uint tileRowCount = uint(NUM_TILES_Y);
+#endif
 
-layout(std430, binding = 1) buffer HistogramBuffer {
-    uint histograms[];
-};
+// histogram bin of an input sample, as in the first pass
+uint sampleBin(ivec2 pos) {
+    return min((imageLoad(inputImage, FRAME_POSITION(pos)).r * numBins) >> uint(INPUT_BIT_DEPTH), numBins - 1u);
+}
 
-const uint numBins = 256u;
-const uint numTilesX = 33u;
-const uint numTilesY = 18u;
-const uint tileWidth = 39u;
-const uint tileHeight = 39u;
+// histogram bin of a pixel
+uint pixelBin(ivec2 pos) {
+#if HISTOGRAM_STRIDE > 1
+    // the first pass only binned its samples
+    return sampleBin(pos);
+#else
+#if TEMPORAL
+    // tile rows the first pass skipped
+    uint tileRow = uint(pos.y) / uint(TILE_HEIGHT);
+    if ((tileRow + numTilesY - firstTileRow) % numTilesY >= tileRowCount) {
+        return sampleBin(pos);
+    }
+#endif
+#if DIRTY_TILES
+    // clean tiles
+    uvec2 tile = uvec2(pos) / uvec2(TILE_WIDTH, TILE_HEIGHT);
+    if (dirty[tile.y * numTilesX + tile.x] == 0u) {
+        return sampleBin(pos);
+    }
+#endif
+    // stored by the first pass
+    return imageLoad(binImage, FRAME_POSITION(pos)).r;
+#endif
+}
 
-void main() {
-    ivec2 imgSize = imageSize(img);
-    ivec2 pos = ivec2(gl_GlobalInvocationID.xy);
+#if LUT_TEXTURE
+float equalize(ivec2 pos) {
+    // retrieve saved bins for each pixel from image buffer
+    uint bin = pixelBin(pos);
 
-    uint tileX = pos.x / tileWidth;
-    uint tileY = pos.y / tileHeight;
+    // position in tile space, tile centers sit on texel centers. clamp to edge covers the border.
+    vec2 tilePosition = (vec2(pos) + 0.5) * inverseTileSize / vec2(numTilesX, numTilesY);
+    return texture(lutTexture, vec3(tilePosition, (float(bin) + 0.5) / float(numBins))).r;
+}
+#else
+// normalized LUT value of a bin, unpacked from the format the second pass wrote it in
+float lut(uint tileIndex, uint bin) {
+    uint index = (gl_WorkGroupID.z * numTilesX * numTilesY + tileIndex) * numBins + bin;
+#if LUT_FORMAT == LUT_FORMAT_FLOAT
+    return uintBitsToFloat(luts[index]);
+#else
+#if LUT_FORMAT == LUT_FORMAT_HALF
+    vec2 pair = unpackHalf2x16(luts[index >> 1u]);
+#else
+    vec2 pair = unpackUnorm2x16(luts[index >> 1u]);
+#endif
+    return (bin & 1u) == 0u ? pair.x : pair.y;
+#endif
+}
 
-    // Calculate relative position within the tile as fraction
-    float fx = float(pos.x % tileWidth) / float(tileWidth);
-    float fy = float(pos.y % tileHeight) / float(tileHeight);
+float equalize(ivec2 pos) {
+    // position in tile space with the tile centers on integers, clamped to the outermost centers
+    vec2 tilePosition = clamp((vec2(pos) + 0.5) * inverseTileSize - 0.5,
+                              vec2(0.0), vec2(numTilesX - 1u, numTilesY - 1u));
+    uint tileX = uint(tilePosition.x);
+    uint tileY = uint(tilePosition.y);
 
-    // interpolation weights
-    float top_left_weight = (1.0 - fx) * (1.0 - fy);
-    float top_right_weight = fx * (1.0 - fy);
-    float bottom_left_weight = (1.0 - fx) * fy;
-    float bottom_right_weight = fx * fy;
+    // relative position between the tile centers as fraction
+    float fx = fract(tilePosition.x);
+    float fy = fract(tilePosition.y);
 
-    // next-neighbor tile indices
-    uint tileX1 = tileX + 1u;
-    uint tileY1 = tileY + 1u;
+    // next-neighbor tile indices (the last row and column of tiles have no next neighbor)
+    uint tileX1 = min(tileX + 1u, numTilesX - 1u);
+    uint tileY1 = min(tileY + 1u, numTilesY - 1u);
 
     // tile indices for the four neighboring tiles
     uint tile_idx_top_left = tileY * numTilesX + tileX;
@@ -55,30 +171,77 @@ void main() {
     uint tile_idx_bottom_right = tileY1 * numTilesX + tileX1;
 
     // retrieve saved bins for each pixel from image buffer
-    uint bin = uint(imageLoad(img, pos).r * 255.0);
-
-    // Fetch CDF value at current pixel bin for adjacent tiles
-    uint cdf_top_left = histograms[tile_idx_top_left * numBins + bin];
-    uint cdf_top_right = histograms[tile_idx_top_right * numBins + bin];
-    uint cdf_bottom_left = histograms[tile_idx_bottom_left * numBins + bin];
-    uint cdf_bottom_right = histograms[tile_idx_bottom_right * numBins + bin];
-
-    // Fetch the total number of pixels (last CDF value) for normalization
-    uint cdf_max_top_left = histograms[tile_idx_top_left * numBins + numBins - 1u];
-    uint cdf_max_top_right = histograms[tile_idx_top_right * numBins + numBins - 1u];
-    uint cdf_max_bottom_left = histograms[tile_idx_bottom_left * numBins + numBins - 1u];
-    uint cdf_max_bottom_right = histograms[tile_idx_bottom_right * numBins + numBins - 1u];
-
-    // Normalize CDF values to [0,1]
-    float normal_cdf_top_left = float(cdf_top_left) / float(cdf_max_top_left);
-    float normal_cdf_top_right = float(cdf_top_right) / float(cdf_max_top_right);
-    float normal_cdf_bottom_left = float(cdf_bottom_left) / float(cdf_max_bottom_left);
-    float normal_cdf_bottom_right = float(cdf_bottom_right) / float(cdf_max_bottom_right);
-
-    // interpolation of the CDF values
-    float equalized_intensity = normal_cdf_top_left * top_left_weight + normal_cdf_top_right * top_right_weight +
-                                normal_cdf_bottom_left * bottom_left_weight + normal_cdf_bottom_right * bottom_right_weight;
-
-    // Write the equalized intensity back to the image
-    imageStore(img, pos, vec4(equalized_intensity, 0.0, 0.0, 1.0));
+    uint bin = pixelBin(pos);
+
+    // Fetch the LUT value at current pixel bin for adjacent tiles
+    float top_left = lut(tile_idx_top_left, bin);
+    float top_right = lut(tile_idx_top_right, bin);
+    float bottom_left = lut(tile_idx_bottom_left, bin);
+    float bottom_right = lut(tile_idx_bottom_right, bin);
+
+    // bilinear interpolation of the LUT values
+    return mix(mix(top_left, top_right, fx), mix(bottom_left, bottom_right, fx), fy);
+}
+#endif
+
+#if SCALED_OUTPUT
+// equalized input pixels under the work group's block of output pixels
+shared float equalizedBlock[SCALED_INPUT_BLOCK_X * SCALED_INPUT_BLOCK_Y];
+
+// input pixel position of an output pixel, pixel centers on integers, clamped to the edge
+// pixels like GL_CLAMP_TO_EDGE
+vec2 inputPosition(ivec2 outputPos) {
+    return clamp((vec2(outputPos) + 0.5) * inputScale - 0.5, vec2(0.0), vec2(IMAGE_WIDTH - 1, IMAGE_HEIGHT - 1));
+}
+
+// the equalized frame scaled to OUTPUT_WIDTH x OUTPUT_HEIGHT, as GL_LINEAR sampling of the
+// equalized frame would: blend the equalized values of the four nearest input pixels
+void main() {
+    // every input pixel under the block is equalized once, upscaling would otherwise
+    // equalize each of them for every output pixel around it
+    ivec2 blockOrigin = ivec2(inputPosition(ivec2(gl_WorkGroupID.xy) * SCALED_LOCAL_SIZE));
+    const int blockSize = SCALED_INPUT_BLOCK_X * SCALED_INPUT_BLOCK_Y;
+    const int localSize = SCALED_LOCAL_SIZE * SCALED_LOCAL_SIZE;
+    for (int i = int(gl_LocalInvocationIndex); i < blockSize; i += localSize) {
+        ivec2 pos = min(blockOrigin + ivec2(i % SCALED_INPUT_BLOCK_X, i / SCALED_INPUT_BLOCK_X),
+                        ivec2(IMAGE_WIDTH - 1, IMAGE_HEIGHT - 1));
+        equalizedBlock[i] = equalize(pos);
+    }
+    barrier();
+
+    ivec2 outputPos = ivec2(gl_GlobalInvocationID.xy);
+    if (outputPos.x >= OUTPUT_WIDTH || outputPos.y >= OUTPUT_HEIGHT) {
+        return;
+    }
+
+    vec2 position = inputPosition(outputPos);
+    ivec2 pos = ivec2(position) - blockOrigin;
+    // the right and bottom neighbors, unless the pixel is on the edge of the frame
+    ivec2 step = ivec2(lessThan(ivec2(position) + 1, ivec2(IMAGE_WIDTH, IMAGE_HEIGHT)));
+    int index = pos.y * SCALED_INPUT_BLOCK_X + pos.x;
+    int below = step.y * SCALED_INPUT_BLOCK_X;
+    vec2 f = fract(position);
+
+    float top = mix(equalizedBlock[index], equalizedBlock[index + step.x], f.x);
+    float bottom = mix(equalizedBlock[index + below], equalizedBlock[index + below + step.x], f.x);
+    float equalized_intensity = mix(top, bottom, f.y);
+
+    // the presentable texture is bottom up, the frame top down
+    imageStore(outputImage, FRAME_POSITION(ivec2(outputPos.x, OUTPUT_HEIGHT - 1 - outputPos.y)),
+               vec4(vec3(equalized_intensity), 1.0));
+}
+#else
+void main() {
+    ivec2 tileOrigin = ivec2(gl_WorkGroupID.xy) * ivec2(TILE_WIDTH, TILE_HEIGHT);
+
+    for (int y = int(gl_LocalInvocationID.y); y < TILE_HEIGHT; y += LOCAL_SIZE_Y) {
+        for (int x = int(gl_LocalInvocationID.x); x < TILE_WIDTH; x += LOCAL_SIZE_X) {
+            ivec2 pos = tileOrigin + ivec2(x, y);
+            if (pos.x < IMAGE_WIDTH && pos.y < IMAGE_HEIGHT) {
+                // Write the equalized intensity to the output image
+                imageStore(outputImage, FRAME_POSITION(pos), vec4(vec3(equalize(pos)), 1.0));
+            }
+        }
+    }
 }
+#endif
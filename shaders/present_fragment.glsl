@@ -0,0 +1,39 @@
+/*
+present_fragment.glsl
+Charles Rothbaum
+PROVUU
+
+Presentation, fragment stage:
+
+Samples the processed frame with GL_LINEAR filtering, which also scales it to the display,
+and writes it as grey. The frame texture stays bound to texture unit PRESENT_TEXTURE_UNIT for
+the whole session.
+
+With STREAMS > 1 the frame texture is an array with a layer per camera stream, drawn as a tiled
+composite of STREAM_COLUMNS x STREAM_ROWS cells. Stream i fills cell (i % STREAM_COLUMNS,
+i / STREAM_COLUMNS), counted from the top left with FLIP_Y set. Cells without a stream are black.
+*/
+
+#version 430 core
+
+#if STREAMS > 1
+layout(binding = PRESENT_TEXTURE_UNIT) uniform sampler2DArray frames;
+#else
+layout(binding = PRESENT_TEXTURE_UNIT) uniform sampler2D frame;
+#endif
+
+in vec2 textureCoordinates;
+out vec4 color;
+
+void main() {
+#if STREAMS > 1
+    vec2 grid = vec2(STREAM_COLUMNS, STREAM_ROWS);
+    vec2 cell = min(floor(textureCoordinates * grid), grid - 1.0);
+    float layer = cell.y * STREAM_COLUMNS + cell.x;
+    // clamp to edge keeps the filter inside the cell's own layer
+    float value = layer < STREAMS ? texture(frames, vec3(textureCoordinates * grid - cell, layer)).r : 0.0;
+    color = vec4(vec3(value), 1.0);
+#else
+    color = vec4(texture(frame, textureCoordinates).rrr, 1.0);
+#endif
+}
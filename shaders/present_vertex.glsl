@@ -0,0 +1,27 @@
+/*
+present_vertex.glsl
+Charles Rothbaum
+PROVUU
+
+Presentation, vertex stage:
+
+Draws one triangle that covers the whole viewport, with no vertex buffer: the corners come
+from gl_VertexID (0,0), (2,0), (0,2) in texture space, so the part of the triangle inside the
+viewport maps the texture's [0, 1] range exactly onto the screen.
+
+FLIP_Y is set for textures stored top row first (the equalized frame, as uploaded from the
+camera), so the first row ends up at the top of the screen.
+*/
+
+#version 430 core
+
+out vec2 textureCoordinates;
+
+void main() {
+    vec2 corner = vec2((gl_VertexID << 1) & 2, gl_VertexID & 2);
+    textureCoordinates = corner;
+#if FLIP_Y
+    textureCoordinates.y = 1.0 - corner.y;
+#endif
+    gl_Position = vec4(corner * 2.0 - 1.0, 0.0, 1.0);
+}
@@ -0,0 +1,148 @@
+# temporal_lut.py
+# PROVUU
+#
+# Temporal mode for the CLAHE passes.
+#
+# At 30 fps the scene usually changes slowly, so rebuilding every tile histogram every frame
+# is mostly wasted work, and equalizing every frame independently makes the output flicker.
+# In temporal mode:
+#
+#   * the second pass blends each new cdf into the tile's previous one with an exponential
+#     moving average (alpha is the weight of the new cdf, 1 turns smoothing off)
+#   * histograms are only recomputed every `interval` frames, or for `rows` tile rows per frame,
+#     rotating down the image. The third pass reuses the LUTs of the other tiles.
+#   * a scene cut forces a full refresh: every tile is recomputed and takes its new cdf as is.
+#
+# Scene cuts are detected on the GPU. The second pass counts the tiles whose new cdf is further
+# than `cut_distance` (mean absolute difference of the normalized cdfs) from their previous
+# one. The counts go to a small persistently mapped ring of slots that is read once the frame's
+# fence has signaled, so detection never stalls the pipeline. When more than `cut_fraction` of
+# the recomputed tiles changed, the next frame is a full refresh.
+
+import collections
+import ctypes
+import numpy as np
+from OpenGL.GL import *
+
+# frames whose scene cut counts can be in flight at once. the scene buffer has one more
+# slot, for frames that run while all others are in flight and whose count is never read.
+SCENE_SLOTS = 4
+
+DEFAULT_ALPHA = 0.25
+DEFAULT_CUT_DISTANCE = 0.1
+DEFAULT_CUT_FRACTION = 0.3
+
+
+class TemporalSchedule:
+    def __init__(self, geometry, alpha=DEFAULT_ALPHA, interval=1, rows=0,
+                 cut_distance=DEFAULT_CUT_DISTANCE, cut_fraction=DEFAULT_CUT_FRACTION):
+        if not 0.0 < alpha <= 1.0:
+            raise ValueError(f"temporal alpha must be in (0, 1], not {alpha}")
+        if interval < 1:
+            raise ValueError(f"histogram interval must be at least 1, not {interval}")
+        self.geometry = geometry
+        self.alpha = alpha
+        self.interval = interval
+        self.rows = min(rows, geometry.num_tiles_y) if rows > 0 else 0
+        self.cut_distance = cut_distance
+        self.cut_fraction = cut_fraction
+
+        self.frame = 0
+        self.next_row = 0
+        self.refresh = True     # nothing to blend with on the first frame
+
+        # statistics
+        self.full_refreshes = 0
+        self.scene_cuts = 0
+        self.rows_computed = 0
+
+        self._create_buffers()
+        self._free_slots = collections.deque(range(SCENE_SLOTS))
+        self._pending = collections.deque()     # (slot, fence, tiles recomputed)
+        self._slot = None
+
+    def _create_buffers(self):
+        # smoothed normalized cdfs of every tile, float32
+        self.smoothed_buffer = glGenBuffers(1)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, self.smoothed_buffer)
+        glBufferData(GL_SHADER_STORAGE_BUFFER, self.geometry.num_tiles * self.geometry.num_bins * 4, None, GL_DYNAMIC_COPY)
+        glClearBufferData(GL_SHADER_STORAGE_BUFFER, GL_R32F, GL_RED, GL_FLOAT, None)
+
+        # changed tile counts, one uint per slot
+        flags = GL_MAP_READ_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT
+        self.scene_buffer = glGenBuffers(1)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, self.scene_buffer)
+        glBufferStorage(GL_SHADER_STORAGE_BUFFER, (SCENE_SLOTS + 1) * 4, None, flags)
+        ptr = glMapBufferRange(GL_SHADER_STORAGE_BUFFER, 0, (SCENE_SLOTS + 1) * 4, flags)
+        self.counts = np.ctypeslib.as_array(ctypes.cast(ptr, ctypes.POINTER(ctypes.c_uint32)), (SCENE_SLOTS + 1,))
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+
+    def bind(self):
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 3, self.smoothed_buffer)
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 4, self.scene_buffer)
+
+    def next_frame(self):
+        # tile rows to recompute this frame and the blend weight of their new cdfs.
+        # returns (first_row, row_count, alpha, slot), row_count is 0 when the LUTs are reused.
+        self._collect()
+        num_rows = self.geometry.num_tiles_y
+        self._slot = None
+        refreshing = self.refresh
+
+        if refreshing:
+            self.refresh = False
+            self.full_refreshes += 1
+            self.next_row = 0
+            first_row, row_count, alpha = 0, num_rows, 1.0
+        elif self.rows:
+            first_row, row_count, alpha = self.next_row, self.rows, self.alpha
+            self.next_row = (self.next_row + self.rows) % num_rows
+        elif self.frame % self.interval == 0:
+            first_row, row_count, alpha = 0, num_rows, self.alpha
+        else:
+            first_row, row_count, alpha = 0, 0, self.alpha
+        self.frame += 1
+        self.rows_computed += row_count
+        self._row_count = row_count
+
+        # count the changed tiles, unless this already is a full refresh
+        slot = SCENE_SLOTS
+        if row_count and not refreshing and self._free_slots:
+            slot = self._slot = self._free_slots.popleft()
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, self.scene_buffer)
+        glClearBufferSubData(GL_SHADER_STORAGE_BUFFER, GL_R32UI, slot * 4, 4, GL_RED_INTEGER, GL_UNSIGNED_INT, None)
+        return first_row, row_count, alpha, slot
+
+    def frame_done(self):
+        # fence the frame's scene cut count, read it back once the GPU got there
+        if self._slot is not None:
+            fence = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+            self._pending.append((self._slot, fence, self._row_count * self.geometry.num_tiles_x))
+            self._slot = None
+
+    def _collect(self):
+        while self._pending:
+            slot, fence, tiles = self._pending[0]
+            if glClientWaitSync(fence, 0, 0) == GL_TIMEOUT_EXPIRED:
+                break
+            glDeleteSync(fence)
+            self._pending.popleft()
+            if self.counts[slot] > self.cut_fraction * tiles:
+                self.scene_cuts += 1
+                self.refresh = True
+            self._free_slots.append(slot)
+
+    def close(self):
+        while self._pending:
+            glDeleteSync(self._pending.popleft()[1])
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, self.scene_buffer)
+        glUnmapBuffer(GL_SHADER_STORAGE_BUFFER)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+        glDeleteBuffers(2, [self.smoothed_buffer, self.scene_buffer])
+
+    def report(self):
+        frames = max(self.frame, 1)
+        mode = f"{self.rows} rows per frame" if self.rows else f"every {self.interval} frames"
+        return (f"temporal (alpha {self.alpha}, histograms {mode}): {self.full_refreshes} full refreshes, "
+                f"{self.scene_cuts} scene cuts, {self.rows_computed / frames:.1f} of "
+                f"{self.geometry.num_tiles_y} tile rows recomputed per frame")
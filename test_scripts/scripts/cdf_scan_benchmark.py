@@ -0,0 +1,97 @@
+# cdf_scan_benchmark.py
+# PROVUU
+#
+# Benchmark of the second pass: parallel (Blelloch) cdf scan against the serial cdf loop.
+#
+# Runs shaders/clahe_second_pass.glsl and the serial baseline in
+# test_scripts/shaders/clahe_second_pass_serial.glsl on the same tile histograms (taken from a
+# noisy frame and a low contrast frame) and checks that both produce the same cdfs.
+#
+#   python3 test_scripts/scripts/cdf_scan_benchmark.py [--iterations 20]
+
+import argparse
+from gpu_bench import *
+from shader_build import BIN_COUNTS, ClaheGeometry
+
+VARIANTS = {
+    'serial': ('clahe_second_pass_serial.glsl', TEST_SHADER_DIR),
+    'scan': ('clahe_second_pass.glsl', SHADER_DIR),
+}
+
+
+def tile_histograms(geometry, frame):
+    # histograms as the first pass leaves them in the buffer
+    bins = np.minimum(frame.astype(np.uint32) * geometry.num_bins >> geometry.bit_depth, geometry.num_bins - 1)
+    histograms = np.zeros((geometry.num_tiles_y, geometry.num_tiles_x, geometry.num_bins), dtype=np.uint32)
+    for ty in range(geometry.num_tiles_y):
+        for tx in range(geometry.num_tiles_x):
+            tile = bins[ty * geometry.tile_height:(ty + 1) * geometry.tile_height,
+                        tx * geometry.tile_width:(tx + 1) * geometry.tile_width]
+            histograms[ty, tx] = np.bincount(tile.ravel(), minlength=geometry.num_bins)
+    return histograms.ravel()
+
+
+def benchmark(geometry, variant, histograms, iterations):
+    name, shader_dir = VARIANTS[variant]
+    max_invocations = glGetIntegerv(GL_MAX_COMPUTE_WORK_GROUP_INVOCATIONS)
+    program = create_program(name, geometry.defines(max_invocations), shader_dir)
+    buffer = create_storage_buffer(geometry.histogram_buffer_size, 1)
+
+    def prepare():
+        # the pass overwrites the histograms with cdfs
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, buffer)
+        glBufferSubData(GL_SHADER_STORAGE_BUFFER, 0, histograms.nbytes, histograms)
+        glMemoryBarrier(GL_ALL_BARRIER_BITS)
+
+    def run():
+        glUseProgram(program)
+        glDispatchCompute(geometry.num_tiles_x, geometry.num_tiles_y, 1)
+
+    ms = gpu_time_ms(run, prepare, iterations)
+    cdfs = read_storage_buffer(buffer, geometry.histogram_buffer_size)
+    glDeleteBuffers(1, [buffer])
+    glDeleteProgram(program)
+    return ms, cdfs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="second pass cdf scan benchmark")
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--tile-size', type=int, default=39)
+    parser.add_argument('--bins', type=int, choices=BIN_COUNTS, default=256)
+    parser.add_argument('--bit-depth', type=int, default=10)
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    context = create_headless_context()
+    print(f"{glGetString(GL_RENDERER).decode()}, {glGetString(GL_VERSION).decode()}")
+    geometry = ClaheGeometry(args.width, args.height, args.tile_size, args.tile_size, args.bins, args.bit_depth)
+    print(geometry)
+
+    frames = {
+        'noisy': noisy_frame(args.width, args.height, args.bit_depth),
+        'low contrast': noisy_frame(args.width, args.height, args.bit_depth - 5) + (1 << (args.bit_depth - 1)),
+    }
+    print(f"{'variant':>8}" + "".join(f"{name:>20}" for name in frames))
+
+    baseline = {}
+    for variant in VARIANTS:
+        if variant == 'serial' and geometry.num_bins > glGetIntegerv(GL_MAX_COMPUTE_WORK_GROUP_INVOCATIONS):
+            print(f"{variant:>8}  needs a thread per bin, {geometry.num_bins} is above the work group limit")
+            continue
+        row = f"{variant:>8}"
+        for name, frame in frames.items():
+            ms, cdfs = benchmark(geometry, variant, tile_histograms(geometry, frame), args.iterations)
+            if name not in baseline:
+                baseline[name] = (ms, cdfs)
+            elif not np.array_equal(cdfs, baseline[name][1]):
+                raise SystemExit(f"{variant}: cdfs of the {name} frame differ from the serial pass")
+            row += f"{ms:13.3f}ms {baseline[name][0] / ms:4.1f}x"
+        print(row)
+
+    context.terminate()
+
+
+if __name__ == '__main__':
+    main()
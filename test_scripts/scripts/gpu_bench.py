@@ -0,0 +1,140 @@
+# gpu_bench.py
+# PROVUU
+#
+# Shared setup for the compute pass benchmarks in this directory.
+#
+# Benchmarks run on a headless context (EGL surfaceless by default, see gl_context.py), so they
+# work on the Nano without a display as well as on Mesa llvmpipe. Import this module before
+# anything imports OpenGL, it selects the PyOpenGL platform.
+
+import os
+import sys
+
+os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, REPO_DIR)
+
+import ctypes
+import time
+import numpy as np
+from OpenGL.GL import *
+from gl_context import create_context
+from shader_build import BIN_TEXTURE_FORMATS, SHADER_DIR, build_shader_source
+
+# GL_TIME_ELAPSED results below this are not real measurements (ns)
+MIN_QUERY_NS = 1000
+
+
+def create_headless_context(width=64, height=64):
+    return create_context(width, height, "benchmark", os.environ['PYOPENGL_PLATFORM'])
+
+
+# experimental shaders and baselines of the benchmarks
+TEST_SHADER_DIR = os.path.join(REPO_DIR, 'test_scripts', 'shaders')
+
+
+def create_program(name, defines, shader_dir=SHADER_DIR):
+    shader = glCreateShader(GL_COMPUTE_SHADER)
+    glShaderSource(shader, build_shader_source(name, defines, shader_dir))
+    glCompileShader(shader)
+    if glGetShaderiv(shader, GL_COMPILE_STATUS) != GL_TRUE:
+        raise RuntimeError(glGetShaderInfoLog(shader).decode())
+    program = glCreateProgram()
+    glAttachShader(program, shader)
+    glLinkProgram(program)
+    if glGetProgramiv(program, GL_LINK_STATUS) != GL_TRUE:
+        raise RuntimeError(glGetProgramInfoLog(program).decode())
+    glDeleteShader(shader)
+    return program
+
+
+def create_image_texture(width, height, internal_format):
+    texture = glGenTextures(1)
+    glBindTexture(GL_TEXTURE_2D, texture)
+    glTexStorage2D(GL_TEXTURE_2D, 1, internal_format, width, height)
+    return texture
+
+
+def create_frame_texture(frame):
+    # GL_R16UI input image, as the passes read it
+    texture = create_image_texture(frame.shape[1], frame.shape[0], GL_R16UI)
+    upload_frame(texture, frame)
+    return texture
+
+
+def create_pass_images(geometry, frame):
+    # input, bin and output image of the CLAHE passes, bound to their image units
+    images = (create_frame_texture(frame),
+              create_image_texture(geometry.width, geometry.height, BIN_TEXTURE_FORMATS[geometry.bin_image_format]),
+              create_image_texture(geometry.width, geometry.height, GL_R16))
+    glBindImageTexture(0, images[0], 0, GL_FALSE, 0, GL_READ_ONLY, GL_R16UI)
+    glBindImageTexture(3, images[1], 0, GL_FALSE, 0, GL_READ_WRITE, BIN_TEXTURE_FORMATS[geometry.bin_image_format])
+    glBindImageTexture(4, images[2], 0, GL_FALSE, 0, GL_WRITE_ONLY, GL_R16)
+    return images
+
+
+def upload_frame(texture, frame):
+    glBindTexture(GL_TEXTURE_2D, texture)
+    glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, frame.shape[1], frame.shape[0], GL_RED_INTEGER, GL_UNSIGNED_SHORT, frame)
+
+
+def create_storage_buffer(size, binding):
+    buffer = glGenBuffers(1)
+    glBindBuffer(GL_SHADER_STORAGE_BUFFER, buffer)
+    glBufferData(GL_SHADER_STORAGE_BUFFER, size, None, GL_DYNAMIC_COPY)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, binding, buffer)
+    return buffer
+
+
+def read_storage_buffer(buffer, size, dtype=np.uint32):
+    glMemoryBarrier(GL_BUFFER_UPDATE_BARRIER_BIT)
+    glBindBuffer(GL_SHADER_STORAGE_BUFFER, buffer)
+    return np.frombuffer(glGetBufferSubData(GL_SHADER_STORAGE_BUFFER, 0, size), dtype=dtype).copy()
+
+
+def read_texture(texture, width, height, pixel_format=GL_RED):
+    # GL_RED for normalized images, GL_RED_INTEGER for integer ones
+    glMemoryBarrier(GL_TEXTURE_UPDATE_BARRIER_BIT)
+    glBindTexture(GL_TEXTURE_2D, texture)
+    data = glGetTexImage(GL_TEXTURE_2D, 0, pixel_format, GL_UNSIGNED_SHORT)
+    return np.frombuffer(data, dtype=np.uint16).reshape(height, width).copy()
+
+
+def gpu_time_ms(run, prepare=None, iterations=20, warmup=3):
+    # median GPU time of run() in ms, from GL_TIME_ELAPSED queries.
+    # prepare() runs before every iteration, outside of the measurement.
+    # software drivers (llvmpipe) report next to nothing for compute work, then the time
+    # from submission to glFinish() returning is used instead.
+    for _ in range(warmup):
+        if prepare:
+            prepare()
+        run()
+    query = glGenQueries(1)[0]
+    result = ctypes.c_uint64()
+    times = []
+    for _ in range(iterations):
+        if prepare:
+            prepare()
+        glFinish()
+        start = time.perf_counter_ns()
+        glBeginQuery(GL_TIME_ELAPSED, query)
+        run()
+        glEndQuery(GL_TIME_ELAPSED)
+        glFinish()
+        wall_ns = time.perf_counter_ns() - start
+        glGetQueryObjectui64v(query, GL_QUERY_RESULT, ctypes.byref(result))
+        times.append((result.value if result.value >= MIN_QUERY_NS else wall_ns) / 1e6)
+    glDeleteQueries(1, [query])
+    return float(np.median(times))
+
+
+def uniform_frame(width, height, value=512):
+    # flat grey frame, every pixel of a tile lands in the same bin
+    return np.full((height, width), value, dtype=np.uint16)
+
+
+def noisy_frame(width, height, bit_depth=10, seed=0):
+    # uniform noise over the sensor range, pixels spread over all bins
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 1 << bit_depth, (height, width), dtype=np.uint16)
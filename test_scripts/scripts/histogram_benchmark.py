@@ -0,0 +1,87 @@
+# histogram_benchmark.py
+# PROVUU
+#
+# Benchmark of the first pass with the tile histograms in shared memory against global atomics.
+#
+# Runs clahe_first_pass.glsl with HISTOGRAM_COPIES = 0 (every invocation does atomicAdd on the
+# histogram storage buffer) and with 1, 2, 4, ... shared memory sub-histograms, on a uniform frame
+# (every pixel of a tile in one bin, worst case contention) and on a noisy frame, and checks that
+# every variant produces the same histograms.
+#
+#   python3 test_scripts/scripts/histogram_benchmark.py [--copies 0 1 2 4 8 16] [--iterations 20]
+
+import argparse
+from gpu_bench import *
+from shader_build import BIN_COUNTS, ClaheGeometry, fit_histogram_copies
+
+
+def benchmark(geometry, copies, frame, iterations):
+    max_invocations = glGetIntegerv(GL_MAX_COMPUTE_WORK_GROUP_INVOCATIONS)
+    defines = dict(geometry.defines(max_invocations), HISTOGRAM_COPIES=copies)
+    program = create_program('clahe_first_pass.glsl', defines)
+
+    images = create_pass_images(geometry, frame)
+    histograms = create_storage_buffer(geometry.histogram_buffer_size, 1)
+    zeros = np.zeros(geometry.histogram_buffer_size // 4, dtype=np.uint32)
+
+    def prepare():
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, histograms)
+        glBufferSubData(GL_SHADER_STORAGE_BUFFER, 0, zeros.nbytes, zeros)
+        glMemoryBarrier(GL_ALL_BARRIER_BITS)
+
+    def run():
+        glUseProgram(program)
+        glDispatchCompute(geometry.num_tiles_x, geometry.num_tiles_y, 1)
+
+    ms = gpu_time_ms(run, prepare, iterations)
+    result = read_storage_buffer(histograms, geometry.histogram_buffer_size)
+
+    glDeleteBuffers(1, [histograms])
+    glDeleteTextures(len(images), images)
+    glDeleteProgram(program)
+    return ms, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="first pass histogram benchmark")
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--tile-size', type=int, default=39)
+    parser.add_argument('--bins', type=int, choices=BIN_COUNTS, default=256)
+    parser.add_argument('--bit-depth', type=int, default=10)
+    parser.add_argument('--copies', type=int, nargs='+', default=[0, 1, 2, 4, 8, 16])
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    context = create_headless_context()
+    print(f"{glGetString(GL_RENDERER).decode()}, {glGetString(GL_VERSION).decode()}")
+    geometry = ClaheGeometry(args.width, args.height, args.tile_size, args.tile_size, args.bins, args.bit_depth)
+    max_shared_bytes = glGetIntegerv(GL_MAX_COMPUTE_SHARED_MEMORY_SIZE)
+    print(f"{geometry}, {max_shared_bytes} bytes of shared memory")
+
+    frames = {
+        'uniform': uniform_frame(args.width, args.height),
+        'noisy': noisy_frame(args.width, args.height, args.bit_depth),
+    }
+    print(f"{'copies':>8}" + "".join(f"{name:>16}" for name in frames))
+
+    baseline = {}
+    for copies in args.copies:
+        if fit_histogram_copies(copies, geometry.num_bins, max_shared_bytes) != copies:
+            print(f"{copies:>8}  does not fit in shared memory")
+            continue
+        row = f"{copies:>8}"
+        for name, frame in frames.items():
+            ms, histograms = benchmark(geometry, copies, frame, args.iterations)
+            if name not in baseline:
+                baseline[name] = (ms, histograms)
+            elif not np.array_equal(histograms, baseline[name][1]):
+                raise SystemExit(f"{copies} copies: histograms of the {name} frame differ")
+            row += f"{ms:9.3f}ms {baseline[name][0] / ms:4.1f}x"
+        print(row)
+
+    context.terminate()
+
+
+if __name__ == '__main__':
+    main()
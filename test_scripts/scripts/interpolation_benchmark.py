@@ -0,0 +1,117 @@
+# interpolation_benchmark.py
+# PROVUU
+#
+# Accuracy versus throughput of the two LUT interpolation engines of the third pass.
+#
+#   alu      four LUT fetches from the LUT buffer, bilinear blend in the shader
+#   texture  one GL_LINEAR sample of the 3D LUT texture, the texture unit does the blend
+#
+# for every LUT format. The first two passes run once per variant, then the third pass is timed
+# on its own. Accuracy is measured against a float64 numpy evaluation of the same tile center
+# interpolation, from the cdfs the second pass leaves in the histograms buffer, in 16-bit steps.
+#
+#   python3 test_scripts/scripts/interpolation_benchmark.py [--iterations 20]
+
+import argparse
+from gpu_bench import *
+from shader_build import (BIN_COUNTS, INTERPOLATIONS, LUT_FORMATS, LUT_TEXTURE_FORMATS, ClaheGeometry, lut_defines,
+                          output_defines)
+
+
+def reference(geometry, frame, cdfs):
+    # tile center bilinear interpolation of the normalized cdfs, in float64
+    luts = cdfs.reshape(geometry.num_tiles_y, geometry.num_tiles_x, geometry.num_bins).astype(np.float64)
+    luts /= np.maximum(luts[..., -1:], 1)
+    bins = np.minimum(frame.astype(np.int64) * geometry.num_bins >> geometry.bit_depth, geometry.num_bins - 1)
+
+    y, x = np.mgrid[0:geometry.height, 0:geometry.width]
+    tx = np.clip((x + 0.5) / geometry.tile_width - 0.5, 0, geometry.num_tiles_x - 1)
+    ty = np.clip((y + 0.5) / geometry.tile_height - 0.5, 0, geometry.num_tiles_y - 1)
+    x0, y0 = tx.astype(np.int64), ty.astype(np.int64)
+    x1, y1 = np.minimum(x0 + 1, geometry.num_tiles_x - 1), np.minimum(y0 + 1, geometry.num_tiles_y - 1)
+    fx, fy = tx - x0, ty - y0
+
+    top = luts[y0, x0, bins] * (1 - fx) + luts[y0, x1, bins] * fx
+    bottom = luts[y1, x0, bins] * (1 - fx) + luts[y1, x1, bins] * fx
+    return (top * (1 - fy) + bottom * fy) * 65535.0
+
+
+def benchmark(geometry, frame, interpolation, lut_format, iterations):
+    max_invocations = glGetIntegerv(GL_MAX_COMPUTE_WORK_GROUP_INVOCATIONS)
+    defines = dict(geometry.defines(max_invocations), HISTOGRAM_COPIES=4)
+    defines.update(lut_defines(lut_format, interpolation))
+    defines.update(output_defines())
+    passes = [create_program(name, defines) for name in
+              ('clahe_first_pass.glsl', 'clahe_second_pass.glsl', 'clahe_third_pass.glsl')]
+
+    images = create_pass_images(geometry, frame)
+    histograms = create_storage_buffer(geometry.histogram_buffer_size, 1)
+    if interpolation == 'texture':
+        luts = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_3D, luts)
+        glTexStorage3D(GL_TEXTURE_3D, 1, LUT_TEXTURE_FORMATS[lut_format],
+                       geometry.num_tiles_x, geometry.num_tiles_y, geometry.num_bins)
+        glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        for wrap in (GL_TEXTURE_WRAP_S, GL_TEXTURE_WRAP_T, GL_TEXTURE_WRAP_R):
+            glTexParameteri(GL_TEXTURE_3D, wrap, GL_CLAMP_TO_EDGE)
+        glBindImageTexture(1, luts, 0, GL_TRUE, 0, GL_WRITE_ONLY, LUT_TEXTURE_FORMATS[lut_format])
+        glActiveTexture(GL_TEXTURE1)
+        glBindTexture(GL_TEXTURE_3D, luts)
+        glActiveTexture(GL_TEXTURE0)
+    else:
+        luts = create_storage_buffer(geometry.lut_buffer_size(lut_format), 2)
+
+    def dispatch(program):
+        glUseProgram(program)
+        glDispatchCompute(geometry.num_tiles_x, geometry.num_tiles_y, 1)
+
+    # first and second pass once, the third pass only reads their bins and LUTs
+    for program in passes[:2]:
+        dispatch(program)
+        glMemoryBarrier(GL_ALL_BARRIER_BITS)
+
+    ms = gpu_time_ms(lambda: dispatch(passes[2]), iterations=iterations)
+
+    output = read_texture(images[2], geometry.width, geometry.height)
+    cdfs = read_storage_buffer(histograms, geometry.histogram_buffer_size)
+    error = np.abs(output - reference(geometry, frame, cdfs))
+
+    if interpolation == 'texture':
+        glDeleteTextures(1, [luts])
+    else:
+        glDeleteBuffers(1, [luts])
+    glDeleteBuffers(1, [histograms])
+    glDeleteTextures(len(images), images)
+    for program in passes:
+        glDeleteProgram(program)
+    return ms, error.max(), error.mean()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="third pass interpolation benchmark")
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--tile-size', type=int, default=39)
+    parser.add_argument('--bins', type=int, choices=BIN_COUNTS, default=256)
+    parser.add_argument('--bit-depth', type=int, default=10)
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    context = create_headless_context()
+    print(f"{glGetString(GL_RENDERER).decode()}, {glGetString(GL_VERSION).decode()}")
+    geometry = ClaheGeometry(args.width, args.height, args.tile_size, args.tile_size, args.bins, args.bit_depth)
+    print(geometry)
+    frame = noisy_frame(args.width, args.height, args.bit_depth)
+
+    print(f"{'engine':>8} {'lut':>7} {'third pass':>12} {'max error':>10} {'mean error':>11}")
+    for interpolation in INTERPOLATIONS:
+        for lut_format in LUT_FORMATS:
+            ms, max_error, mean_error = benchmark(geometry, frame, interpolation, lut_format, args.iterations)
+            print(f"{interpolation:>8} {lut_format:>7} {ms:10.3f}ms {max_error:10.2f} {mean_error:11.3f}")
+
+    context.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+# present_benchmark.py
+# PROVUU
+#
+# Render thread cost and accuracy of the presentation modes (see presentation.py).
+#
+#   triangle  core profile fullscreen triangle sampling the frame with GL_LINEAR
+#   blit      glBlitFramebuffer with GL_LINEAR filtering
+#
+# for the equalized frame at input size (flipped on the way) and for a frame already at output
+# size (the fused third pass output), in every output format the mode can draw (16 and 8 bits,
+# the 8-bit ones move half the bytes through the scaling). The CPU time of the present call is what the render thread
+# pays per frame, the GPU time is of the draw itself. Accuracy is measured against a numpy
+# evaluation of GL_LINEAR sampling at the output pixel centers, in 8-bit steps of the target. An
+# 8-bit frame adds up to half a step of its own rounding.
+#
+#   python3 test_scripts/scripts/present_benchmark.py [--iterations 200]
+
+import argparse
+from gpu_bench import *
+from presentation import PRESENT_CALLS, PRESENT_FORMATS, PRESENT_MODES, Presenter
+from shader_build import OUTPUT_TEXTURE_FORMATS
+
+
+def gradient_frame(width, height):
+    # a diagonal gradient, so flips and offsets show up as errors
+    y, x = np.mgrid[0:height, 0:width]
+    return ((x / width * 0.5 + y / height * 0.5) * 65535).astype(np.uint16)
+
+
+def create_frame(frame, output_format):
+    # the output image of the third pass, with the sampling state create_texture gives it.
+    # the third pass writes the intensity to every channel.
+    texture = glGenTextures(1)
+    glBindTexture(GL_TEXTURE_2D, texture)
+    if output_format.startswith('rgba'):
+        data, pixel_format = np.repeat(frame[..., None], 4, axis=2), GL_RGBA
+    else:
+        data, pixel_format = frame, GL_RED
+    glTexImage2D(GL_TEXTURE_2D, 0, OUTPUT_TEXTURE_FORMATS[output_format], frame.shape[1], frame.shape[0], 0,
+                 pixel_format, GL_UNSIGNED_SHORT, np.ascontiguousarray(data))
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+    for swizzle in (GL_TEXTURE_SWIZZLE_R, GL_TEXTURE_SWIZZLE_G, GL_TEXTURE_SWIZZLE_B):
+        glTexParameteri(GL_TEXTURE_2D, swizzle, GL_RED)
+    glBindTexture(GL_TEXTURE_2D, 0)
+    return texture
+
+
+def reference(frame, output_width, output_height, flip):
+    # GL_LINEAR sampling with clamp to edge at every output pixel center, bottom row first.
+    # a flipped frame is stored top row first, its first row ends up at the top.
+    height, width = frame.shape
+    x = np.clip((np.arange(output_width) + 0.5) * width / output_width - 0.5, 0, width - 1)
+    y = np.clip((np.arange(output_height) + 0.5) * height / output_height - 0.5, 0, height - 1)
+    x0, y0 = np.floor(x).astype(int), np.floor(y).astype(int)
+    x1, y1 = np.minimum(x0 + 1, width - 1), np.minimum(y0 + 1, height - 1)
+    fx, fy = x - x0, (y - y0)[:, None]
+    data = frame.astype(np.float64)
+    top = data[y0][:, x0] * (1 - fx) + data[y0][:, x1] * fx
+    bottom = data[y1][:, x0] * (1 - fx) + data[y1][:, x1] * fx
+    scaled = (top * (1 - fy) + bottom * fy) / 65535.0 * 255.0
+    return scaled[::-1] if flip else scaled
+
+
+def read_target(context):
+    glFinish()
+    glBindTexture(GL_TEXTURE_2D, context.texture)
+    data = glGetTexImage(GL_TEXTURE_2D, 0, GL_RGBA, GL_UNSIGNED_BYTE)
+    glBindTexture(GL_TEXTURE_2D, 0)
+    return np.frombuffer(data, dtype=np.uint8).reshape(context.height, context.width, 4)
+
+
+def benchmark(context, frame, mode, output_format, flip, iterations):
+    texture = create_frame(frame, output_format)
+    presenter = Presenter(context, texture, (frame.shape[1], frame.shape[0]), (context.width, context.height),
+                          flip, mode)
+
+    # render thread time of the present call alone, the GPU idle before every call
+    cpu_ns = []
+    for _ in range(iterations):
+        glFinish()
+        start = time.perf_counter_ns()
+        presenter.present()
+        cpu_ns.append(time.perf_counter_ns() - start)
+    gpu_ms = gpu_time_ms(presenter.present)
+
+    target = read_target(context)
+    expected = reference(frame, context.width, context.height, flip)
+    error = np.abs(target[..., 0] - expected)
+    grey = bool((target[..., 0] == target[..., 1]).all() and (target[..., 0] == target[..., 2]).all())
+
+    presenter.close()
+    glDeleteTextures(1, [texture])
+    return float(np.median(cpu_ns)) / 1e3, gpu_ms, error.max(), grey
+
+
+def main():
+    parser = argparse.ArgumentParser(description="presentation benchmark")
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--output-width', type=int, default=1920)
+    parser.add_argument('--output-height', type=int, default=1080)
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    context = create_headless_context(args.output_width, args.output_height)
+    print(f"{glGetString(GL_RENDERER).decode()}, {glGetString(GL_VERSION).decode()}")
+    frame = gradient_frame(args.width, args.height)
+    scaled = gradient_frame(args.output_width, args.output_height)
+
+    print(f"{'mode':>8} {'format':>7} {'frame':>10} {'GL calls':>9} {'cpu':>10} {'gpu':>10} {'max error':>10} "
+          f"{'grey':>5}")
+    for mode in PRESENT_MODES:
+        for output_format in PRESENT_FORMATS[mode]:
+            for source, flip in ((frame, True), (scaled, False)):
+                cpu_us, gpu_ms, max_error, grey = benchmark(context, source, mode, output_format, flip,
+                                                            args.iterations)
+                size = f"{source.shape[1]}x{source.shape[0]}"
+                print(f"{mode:>8} {output_format:>7} {size:>10} {PRESENT_CALLS[mode]:>9} {cpu_us:8.1f}us "
+                      f"{gpu_ms:8.3f}ms {max_error:10.2f} {'yes' if grey else 'no':>5}")
+
+    context.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# sampling_benchmark.py
+# PROVUU
+#
+# Time saved and equalization error of subsampled histograms (--histogram-stride).
+#
+# Runs the three CLAHE passes with the first pass counting one pixel in every SxS cell of a tile,
+# for every stride and sampling pattern, on a synthetic scene with smooth gradients, flat
+# regions, hard edges and a fine periodic grating (the worst case for regular sampling). Every
+# variant is timed per pass and for the whole frame, and its output is compared with the output
+# of stride 1 (every pixel counted), in 8-bit display steps.
+#
+#   python3 test_scripts/scripts/sampling_benchmark.py [--strides 1 2 4 8] [--iterations 20]
+
+import argparse
+from gpu_bench import *
+from shader_build import (BIN_COUNTS, CLAHE_SHADERS, HISTOGRAM_SAMPLINGS, ClaheGeometry, lut_defines,
+                          output_defines, sampling_defines)
+
+
+def scene_frame(width, height, bit_depth=10, seed=0):
+    # gradient background, flat blocks with hard edges, a 3 pixel grating and sensor noise
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float64)
+    frame = 0.2 + 0.3 * x / width + 0.2 * y / height
+    frame[height // 8:height // 2, width // 8:width // 3] = 0.85
+    frame[height // 2:height * 7 // 8, width // 2:width * 3 // 4] = 0.1
+    grating = (slice(height // 4, height * 3 // 4), slice(width * 3 // 4, width))
+    frame[grating] = 0.45 + 0.25 * (x[grating] % 3 == 0)
+    frame += rng.normal(0.0, 0.01, frame.shape)
+    return (np.clip(frame, 0.0, 1.0) * ((1 << bit_depth) - 1)).astype(np.uint16)
+
+
+def benchmark(geometry, frame, sampling, iterations):
+    max_invocations = glGetIntegerv(GL_MAX_COMPUTE_WORK_GROUP_INVOCATIONS)
+    defines = dict(geometry.defines(max_invocations), HISTOGRAM_COPIES=4)
+    defines.update(lut_defines('uint16'))
+    defines.update(output_defines())
+    defines.update(sampling_defines(sampling))
+    passes = [create_program(name, defines) for name in CLAHE_SHADERS]
+
+    images = create_pass_images(geometry, frame)
+    histograms = create_storage_buffer(geometry.histogram_buffer_size, 1)
+    luts = create_storage_buffer(geometry.lut_buffer_size('uint16'), 2)
+    zeros = np.zeros(geometry.histogram_buffer_size // 4, dtype=np.uint32)
+
+    def clear():
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, histograms)
+        glBufferSubData(GL_SHADER_STORAGE_BUFFER, 0, zeros.nbytes, zeros)
+        glMemoryBarrier(GL_ALL_BARRIER_BITS)
+
+    def dispatch(program):
+        glUseProgram(program)
+        glDispatchCompute(geometry.num_tiles_x, geometry.num_tiles_y, 1)
+
+    def frame_passes():
+        for program in passes:
+            dispatch(program)
+            glMemoryBarrier(GL_ALL_BARRIER_BITS)
+
+    times = [gpu_time_ms(lambda: dispatch(passes[0]), clear, iterations)]
+    dispatch(passes[0])
+    glMemoryBarrier(GL_ALL_BARRIER_BITS)
+    times.append(gpu_time_ms(lambda: dispatch(passes[1]), iterations=iterations))
+    times.append(gpu_time_ms(lambda: dispatch(passes[2]), iterations=iterations))
+    times.append(gpu_time_ms(frame_passes, clear, iterations))
+
+    output = read_texture(images[2], geometry.width, geometry.height)
+
+    glDeleteBuffers(2, [histograms, luts])
+    glDeleteTextures(len(images), images)
+    for program in passes:
+        glDeleteProgram(program)
+    return times, output
+
+
+def main():
+    parser = argparse.ArgumentParser(description="subsampled histogram benchmark")
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--tile-size', type=int, default=39)
+    parser.add_argument('--bins', type=int, choices=BIN_COUNTS, default=256)
+    parser.add_argument('--bit-depth', type=int, default=10)
+    parser.add_argument('--strides', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    context = create_headless_context()
+    print(f"{glGetString(GL_RENDERER).decode()}, {glGetString(GL_VERSION).decode()}")
+    frame = scene_frame(args.width, args.height, args.bit_depth)
+
+    reference = None
+    print(f"{'stride':>6} {'sampling':>9} {'pixels':>7} {'first':>10} {'second':>10} {'third':>10} {'frame':>10} "
+          f"{'mean err':>9} {'p99 err':>8} {'max err':>8}")
+    for stride in sorted(set(args.strides) | {1}):
+        geometry = ClaheGeometry(args.width, args.height, args.tile_size, args.tile_size, args.bins,
+                                 args.bit_depth, histogram_stride=stride)
+        for sampling in HISTOGRAM_SAMPLINGS if stride > 1 else HISTOGRAM_SAMPLINGS[:1]:
+            times, output = benchmark(geometry, frame, sampling, args.iterations)
+            if reference is None:
+                reference = output.astype(np.float64)
+            # in 8-bit steps, as the output is displayed
+            error = np.abs(output - reference) / 257.0
+            first, second, third, total = times
+            print(f"{stride:>6} {sampling:>9} {f'1/{stride * stride}':>7} {first:8.3f}ms {second:8.3f}ms "
+                  f"{third:8.3f}ms {total:8.3f}ms {error.mean():9.3f} {np.percentile(error, 99):8.2f} "
+                  f"{error.max():8.2f}")
+
+    context.terminate()
+
+
+if __name__ == '__main__':
+    main()
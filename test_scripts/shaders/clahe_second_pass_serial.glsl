@@ -0,0 +1,70 @@
+/*  
+clahe_second_pass_serial.glsl
+Charles Rothbaum
+PROVUU
+
+Second pass with the serial cdf loop, kept as the baseline for cdf_scan_benchmark.py:
+
+spawns NUM_BINS parallel threads per tile to span the histograms buffer object, and compute the clip limit
+for each bin in the histograms buffer, and redistributes the clipped values evenly across
+the histogram.
+
+One thread is delegated to finally compute the cdf for the histogram, overwriting the histograms
+buffer with the cdf values.
+*/
+
+#version 430
+
+#ifndef NUM_BINS
+#error "build this shader with shader_build.py, it defines the frame and tile geometry"
+#endif
+
+layout(local_size_x = NUM_BINS) in;
+
+layout(std430, binding = 1) buffer HistogramBuffer {
+    uint histograms[];
+};
+
+const uint numBins = uint(NUM_BINS);
+uniform uint clipLimit = uint(CLIP_LIMIT);
+shared uint excess_values;
+
+void main() {
+    if(gl_LocalInvocationIndex == 0){
+        excess_values = 0u;
+    }
+    barrier();
+
+    uint tileX = gl_WorkGroupID.x;
+    uint tileY = gl_WorkGroupID.y;
+    uint tileIndex = tileY * uint(NUM_TILES_X) + tileX;
+    uint binIndex = tileIndex * numBins + gl_LocalInvocationIndex;
+    uint num_bins_at_index = histograms[binIndex];
+
+    // clip histogram where it exceeds clipLimit
+    // keep track of excess values for later.
+    if(num_bins_at_index > clipLimit){
+        histograms[binIndex] = clipLimit;
+        atomicAdd(excess_values, (num_bins_at_index - clipLimit));
+    }
+
+    barrier(); //make sure every thread has added its excess before it is redistributed
+
+    // distribute clipped value excess across all bins uniformly
+    atomicAdd(histograms[binIndex], uint(excess_values / numBins));
+
+    memoryBarrierBuffer();
+    barrier(); //make sure all threads are finished before thread 0 computes the cdf
+
+    //compute cdf, handing out the excess that did not divide evenly to every residualStep-th bin
+    if (gl_LocalInvocationIndex == 0){
+        uint residual = excess_values % numBins;
+        uint residualStep = max(numBins / max(residual, 1u), 1u);
+        uint sum = 0u;
+        for(uint i = 0u; i < numBins; i++){
+            bool extra = i % residualStep == 0u && i / residualStep < residual;
+            sum += histograms[tileIndex * numBins + i] + (extra ? 1u : 0u);
+            histograms[tileIndex * numBins + i] = sum;
+        }
+    }
+}
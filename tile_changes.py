@@ -0,0 +1,142 @@
+# tile_changes.py
+# PROVUU
+#
+# Changed-tile detection for mostly static scenes.
+#
+# A fixed camera sees the same background frame after frame, so most tiles come out of the
+# first two passes with the LUT they already had. With dirty tiles, a change pass
+# (shaders/clahe_change_pass.glsl) runs ahead of the first pass and compares every tile with
+# the previous frame. It writes a compacted list of the tiles that changed, headed by the work
+# group counts of an indirect dispatch:
+#
+#   uint numGroupsX, numGroupsY, numGroupsZ     dirty tile count, 1, 1
+#   uint tiles[num_tiles]                       indices of the dirty tiles
+#   uint dirty[num_tiles]                       1 for a dirty tile, read by the third pass
+#
+# The first and second pass then go through glDispatchComputeIndirect on that buffer, so the
+# dirty count never has to come back to the CPU, and the clean tiles keep their LUTs.
+# The counts are copied into a small persistently mapped ring and read once the frame's fence
+# has signaled, only for the report.
+
+import collections
+import ctypes
+import math
+import numpy as np
+from OpenGL.GL import *
+from shader_build import DEFAULT_CHANGE_THRESHOLD
+
+# frames whose dirty counts can be in flight at once, like the scene slots of temporal mode
+COUNT_SLOTS = 4
+
+# indirect dispatch arguments at the head of the dirty tile buffer
+DISPATCH_HEADER = np.array([0, 1, 1], dtype=np.uint32)
+
+# largest absolute difference of two input samples, the r16ui input can hold any 16-bit value
+MAX_SAMPLE_DIFFERENCE = 0xffff
+
+
+class ChangeDetector:
+    def __init__(self, geometry, program, threshold=DEFAULT_CHANGE_THRESHOLD):
+        # the change pass sums the differences of the pixels each invocation strides over in a
+        # uint, and the work group's total in 64 bits
+        local_x, local_y = geometry.local_size(glGetIntegerv(GL_MAX_COMPUTE_WORK_GROUP_INVOCATIONS))
+        invocation_pixels = math.ceil(geometry.tile_width / local_x) * math.ceil(geometry.tile_height / local_y)
+        if invocation_pixels * MAX_SAMPLE_DIFFERENCE > 0xffffffff:
+            raise ValueError(f"{geometry.tile_width}x{geometry.tile_height} tiles are too large for the change pass, "
+                             f"its per invocation sums of {invocation_pixels} pixels could overflow")
+        self.geometry = geometry
+        self.program = program
+        self.threshold = threshold
+        self.first_frame = True
+
+        # statistics
+        self.frames = 0
+        self.dirty_tiles = 0
+        self.counted_frames = 0
+
+        self._create_buffers()
+        self._threshold_location = glGetUniformLocation(program, 'changeThreshold')
+        self._force_location = glGetUniformLocation(program, 'forceDirty')
+        glProgramUniform1f(program, self._threshold_location, threshold)
+        self._free_slots = collections.deque(range(COUNT_SLOTS))
+        self._pending = collections.deque()     # (slot, fence)
+
+    def _create_buffers(self):
+        geometry = self.geometry
+
+        # the previous input frame, kept by the change pass
+        self.previous_frame = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, self.previous_frame)
+        glTexStorage2D(GL_TEXTURE_2D, 1, GL_R16UI, geometry.width, geometry.height)
+        glBindTexture(GL_TEXTURE_2D, 0)
+
+        # dispatch header, dirty tile list and dirty flags
+        self.dirty_buffer = glGenBuffers(1)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, self.dirty_buffer)
+        glBufferData(GL_SHADER_STORAGE_BUFFER, (DISPATCH_HEADER.size + 2 * geometry.num_tiles) * 4, None, GL_DYNAMIC_COPY)
+
+        # dirty tile counts, one uint per slot
+        flags = GL_MAP_READ_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT
+        self.count_buffer = glGenBuffers(1)
+        glBindBuffer(GL_COPY_WRITE_BUFFER, self.count_buffer)
+        glBufferStorage(GL_COPY_WRITE_BUFFER, COUNT_SLOTS * 4, None, flags)
+        ptr = glMapBufferRange(GL_COPY_WRITE_BUFFER, 0, COUNT_SLOTS * 4, flags)
+        self.counts = np.ctypeslib.as_array(ctypes.cast(ptr, ctypes.POINTER(ctypes.c_uint32)), (COUNT_SLOTS,))
+        glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+
+    def bind(self):
+        glBindImageTexture(2, self.previous_frame, 0, GL_FALSE, 0, GL_READ_WRITE, GL_R16UI)
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 5, self.dirty_buffer)
+        glBindBuffer(GL_DISPATCH_INDIRECT_BUFFER, self.dirty_buffer)
+
+    def detect(self):
+        # compare the uploaded frame with the previous one and list the dirty tiles.
+        # every tile is dirty on the first frame, there is nothing to compare with.
+        self._collect()
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, self.dirty_buffer)
+        glBufferSubData(GL_SHADER_STORAGE_BUFFER, 0, DISPATCH_HEADER.nbytes, DISPATCH_HEADER)
+        glProgramUniform1i(self.program, self._force_location, self.first_frame)
+        self.first_frame = False
+
+        glUseProgram(self.program)
+        glDispatchCompute(self.geometry.num_tiles_x, self.geometry.num_tiles_y, 1)
+        # the list feeds the indirect dispatches and the storage buffer reads of the passes
+        glMemoryBarrier(GL_COMMAND_BARRIER_BIT | GL_SHADER_STORAGE_BARRIER_BIT | GL_BUFFER_UPDATE_BARRIER_BIT)
+        self.frames += 1
+
+        if self._free_slots:
+            slot = self._free_slots.popleft()
+            glBindBuffer(GL_COPY_READ_BUFFER, self.dirty_buffer)
+            glBindBuffer(GL_COPY_WRITE_BUFFER, self.count_buffer)
+            glCopyBufferSubData(GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER, 0, slot * 4, 4)
+            self._pending.append((slot, glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)))
+
+    def dispatch(self):
+        # run the bound program on the dirty tiles
+        glDispatchComputeIndirect(0)
+
+    def _collect(self):
+        while self._pending:
+            slot, fence = self._pending[0]
+            if glClientWaitSync(fence, 0, 0) == GL_TIMEOUT_EXPIRED:
+                break
+            glDeleteSync(fence)
+            self._pending.popleft()
+            self.dirty_tiles += int(self.counts[slot])
+            self.counted_frames += 1
+            self._free_slots.append(slot)
+
+    def close(self):
+        while self._pending:
+            glDeleteSync(self._pending.popleft()[1])
+        glBindBuffer(GL_COPY_WRITE_BUFFER, self.count_buffer)
+        glUnmapBuffer(GL_COPY_WRITE_BUFFER)
+        glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+        glDeleteBuffers(2, [self.dirty_buffer, self.count_buffer])
+        glDeleteTextures(1, [self.previous_frame])
+
+    def report(self):
+        dirty = self.dirty_tiles / max(self.counted_frames, 1)
+        return (f"dirty tiles (threshold {self.threshold}): {dirty:.1f} of {self.geometry.num_tiles} tiles "
+                f"recomputed per frame, over {self.counted_frames} of {self.frames} frames")